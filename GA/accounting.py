@@ -0,0 +1,212 @@
+import contextvars
+import csv
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+# USD per million tokens (prompt, completion, prompt served from the provider's prefix cache),
+# models missing here are reported without cost
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60, 0.075),
+    "gpt-4o": (2.50, 10.00, 1.25),
+    "gpt-4.1-mini": (0.40, 1.60, 0.10),
+    "gpt-4.1": (2.00, 8.00, 0.50),
+}
+
+FIELDS = [
+    "time", "generation", "phase", "model", "prompt_tokens", "cached_prompt_tokens", "completion_tokens",
+    "latency", "cost", "cached", "estimated", "error",
+]
+
+# GA phase and generation the LLM calls belong to, asyncio tasks and the
+# threads started with contextvars.copy_context() inherit them
+current_phase = contextvars.ContextVar("current_phase", default=None)
+current_generation = contextvars.ContextVar("current_generation", default=None)
+
+
+@contextmanager
+def phase(name: str, generation: int = None):
+    """
+    Attribute the LLM calls made inside the block to a GA phase (generate, crossover, mutate)
+    """
+    phase_token = current_phase.set(name)
+    generation_token = current_generation.set(generation)
+    try:
+        yield
+    finally:
+        current_phase.reset(phase_token)
+        current_generation.reset(generation_token)
+
+
+def call_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_prompt_tokens: int = 0):
+    if model not in PRICES:
+        return None
+    prompt_price, completion_price, cached_price = PRICES[model]
+    return (
+        (prompt_tokens - cached_prompt_tokens) * prompt_price
+        + cached_prompt_tokens * cached_price
+        + completion_tokens * completion_price
+    ) / 1e6
+
+
+def summarize(records: list) -> dict:
+    """
+    Totals of a list of records (see UsageLedger.record)
+    """
+    latencies = np.array([record["latency"] for record in records if not record["cached"]])
+    costs = [record["cost"] for record in records if record["cost"] is not None]
+    prompt_tokens = sum(record["prompt_tokens"] for record in records)
+    cached_prompt_tokens = sum(record["cached_prompt_tokens"] for record in records)
+    # the provider's prefix cache is unknown for calls without usage
+    reported_prompt_tokens = sum(record["prompt_tokens"] for record in records if not record["estimated"])
+    return {
+        "calls": len(records),
+        "cached": sum(record["cached"] for record in records),
+        "errors": sum(record["error"] is not None for record in records),
+        "estimated": sum(record["estimated"] for record in records),
+        "prompt_tokens": prompt_tokens,
+        "cached_prompt_tokens": cached_prompt_tokens,
+        # share of the prompt tokens the provider took from its prefix cache, of the calls with usage
+        "prefix_cache_ratio": cached_prompt_tokens / reported_prompt_tokens if reported_prompt_tokens else None,
+        "completion_tokens": sum(record["completion_tokens"] for record in records),
+        "cost": sum(costs),
+        "latency_total": float(latencies.sum()) if latencies.size else 0.0,
+        "latency_p50": float(np.percentile(latencies, 50)) if latencies.size else None,
+        "latency_p95": float(np.percentile(latencies, 95)) if latencies.size else None,
+    }
+
+
+class UsageLedger:
+    def __init__(self):
+        """
+        Token, cost and latency of every LLM call of a run
+        """
+        self._lock = threading.Lock()
+        self.records = []
+
+    def record(
+        self,
+        model: str,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        latency: float = 0.0,
+        cached: bool = False,
+        error: str = None,
+        cached_prompt_tokens: int = 0,
+        estimated: bool = False,
+    ) -> dict:
+        """
+        Add one call, tagged with the current phase and generation
+        @param: latency: Seconds until the response arrived, retries and rate limit waits included
+        @param: cached: Answered by the response cache, no tokens were paid for
+        @param: error: Description of the failure if the call failed
+        @param: cached_prompt_tokens: Prompt tokens the provider served from its prefix cache (usage.prompt_tokens_details)
+        @param: estimated: The provider sent no usage (a stream cancelled before its end), the tokens are
+                           counted locally and the call has no cost and no prefix cache share
+        """
+        cost = call_cost(model, prompt_tokens, completion_tokens, cached_prompt_tokens)
+        if cached:
+            cost = 0.0
+        elif estimated:
+            cost = None
+        record = {
+            "time": time.time(),
+            "generation": current_generation.get(),
+            "phase": current_phase.get(),
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": cached_prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency": latency,
+            "cost": cost,
+            "cached": cached,
+            "estimated": estimated,
+            "error": error,
+        }
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def select(self, generation=None, phase_name=None) -> list:
+        with self._lock:
+            records = list(self.records)
+        if generation is not None:
+            records = [record for record in records if record["generation"] == generation]
+        if phase_name is not None:
+            records = [record for record in records if record["phase"] == phase_name]
+        return records
+
+    def summary(self, generation=None) -> dict:
+        """
+        Totals per phase and overall, of one generation or (generation None) of the whole run
+        """
+        records = self.select(generation)
+        phases = sorted({record["phase"] or "other" for record in records})
+        return {
+            "total": summarize(records),
+            "phases": {
+                name: summarize([record for record in records if (record["phase"] or "other") == name])
+                for name in phases
+            },
+        }
+
+    def print_summary(self, generation=None) -> None:
+        summary = self.summary(generation)
+        title = "LLM usage" if generation is None else f"LLM usage of generation {generation}"
+        print(f"{title}: {format_totals(summary['total'])}")
+        for name, totals in summary["phases"].items():
+            print(f"  {name}: {format_totals(totals)}")
+
+    def export(self, path: str) -> None:
+        """
+        Write every record to path, CSV if it ends in .csv, otherwise JSON with the summaries
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        records = self.select()
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(records)
+            return
+
+        generations = sorted({record["generation"] for record in records if record["generation"] is not None})
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "run": self.summary(),
+                    "generations": {str(generation): self.summary(generation) for generation in generations},
+                    "calls": records,
+                },
+                file,
+                indent=2,
+            )
+
+    def reset(self) -> None:
+        with self._lock:
+            self.records = []
+
+
+def format_totals(totals: dict) -> str:
+    cost = f"${totals['cost']:.4f}" if totals["cost"] else "$0"
+    if totals["estimated"]:
+        cost += f" (without {totals['estimated']} cancelled streams)"
+    latency = ""
+    if totals["latency_p50"] is not None:
+        latency = f", latency p50 {totals['latency_p50']:.1f}s p95 {totals['latency_p95']:.1f}s"
+    prefix = ""
+    if totals["prefix_cache_ratio"] is not None:
+        prefix = f" ({totals['prefix_cache_ratio']:.0%} from the prefix cache)"
+    return (
+        f"{totals['calls']} calls ({totals['cached']} cached, {totals['errors']} failed), "
+        f"{totals['prompt_tokens']} prompt{prefix} + {totals['completion_tokens']} completion tokens, {cost}{latency}"
+    )
+
+
+# ledger of this process, every call of llm_api is recorded here
+usage_ledger = UsageLedger()
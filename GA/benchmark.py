@@ -0,0 +1,385 @@
+import argparse
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import build_cache
+import llm_api
+from accounting import usage_ledger, phase
+from evaluator import FitnessEvaluator
+from ga import GA, Solution, evaluate_population
+from llm_api import AsyncLLMClient
+
+RUST_EXAMPLES = os.path.abspath(os.path.join(os.path.dirname(__file__), "../rust_examples"))
+INITIAL_PROMPTS = os.path.abspath(os.path.join(os.path.dirname(__file__), "../initial_prompts/init_prompts.json"))
+# characters per chunk of a streamed response
+STREAM_CHUNK = 16
+
+
+def example_codes(project_path: str) -> list:
+    return sorted(
+        name for name in os.listdir(project_path)
+        if os.path.isfile(os.path.join(project_path, name, "Cargo.toml"))
+    )
+
+
+def read_source(project_path: str, code: str, name: str) -> str:
+    with open(os.path.join(project_path, code, "src", name), "r") as file:
+        return file.read()
+
+
+class MockOpenAIServer:
+    def __init__(self, project_path: str = RUST_EXAMPLES, latency: float = 0.5, jitter: float = 0.0,
+                 recorded: str = None, port: int = 0, chunk_delay: float = 0.0):
+        """
+        Local stand-in for the chat completions endpoint of the OpenAI API.
+        A code generation request is recognised by the skeleton (src/<code>_src.rs) in the prompt and
+        answered with the reference solution src/<code>.rs, or with the responses recorded for that
+        example in a LLM response cache (see llm_cache.py). Crossover requests get one JSON entry per pair.
+        @param: project_path: Path to the rust_examples directory
+        @param: latency: Seconds every response is delayed
+        @param: jitter: Up to this many seconds are added at random to the latency
+        @param: recorded: Path of a LLM response cache to take the code from instead of the reference solutions
+        @param: port: Port to listen on, 0 picks a free one
+        @param: chunk_delay: Seconds between the chunks of a streamed response
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        self._lock = threading.Lock()
+        # system messages seen so far, a request repeating one is served from the prefix cache
+        self.prefixes = set()
+        self.skeletons = {}
+        self.solutions = {}
+        for code in example_codes(project_path):
+            self.skeletons[code] = read_source(project_path, code, f"{code}_src.rs").strip()
+            self.solutions[code] = [f"```rust\n{read_source(project_path, code, f'{code}.rs')}\n```"]
+        if recorded is not None:
+            self._load_recorded(recorded)
+        self._next = {code: 0 for code in self.solutions}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                content = server.respond(body["messages"])
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+                prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+                cached_tokens = server.cached_tokens(body["messages"])
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": prompt_tokens + len(content) // 4,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                }
+                if body.get("stream"):
+                    self.stream(body, content, usage)
+                    return
+                payload = json.dumps({
+                    "id": f"mock-{server.requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [{
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }],
+                    "usage": usage,
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def stream(self, body, content, usage):
+                # server-sent events of chat.completion.chunk objects, the usage in a last chunk
+                def chunk(choices, chunk_usage=None):
+                    return json.dumps({
+                        "id": f"mock-{server.requests}",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": body["model"],
+                        "choices": choices,
+                        "usage": chunk_usage,
+                    })
+
+                events = [
+                    chunk([{"index": 0, "delta": {"content": content[i:i + STREAM_CHUNK]}, "finish_reason": None}])
+                    for i in range(0, len(content), STREAM_CHUNK)
+                ]
+                events.append(chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    events.append(chunk([], usage))
+                events.append("[DONE]")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                try:
+                    for event in events:
+                        self.wfile.write(f"data: {event}\n\n".encode())
+                        self.wfile.flush()
+                        time.sleep(server.chunk_delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client stopped reading, e.g. at the end of the code block
+                    pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._thread = None
+
+    def _load_recorded(self, path: str) -> None:
+        connection = sqlite3.connect(path)
+        rows = connection.execute("SELECT messages, response FROM responses ORDER BY created_at").fetchall()
+        connection.close()
+        recorded = {}
+        for messages, response in rows:
+            code = self.example_of(json.loads(messages))
+            if code is not None and response.startswith("```"):
+                recorded.setdefault(code, []).append(response)
+        self.solutions.update(recorded)
+
+    def cached_tokens(self, messages: list) -> int:
+        # like the OpenAI prefix cache: prompts from 1024 tokens on, in steps of 128 tokens
+        prefix = messages[0]["content"]
+        with self._lock:
+            seen = prefix in self.prefixes
+            self.prefixes.add(prefix)
+        tokens = len(prefix) // 4
+        if not seen or sum(len(message["content"]) for message in messages) // 4 < 1024:
+            return 0
+        return tokens // 128 * 128
+
+    def example_of(self, messages: list):
+        text = " ".join(message["content"] for message in messages)
+        for code, skeleton in self.skeletons.items():
+            if skeleton in text:
+                return code
+        return None
+
+    def respond(self, messages: list) -> str:
+        with self._lock:
+            self.requests += 1
+        text = messages[-1]["content"]
+        pairs = re.findall(r"^Pair (\d+):", text, re.MULTILINE)
+        if pairs:
+            prompts = [{"pair": int(index), "prompt": f"Variant {self.requests}.{index} of the prompt"} for index in pairs]
+            return json.dumps({"prompts": prompts})
+        code = self.example_of(messages)
+        if code is None:
+            # mutation and anything else: the text is sent back
+            return text
+        with self._lock:
+            solutions = self.solutions[code]
+            solution = solutions[self._next[code] % len(solutions)]
+            self._next[code] += 1
+        return solution
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def cpu_seconds() -> float:
+    # the compilers and test binaries are children of this process
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def percentile(values: list, q: float):
+    return float(np.percentile(values, q)) if values else None
+
+
+def benchmark_population(
+    project_path: str,
+    code: str,
+    population_size: int,
+    builds: int,
+    llm_concurrency: int = 8,
+    warm_target_dir: str = None,
+) -> dict:
+    """
+    Generate and evaluate one population through evaluate_population, without the fitness cache
+    @param: population_size: Number of candidates
+    @param: builds: Candidates compiled and tested at the same time
+    @param: llm_concurrency: LLM requests in flight at the same time
+    @return: Throughput, evaluation latencies and CPU utilization
+    """
+    with open(INITIAL_PROMPTS, "r") as file:
+        prompts = json.load(file).get(code) or ["Implement the code."]
+    source_code = read_source(project_path, code, f"{code}_src.rs")
+    evaluator = FitnessEvaluator(project_path, code, builds, warm_target_dir=warm_target_dir)
+    population = [
+        Solution(
+            prompt=f"{prompts[i % len(prompts)]} ({i})",
+            code_string="",
+            source_code=source_code,
+            fitness=float("inf"),
+            run_fitness=False,
+            evaluator=evaluator,
+        )
+        for i in range(population_size)
+    ]
+    llm_client = AsyncLLMClient(max_concurrency=llm_concurrency)
+
+    usage_ledger.reset()
+    cpu_start = cpu_seconds()
+    start = time.perf_counter()
+    try:
+        with phase("generate", 0):
+            evaluate_population(population, llm_client)
+    finally:
+        evaluator.cleanup()
+    wall = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu_start
+
+    reports = [sol.error_report for sol in population if sol.error_report is not None]
+    evaluation_latencies = [sum(report["stage_times"].values()) for report in reports]
+    llm_latencies = [record["latency"] for record in usage_ledger.select() if record["error"] is None]
+    return {
+        "code": code,
+        "population_size": population_size,
+        "builds": builds,
+        "llm_concurrency": llm_concurrency,
+        "wall": wall,
+        "candidates_per_second": population_size / wall,
+        "evaluation_p50": percentile(evaluation_latencies, 50),
+        "evaluation_p95": percentile(evaluation_latencies, 95),
+        "llm_p50": percentile(llm_latencies, 50),
+        "llm_p95": percentile(llm_latencies, 95),
+        "cpu_utilization": cpu / (wall * (os.cpu_count() or 1)),
+        "evaluated": len(reports),
+        "passed": sum(sol.fitness == 0 for sol in population),
+    }
+
+
+def benchmark_ga(code: str, builds: int, llm_concurrency: int = 8, generations: int = 1) -> dict:
+    """
+    Run GA() end to end for a few generations, the population is the initial prompts of the example
+    """
+    usage_ledger.reset()
+    cpu_start = cpu_seconds()
+    start = time.perf_counter()
+    # checkpoints and the prompt log go to a temporary directory, the run leaves the repository clean
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as output_dir:
+        best = GA(
+            input_code=code,
+            generation_limit=generations,
+            mating_pool_size=9,
+            max_parallel_builds=builds,
+            llm_concurrency=llm_concurrency,
+            use_fitness_cache=False,
+            checkpoint_dir=output_dir,
+            prompt_log=os.path.join(output_dir, "prompts.txt"),
+        )
+    wall = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu_start
+    candidates = len(usage_ledger.select(phase_name="generate"))
+    return {
+        "code": code,
+        "generations": generations,
+        "builds": builds,
+        "llm_concurrency": llm_concurrency,
+        "wall": wall,
+        "candidates": candidates,
+        "candidates_per_second": candidates / wall,
+        "cpu_utilization": cpu / (wall * (os.cpu_count() or 1)),
+        "best_fitness": best.fitness,
+    }
+
+
+def format_value(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+
+def print_table(results: list, columns: list) -> None:
+    widths = [max(len(column), *(len(format_value(result[column])) for result in results)) for column in columns]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(format_value(result[column]).rjust(width) for column, width in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark of the evaluation pipeline")
+    parser.add_argument("--file", type=str, default="linked_list", help="Example to benchmark")
+    parser.add_argument("--project", type=str, default=RUST_EXAMPLES, help="Path of the rust_examples directory")
+    parser.add_argument("--populations", type=int, nargs="+", default=[8, 16, 32], help="Population sizes")
+    parser.add_argument("--builds", type=int, nargs="+", default=[1, 2, 4, 8], help="Parallel builds")
+    parser.add_argument("--llm-concurrency", type=int, default=8, help="LLM requests in flight at the same time")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds the mock server takes per response")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random extra latency of the mock server")
+    parser.add_argument("--recorded", type=str, default=None, help="LLM response cache to take the generated code from")
+    parser.add_argument("--ga", action="store_true", help="Also run GA() end to end for every number of builds")
+    parser.add_argument("--generations", type=int, default=1, help="Generations of the end to end run")
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    project_path = os.path.abspath(args.project)
+    warm_target_dir = build_cache.shared_target_dir(project_path)
+    if not build_cache.is_warm(warm_target_dir):
+        print("No warm dependency cache, run `python ga.py warm` first or the first builds dominate")
+        warm_target_dir = None
+
+    with MockOpenAIServer(project_path, args.latency, args.jitter, args.recorded) as server:
+        llm_api.configure_endpoint(server.url, "mock")
+        print(f"Mock OpenAI server on {server.url}, latency {args.latency}s + up to {args.jitter}s")
+
+        population_results = []
+        for population_size in args.populations:
+            for builds in args.builds:
+                population_results.append(
+                    benchmark_population(
+                        project_path, args.file, population_size, builds, args.llm_concurrency, warm_target_dir
+                    )
+                )
+        print("\nPopulation evaluation:")
+        print_table(population_results, [
+            "population_size", "builds", "wall", "candidates_per_second", "evaluation_p50",
+            "evaluation_p95", "llm_p50", "llm_p95", "cpu_utilization", "passed",
+        ])
+
+        ga_results = []
+        if args.ga:
+            # GA() reads the examples and prompts of the repository
+            for builds in args.builds:
+                ga_results.append(benchmark_ga(args.file, builds, args.llm_concurrency, args.generations))
+            print("\nGA end to end:")
+            print_table(ga_results, [
+                "builds", "generations", "candidates", "wall", "candidates_per_second", "cpu_utilization",
+            ])
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump({"population": population_results, "ga": ga_results}, file, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import tempfile
+import time
+from error_message_parser import RustCompilerErrorParser, EvaluationLimits
+from fitness_cache import toolchain_version
+from workspace import CandidateWorkspace, PROFILE
+
+
+def shared_target_dir(project_path: str) -> str:
+    """
+    CARGO_TARGET_DIR shared by all examples and runs, one per toolchain (profiles are subdirectories)
+    @param: project_path: Path to the rust_examples directory
+    """
+    toolchain = hashlib.sha256(toolchain_version(project_path).encode()).hexdigest()[:12]
+    return os.path.join(project_path, ".cargo-target", toolchain)
+
+
+def is_warm(target_dir: str) -> bool:
+    return os.path.isdir(os.path.join(target_dir, PROFILE, "deps"))
+
+
+def _timed_report(parser: RustCompilerErrorParser):
+    start = time.perf_counter()
+    report = parser.generate_report(staged=True)
+    return report, time.perf_counter() - start
+
+
+def warm(project_path: str, code: str, target_dir: str = None) -> dict:
+    """
+    Build the dependencies of one example into the shared target directory and measure how long
+    an evaluation takes without (cold) and with (warm) the prebuilt dependencies.
+    The reference solution src/<code>.rs is evaluated, so check and test artifacts are both built.
+    @param: project_path: Path to the rust_examples directory
+    @param: code: Name of the example crate
+    @param: target_dir: Shared target directory, defaults to shared_target_dir(project_path)
+    @return: Dictionary with the cold and warm evaluation latency in seconds
+    """
+    if target_dir is None:
+        target_dir = shared_target_dir(project_path)
+    was_warm = is_warm(target_dir)
+    crate_path = os.path.join(project_path, code)
+    with open(os.path.join(crate_path, "src", f"{code}.rs"), "r") as file:
+        reference_code = file.read()
+
+    root = os.path.join(project_path, ".workspaces")
+    os.makedirs(root, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=f"warm_{code}_", dir=root) as directory:
+        # a cold build compiles every dependency, far beyond the timeout of a candidate
+        parser = RustCompilerErrorParser(project_path, code, limits=EvaluationLimits(compile_timeout=3600))
+
+        # cold: everything is compiled, straight into the shared directory
+        workspace = CandidateWorkspace(crate_path, code, os.path.join(directory, "cold"))
+        workspace.write_candidate(reference_code)
+        _, cold = _timed_report(parser.for_working_dir(workspace.path, target_dir))
+
+        # warm: a fresh workspace seeded from the shared directory, as used by the evaluator
+        workspace = CandidateWorkspace(crate_path, code, os.path.join(directory, "warm"), target_dir)
+        workspace.write_candidate(reference_code)
+        report, warm_latency = _timed_report(parser.for_working_dir(workspace.path))
+
+    return {
+        "code": code,
+        "target_dir": target_dir,
+        # only a real cold build if the shared directory was empty before
+        "was_warm": was_warm,
+        "cold": cold,
+        "warm": warm_latency,
+        "reference_score": report["total_score"],
+    }
+
+
+def warm_all(project_path: str, codes=None) -> list:
+    """
+    Warm the shared target directory for the given examples (all of them by default) and print the latencies
+    """
+    if codes is None:
+        codes = sorted(
+            name for name in os.listdir(project_path)
+            if os.path.isfile(os.path.join(project_path, name, "Cargo.toml"))
+        )
+    results = []
+    for code in codes:
+        print(f"Warming dependencies of {code}")
+        result = warm(project_path, code)
+        note = " (shared directory was already warm)" if result["was_warm"] else ""
+        print(
+            f"{code}: cold evaluation {result['cold']:.1f}s{note}, warm evaluation {result['warm']:.1f}s, "
+            f"reference solution score {result['reference_score']}"
+        )
+        results.append(result)
+    return results
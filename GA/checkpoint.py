@@ -0,0 +1,83 @@
+import json
+import os
+import random
+from enum import Enum
+import numpy as np
+import data_types
+
+
+def encode_value(value):
+    # enums are stored with their class, selection_type_prob_type can be a RBSType or a FPSType
+    if isinstance(value, Enum):
+        return {"enum": type(value).__name__, "value": value.value}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and "enum" in value:
+        return getattr(data_types, value["enum"])(value["value"])
+    return value
+
+
+def rng_state() -> dict:
+    version, state, gauss_next = random.getstate()
+    np_name, np_keys, np_pos, np_has_gauss, np_cached_gaussian = np.random.get_state()
+    return {
+        "random": [version, list(state), gauss_next],
+        "numpy": [np_name, np_keys.tolist(), np_pos, np_has_gauss, np_cached_gaussian],
+    }
+
+
+def restore_rng_state(state: dict) -> None:
+    version, internal_state, gauss_next = state["random"]
+    random.setstate((version, tuple(internal_state), gauss_next))
+    np_name, np_keys, np_pos, np_has_gauss, np_cached_gaussian = state["numpy"]
+    np.random.set_state(
+        (np_name, np.array(np_keys, dtype=np.uint32), np_pos, np_has_gauss, np_cached_gaussian)
+    )
+
+
+def save_checkpoint(
+    path: str, generation: int, config: dict, population: list, best_solution: dict,
+    prompt_index: list = None, surrogate: dict = None, llm_samples: dict = None,
+) -> None:
+    """
+    Write the state of a GA run after a finished generation
+    @param: path: Checkpoint file, replaced atomically
+    @param: generation: Number of finished generations (0: initial population evaluated)
+    @param: config: Parameters of GA, enums are allowed
+    @param: population: Solutions as dictionaries (see Solution.to_dict)
+    @param: best_solution: Best solution so far as dictionary
+    @param: prompt_index: Solutions of the near-duplicate index as dictionaries, in the order they were added
+    @param: surrogate: Training set of the surrogate model (see SurrogateModel.to_dict)
+    @param: llm_samples: Sample indices handed out by the LLM response cache (see LLMResponseCache.sample_counters)
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    checkpoint = {
+        "generation": generation,
+        "config": {name: encode_value(value) for name, value in config.items()},
+        "population": population,
+        "best_solution": best_solution,
+        "rng_state": rng_state(),
+        "prompt_index": prompt_index,
+        "surrogate": surrogate,
+        "llm_samples": llm_samples,
+    }
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path: str) -> dict:
+    """
+    Read a checkpoint written by save_checkpoint, the config has its enums restored
+    """
+    with open(path, "r") as file:
+        checkpoint = json.load(file)
+    checkpoint["config"] = {
+        name: decode_value(value) for name, value in checkpoint["config"].items()
+    }
+    return checkpoint
@@ -0,0 +1,79 @@
+import re
+
+FENCE = "```"
+# language tags of a fenced block that holds Rust code, an untagged block counts as Rust
+RUST_TAGS = {"", "rust", "rs"}
+TAG = re.compile(r"[A-Za-z0-9_+-]*")
+
+
+class CodeExtractor:
+    def __init__(self):
+        """
+        Finds the first fenced Rust block of a reply while it is streamed, so the request can be
+        cancelled as soon as the closing fence arrives. Prose before the block and blocks in other
+        languages (```toml, ```text, ...) are skipped, the tag may carry attributes (```rust,ignore).
+        """
+        self.text = ""
+        self.start = None
+        self.end = None
+        # start of the first line not looked at yet, and whether it is inside a block of another language
+        self._line = 0
+        self._skipping = False
+
+    @property
+    def closed(self) -> bool:
+        return self.end is not None
+
+    def feed(self, chunk: str) -> bool:
+        """
+        @param: chunk: Next piece of the reply
+        @return: True once the Rust block is closed, everything after it can be dropped
+        """
+        self.text += chunk
+        while not self.closed:
+            newline = self.text.find("\n", self._line)
+            if newline == -1:
+                # a closing fence is recognised before its line is complete
+                if self.start is not None and self.text[self._line:].lstrip().startswith(FENCE):
+                    self.end = self._line
+                break
+            self._scan(self.text[self._line:newline], newline + 1)
+            self._line = newline + 1
+        return self.closed
+
+    def _scan(self, line: str, next_line: int) -> None:
+        stripped = line.strip()
+        if not stripped.startswith(FENCE):
+            return
+        if self.start is not None:
+            self.end = self._line
+        elif self._skipping:
+            self._skipping = False
+        elif TAG.match(stripped, len(FENCE)).group().lower() in RUST_TAGS:
+            self.start = next_line
+        else:
+            self._skipping = True
+
+    def code(self) -> str:
+        """
+        The code of the Rust block, of an unclosed block everything after its opening fence,
+        and the whole reply if it has no Rust block (the model sent bare code)
+        """
+        if self.closed:
+            return self.text[self.start:self.end]
+        if self.start is None:
+            return self.text.strip()
+        code = self.text[self.start:].rstrip()
+        # a closing fence at the end of the last line of code
+        return code[: -len(FENCE)] if code.endswith(FENCE) else code
+
+
+def extract_code(llm_output: str) -> str:
+    """
+    The code of the first fenced Rust block of a reply (see CodeExtractor), None if the call failed
+    """
+    if llm_output is None:
+        return None
+    extractor = CodeExtractor()
+    extractor.feed(llm_output)
+    return extractor.code()
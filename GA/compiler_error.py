@@ -1,11 +1,16 @@
+# The scores of the diagnostics are not set here but by the scoring table (scoring.json),
+# see scoring.ScoringModel. The classes give the errors a type and a readable name.
+
 class CompilerError:
     ERROR_CODE = 0
+    NAME = "Compiler Error"
 
-    def __init__(self, line, column, message):
+    def __init__(self, line=None, column=None, message=None, score=0):
         self.line = line
         self.column = column
         self.message = message
-        self.score = 0
+        self.score = score
+        self.name = self.NAME
 
     @classmethod
     def class_code(cls):
@@ -15,118 +20,92 @@ class CompilerError:
         return f"[E{self.ERROR_CODE:04}] at line {self.line}, column {self.column}: {self.message}"
 
 class GeneralError(CompilerError):
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 2
-        self.name = "General Error"
+    NAME = "General Error"
 
 class TypeMismatchError(CompilerError):
     ERROR_CODE = 308  # E0308: Mismatched types
-
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 8
-        self.name = "Type Mismatch Error"
+    NAME = "Type Mismatch Error"
 
 
 class OwnershipError(CompilerError):
     ERROR_CODE = 382  # E0382: Use of moved value
-
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 10
-        self.name = "Ownership Error"
+    NAME = "Ownership Error"
 
 
 class BorrowCheckerError(CompilerError):
     ERROR_CODE = 499  # E0499: Cannot borrow as mutable more than once at a time
-
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 9
-        self.name = "Borrow Checker Error"
+    NAME = "Borrow Checker Error"
 
 
 class TraitImplementationError(CompilerError):
     ERROR_CODE = 277  # E0277: Trait not implemented
-
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 7
-        self.name = "Trait Implementation Error"
+    NAME = "Trait Implementation Error"
 
 
 class UndefinedValueError(CompilerError):
     ERROR_CODE = 425  # E0425: Cannot find value in this scope
-
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 6
-        self.name = "Undefined Value Error"
+    NAME = "Undefined Value Error"
 
 class UndeclaredType(CompilerError):
-    ERROR_CODE = 433
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 10
-        self.name = "Undeclared Type Error"
+    ERROR_CODE = 433  # E0433: Failed to resolve, use of undeclared type or module
+    NAME = "Undeclared Type Error"
+
 class MethodNotFoundError(CompilerError):
     ERROR_CODE = 599  # E0599: No method named X found for type Y
+    NAME = "Method Not Found Error"
 
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 7
-        self.name = "Method Not Found Error"
 class NonMutableValueAssignmentError(CompilerError):
-    ERROR_CODE = 594
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 1
-        self.name = "Non Mutable Value Assignment Error"
+    ERROR_CODE = 594  # E0594: Assignment to a field or variable that is not mutable
+    NAME = "Non Mutable Value Assignment Error"
+
 class AccessToNonExistentFieldError(CompilerError):
-    ERROR_CODE = 609
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 1
-        self.name = "Non Mutable Value Assignment Error"
+    ERROR_CODE = 609  # E0609: No field on the type, also a field access through a type without Deref
+    NAME = "Access To Non Existent Field Error"
 
 class DelimiterError(CompilerError):
-    def __init__(self, line = None, column = None, message = None):
-        super().__init__(line, column, message)
-        self.score = 100
-        self.name = "Delimiter Error"
+    NAME = "Delimiter Error"
 
 class OperatorTypeError(CompilerError):
     ERROR_CODE = 369  # E0369: Cannot apply binary operator to types
-
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 5
-        self.name = "Operator Type Error"
+    NAME = "Operator Type Error"
 
 
 class MutableBorrowError(CompilerError):
     ERROR_CODE = 502  # E0502: Cannot borrow as immutable because it is also borrowed as mutable
-
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 8
-        self.name = "Mutable Borrow Error"
+    NAME = "Mutable Borrow Error"
 
 
 class UndeclaredLifetimeError(CompilerError):
     ERROR_CODE = 261  # E0261: Use of undeclared lifetime name
+    NAME = "Undeclared Lifetime Error"
+
+
+# outcomes of an evaluation that hit one of the limits, they have no rustc error code
+
+class CompileTimeoutError(CompilerError):
+    NAME = "Compile Timeout Error"
+
+class BuildError(CompilerError):
+    # the build failed, but none of its errors is in the scoring table (e.g. a syntax error without a code)
+    NAME = "Build Error"
 
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 6
-        self.name = "Undeclared Lifetime Error"
+class TestTimeoutError(CompilerError):
+    # the code compiles, but the tests never finish (infinite loop, cpu limit)
+    NAME = "Test Timeout Error"
 
+class TestCrashError(CompilerError):
+    # the test binary died without a result (stack overflow, memory limit, abort)
+    NAME = "Test Crash Error"
 
-class DerefFieldError(CompilerError):
-    ERROR_CODE = 609  # E0609: Attempt to access a field of a type that does not implement Deref
 
-    def __init__(self, line, column, message):
-        super().__init__(line, column, message)
-        self.score = 5
-        self.name = "Deref Field Error"
+def error_classes():
+    """
+    Every error class by name, the names the scoring table refers to
+    """
+    classes = {}
+    pending = [CompilerError]
+    while pending:
+        cls = pending.pop()
+        classes[cls.__name__] = cls
+        pending.extend(cls.__subclasses__())
+    return classes
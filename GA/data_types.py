@@ -7,6 +7,7 @@ class NextGenSelectionType(Enum):
     RBS = "RBS" # ranking based selection
     FPS = "FPS" # improved fitness proportionate selection
     TRS = "TRS" # tournament selection
+    LEXICASE = "LEXICASE" # lexicase selection over the outcomes of the single tests
 
 
 # for selection types from new population
@@ -39,3 +40,22 @@ class CrossOverType(Enum):
     SINGLE_POINT = "SINGLE_POINT"
     TWO_POINT = "TWO_POINT"
     UNIFORM = "UNIFORM"
+
+
+# modes of the LLM response cache
+class CacheMode(Enum):
+    RECORD = "RECORD" # always call the API, store every response
+    REPLAY = "REPLAY" # never call the API, a missing response is an error
+    READ_THROUGH = "READ_THROUGH" # use stored responses, call the API and store on a miss
+
+
+# what happens to an offspring prompt that is a near-duplicate of an evaluated one
+class DuplicatePolicy(Enum):
+    INHERIT = "INHERIT"  # takes over the fitness of the similar prompt, not evaluated
+    REGENERATE = "REGENERATE"  # dropped, another crossover replaces it
+
+
+# what the model returns for a candidate
+class GenerationMode(Enum):
+    FULL = "FULL"  # the whole file
+    PATCH = "PATCH"  # only the items that change, applied to the skeleton (see patch.py)
@@ -5,150 +5,463 @@ import re
 import subprocess
 import json
 import os
+import resource
+import signal
+import threading
+import time
+from scoring import default_model, diagnostic_record
+from tracing import tracer
+
+
+class EvaluationLimits:
+    def __init__(self, compile_timeout=600, test_timeout=30, memory_limit=2 * 1024 ** 3, cpu_limit=None):
+        """
+        Limits of one evaluation, so a pathological candidate can't stall the generation
+        @param: compile_timeout: Seconds a cargo check / cargo build may take
+        @param: test_timeout: Wall-clock seconds the test binary may run
+        @param: memory_limit: Address space of the test binary in bytes, None for no limit
+        @param: cpu_limit: CPU seconds of the test binary, defaults to the test timeout
+        """
+        self.compile_timeout = compile_timeout
+        self.test_timeout = test_timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit if cpu_limit is not None else test_timeout
+
+    def apply(self, pid):
+        # set on the running process (instead of a preexec_fn, which is not
+        # safe with the evaluator threads), the test binary has barely started
+        try:
+            if self.memory_limit is not None:
+                resource.prlimit(pid, resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
+            if self.cpu_limit is not None:
+                cpu_limit = int(self.cpu_limit)
+                resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+        except ProcessLookupError:
+            # the binary already exited (or crashed), its output tells what happened
+            pass
+        except OSError as e:
+            # the wall-clock timeout still applies
+            print(f"Resource limits not applied to the tests: {e}")
+
+
+def kill_process_group(process, killed=None):
+    """
+    SIGKILL the process group of a process started with start_new_session=True
+    @param: killed: Event that is set when the group was killed by this call
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        return
+    if killed is not None:
+        killed.set()
+
+# characters of the output of a failed test kept in the report
+MAX_TEST_MESSAGE = 500
+# lines of cargo's own output (stderr) kept for the message of a failed cargo run
+MAX_CARGO_OUTPUT = 20
+
+def pass_vector(test_results):
+    return [int(test_results[name]['outcome'] == 'ok') for name in sorted(test_results)]
 
 # FIXME class doesn't only parse the compiler errors now as well, it parses the normal test output as well
 #so the name should be changed to RustTestOutputParser or something similar
 class RustCompilerErrorParser:
-    def __init__(self, project_path, code):
+    def __init__(self, project_path, code, working_dir=None, target_dir=None, limits=None, scoring=None):
         """
         Initialize the parser with the path to the Rust project
         @param: project_path: Path to the Rust project root directory
         @param: code: The code to be tested, it is used in cargo test
+        @param: working_dir: Crate directory cargo runs in, defaults to project_path/code
+        @param: target_dir: CARGO_TARGET_DIR for cargo, defaults to the target directory of the crate
+        @param: limits: EvaluationLimits, the defaults if None
+        @param: scoring: ScoringModel of the diagnostics, the table in scoring.json if None
         """
         self.project_path = project_path
         self.code = code 
-        self.errors = (
-            #TODO: Add more error classes
-            OwnershipError,
-            TypeMismatchError,
-            BorrowCheckerError,
-            TraitImplementationError,
-            UndefinedValueError,
-            MethodNotFoundError,
-            UndeclaredType,
-            OperatorTypeError,
-            MutableBorrowError,
-            UndeclaredLifetimeError,
-            DerefFieldError,
-            NonMutableValueAssignmentError,
-            AccessToNonExistentFieldError
-            )
+        self.working_dir = working_dir or os.path.join(project_path, code)
+        self.target_dir = target_dir
+        self.limits = limits or EvaluationLimits()
+        self.scoring = scoring or default_model()
         self.list_of_errors = None
         self.passed = 0
         self.failed = 0 
+        # tests of an aborted run that did not finish, they count in the score as if they passed
+        self.unfinished = 0
+        self.build_success = None
+        # early abort policy, see should_abort
+        self.abort_above = None
+        self.max_errors = None
+        self.aborted = False
+        self.test_executables = []
+        # records of the scored diagnostics and type names of the outcomes of the last cargo run,
+        # kept in the report so it can be scored again without compiling
+        self.diagnostics = []
+        self.outcomes = []
+        # TestTimeoutError or TestCrashError if the tests did not finish
+        self.test_outcome = None
+        # outcome ('ok', 'failed', 'ignored', 'timeout', 'crashed' or 'aborted') and
+        # duration in seconds of every test, by name, the failed ones with their output
+        self.test_results = {}
+        # wall-clock seconds of every cargo command that ran, by stage
+        self.stage_times = {}
+        # why cargo failed without a compiler error (missing dependency, registry, manifest, no cargo),
+        # the candidate can't be scored then
+        self.cargo_error = None
 
     def parse_cargo_test_output(self):
         """
-        Run cargo test and parse the output for compiler errors and run time result of the test. 
+        Build the tests with cargo and run them, parse the output for compiler errors and run time result of the test. 
+        The build runs under the compile timeout, the test binary under the test timeout and the resource limits.
         @return: List of CompilerError instances
         """
+        with tracer.span("build", code=self.code):
+            errors = self.run_cargo(['test', '--no-run', '--message-format=json'], 'build')
+        if self.aborted or not self.build_success or self.cargo_error:
+            return errors
+
+        start = time.perf_counter()
+        with tracer.span("test", code=self.code):
+            for executable in self.test_executables:
+                outcome = self.run_test_binary(executable)
+                if outcome is not None:
+                    self.test_outcome = self.add_outcome(outcome)
+                    errors.append(outcome)
+                    break
+                if self.aborted:
+                    break
+        self.stage_times['test'] = time.perf_counter() - start
+        self.list_of_errors = errors
+        return errors
+
+    def parse_cargo_check_output(self):
+        """
+        Run cargo check on the crate and its tests, only type and borrow checks, nothing is linked or run
+        @return: List of CompilerError instances
+        """
+        with tracer.span("check", code=self.code):
+            return self.run_cargo(['check', '--tests', '--message-format=json'], 'check')
+
+    def run_cargo(self, args, stage):
+        """
+        Run a cargo command with JSON messages in the crate directory of this parser and parse its
+        output while it is produced. The command is killed as soon as the abort policy is met,
+        or when it takes longer than the compile timeout.
+        @param: args: Arguments of cargo, e.g. ['test', '--no-run', '--message-format=json']
+        @param: stage: Name the run time is recorded under in self.stage_times
+        @return: List of CompilerError instances
+        """
+        errors = []
+        self.diagnostics = []
+        self.outcomes = []
+        scorer = self.scoring.scorer()
         try:
-            # Change to the project directory
-            original_dir = os.getcwd()
-            os.chdir(self.project_path + '/'+ self.code)
-
-            # Run cargo test with JSON output
-            result = subprocess.run(
-                ['cargo', 'test', '--message-format=json'], #enable running as well..  
-                capture_output=True, 
-                text=True
+            start = time.perf_counter()
+            env = None
+            if self.target_dir is not None:
+                env = dict(os.environ, CARGO_TARGET_DIR=self.target_dir)
+            # own process group, so rustc is killed together with cargo. The diagnostics are
+            # JSON lines on stdout, cargo's own messages come from stderr and are kept for errors
+            process = subprocess.Popen(
+                ['cargo'] + args,
+                cwd=self.working_dir,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                start_new_session=True,
+            )
+            timed_out = threading.Event()
+            watchdog = threading.Timer(
+                self.limits.compile_timeout, kill_process_group, [process, timed_out]
             )
-            # output = result_.stdout + result_.stderr
-            # Collect errors
-            errors = []
-            # Parse JSON output
-            for line in result.stdout.split('\n'):
-                if not line.strip():
+            watchdog.start()
+            # score and number of diagnostics that are real errors (not warnings)
+            error_score = 0
+            error_count = 0
+            # errors rustc reported, scored or not
+            reported_errors = 0
+            cargo_output = deque(maxlen=MAX_CARGO_OUTPUT)
+            for line in process.stdout:
+                if not line.startswith('{'):
+                    cargo_output.append(line.rstrip())
                     continue
                 try:
                     message = json.loads(line)
-                    
-                    # Check if it's a compiler error
-                    if message.get('reason') == 'compiler-message':
-                        error_details = message.get('message', {})
-                        
-                        # Extract error specifics
-                        code = error_details.get('code', {})
-
-                        # if it is an actual error, we will have a code
-                        if code:
-                            error_code = code.get('code', '')
-                        else:
-                            if "delimiter" in error_details.get('message', {}):
-                               errors.append(
-                                      DelimiterError()
-                               )
-                            continue
-                        spans = error_details.get('spans', [{}])[0]
-                        line = spans.get('line_start', 0)
-                        column = spans.get('column_start', 0)
-                        error_message = error_details.get('message', {})
-                        # Determine error type
-                        error_class = CompilerError
-                        IsSet = False
-                        for error_type in self.errors:
-                            if error_code == error_type.class_code():
-                                error_class = error_type
-                                IsSet = True
-                                break
-                        if not IsSet and error_code != "E0000":
-                            error_class = GeneralError
-                        # Create error instance
-                        error = error_class(
-                            line=line, 
-                            column=column, 
-                            message=error_message
-                        )
-                        errors.append(error)
-                
                 except json.JSONDecodeError:
-                    expr = r"(\d+)\s+passed;\s+(\d+)\s+failed;"
-                    match = re.search(expr, line)
-                    if match:
-                        self.passed = int(match.group(1))
-                        self.failed = int(match.group(2))
-            
-            # Change back to original directory
-            os.chdir(original_dir)
+                    cargo_output.append(line.rstrip())
+                    continue
+
+                if message.get('reason') == 'build-finished':
+                    self.build_success = message.get('success', False)
+                if message.get('reason') == 'compiler-artifact' and message.get('executable'):
+                    if message.get('profile', {}).get('test'):
+                        self.test_executables.append(message['executable'])
+                if message.get('reason') != 'compiler-message':
+                    continue
+                if message.get('message', {}).get('level') == 'error':
+                    reported_errors += 1
+
+                diagnostic = diagnostic_record(message.get('message', {}))
+                error = scorer.add(diagnostic)
+                if error is None:
+                    continue
+                self.diagnostics.append(diagnostic)
+                errors.append(error)
+                if diagnostic['level'] == 'error':
+                    error_score += error.score
+                    error_count += 1
+                    if self.should_abort(error_score, error_count):
+                        self.aborted = True
+                        kill_process_group(process)
+                        break
+
+            process.stdout.close()
+            process.wait()
+            watchdog.cancel()
+            if timed_out.is_set():
+                self.build_success = False
+                errors.append(self.add_outcome(
+                    CompileTimeoutError(message=f"cargo {args[0]} took longer than {self.limits.compile_timeout}s")
+                ))
+            elif not self.aborted and (process.returncode != 0 or self.build_success is False):
+                self.build_success = False
+                if reported_errors == 0:
+                    # nothing in the code failed, e.g. a dependency that can't be resolved
+                    self.cargo_failed(f"cargo {args[0]} exited with {process.returncode} without a compiler error", cargo_output)
+                elif error_count == 0:
+                    errors.append(self.add_outcome(
+                        BuildError(message=f"cargo {args[0]} failed, none of its {reported_errors} errors is scored")
+                    ))
+            self.stage_times[stage] = time.perf_counter() - start
             self.list_of_errors = errors
             return errors
 
-        except subprocess.CalledProcessError as e:
-            print(f"Error running cargo test: {e}")
-            return []
         except Exception as e:
-            print(f"Unexpected error: {e}")
-            return []
+            # e.g. cargo is not installed
+            self.build_success = False
+            self.cargo_failed(f"cargo {args[0]} could not run: {e!r}", [])
+            return errors
 
-    def generate_report(self):
+    def cargo_failed(self, reason, output):
+        """
+        Record a cargo run that failed for reasons outside the candidate, the report then scores inf
+        and is not cached
+        @param: output: Last lines of cargo's own output
+        """
+        self.cargo_error = "\n".join([reason, *output])
+        print(f"{reason} in {self.working_dir}:")
+        for line in output:
+            print(f"  {line}")
+
+    def run_test_binary(self, executable):
+        """
+        Run a test binary built by cargo under the test timeout and the resource limits, with
+        libtest's JSON event stream (an unstable option, enabled with RUSTC_BOOTSTRAP=1 for the
+        test binary only). The outcome and duration of every test go to self.test_results. The
+        tests are stopped as soon as the failed ones alone score above abort_above.
+        @param: executable: Path of the test binary
+        @return: None if the tests finished or were aborted (self.passed and self.failed are updated),
+                 TestTimeoutError or TestCrashError otherwise
+        """
+        process = subprocess.Popen(
+            [executable, '-Z', 'unstable-options', '--format', 'json', '--report-time'],
+            cwd=self.working_dir,
+            env=dict(os.environ, RUSTC_BOOTSTRAP='1'),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            start_new_session=True,
+        )
+        self.limits.apply(process.pid)
+        timed_out = threading.Event()
+        watchdog = threading.Timer(self.limits.test_timeout, kill_process_group, [process, timed_out])
+        watchdog.start()
+
+        events_seen = False
+        suite_finished = False
+        test_count = 0
+        passed = 0
+        failed = 0
+        running = set()
+        for line in process.stdout:
+            if not line.startswith('{'):
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            events_seen = True
+            if event.get('type') == 'suite':
+                if event.get('event') == 'started':
+                    test_count = event.get('test_count', 0)
+                else:
+                    suite_finished = True
+                continue
+            if event.get('type') != 'test':
+                continue
+
+            name, outcome = event.get('name'), event.get('event')
+            if outcome == 'started':
+                running.add(name)
+            # libtest also reports tests running for long as 'timeout', they are still running
+            if outcome not in ('ok', 'failed', 'ignored'):
+                continue
+            running.discard(name)
+            self.test_results[name] = {'outcome': outcome, 'duration': event.get('exec_time')}
+            if outcome == 'failed' and event.get('stdout'):
+                # the panic message, without a backtrace
+                message = event['stdout'].split('stack backtrace:')[0]
+                self.test_results[name]['message'] = message[:MAX_TEST_MESSAGE]
+            if outcome == 'ok':
+                passed += 1
+            elif outcome == 'failed':
+                failed += 1
+                # the score is at least failed / test_count whatever the other tests do
+                if self.abort_above is not None and test_count and failed / test_count > self.abort_above:
+                    self.aborted = True
+                    kill_process_group(process)
+                    break
+
+        process.stdout.close()
+        process.wait()
+        watchdog.cancel()
+        if not events_seen and not timed_out.is_set() and process.returncode > 0:
+            # a toolchain that refuses the JSON format
+            return self.run_test_binary_summary(executable)
+
+        # the counts of tests that did not finish are not used, the score is then the one of the outcome
+        if self.aborted or (suite_finished and process.returncode >= 0):
+            self.passed += passed
+            self.failed += failed
+        if self.aborted:
+            # the score of an aborted run is failed / test_count, the bound the abort was decided on
+            self.unfinished += max(test_count - passed - failed, 0)
+        if self.aborted:
+            outcome = 'aborted'
+        elif timed_out.is_set() or process.returncode == -signal.SIGXCPU:
+            outcome = 'timeout'
+        else:
+            outcome = 'crashed'
+        for name in running:
+            self.test_results[name] = {'outcome': outcome, 'duration': None}
+
+        if self.aborted:
+            return None
+        if timed_out.is_set():
+            return TestTimeoutError(message=f"tests took longer than {self.limits.test_timeout}s")
+        if process.returncode == -signal.SIGXCPU:
+            return TestTimeoutError(message="tests exceeded the cpu time limit")
+        if not suite_finished or process.returncode < 0:
+            return TestCrashError(message=f"test binary exited with {process.returncode}")
+        return None
+
+    def run_test_binary_summary(self, executable):
+        """
+        Run a test binary with the default output and take the counts from its summary line,
+        for toolchains without libtest's JSON format. Same return value as run_test_binary.
+        """
+        process = subprocess.Popen(
+            [executable],
+            cwd=self.working_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            start_new_session=True,
+        )
+        self.limits.apply(process.pid)
+        try:
+            output, _ = process.communicate(timeout=self.limits.test_timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(process)
+            process.communicate()
+            return TestTimeoutError(message=f"tests took longer than {self.limits.test_timeout}s")
+
+        match = re.search(r"(\d+)\s+passed;\s+(\d+)\s+failed;", output)
+        if match:
+            self.passed += int(match.group(1))
+            self.failed += int(match.group(2))
+        if process.returncode == -signal.SIGXCPU:
+            return TestTimeoutError(message="tests exceeded the cpu time limit")
+        if match is None or process.returncode < 0:
+            return TestCrashError(message=f"test binary exited with {process.returncode}")
+        return None
+
+    def should_abort(self, error_score, error_count):
+        """
+        Abort policy: the candidate can't be selected anymore once its compile errors alone
+        score above abort_above, or once there are max_errors errors
+        """
+        if self.abort_above is not None and error_score > self.abort_above:
+            return True
+        return self.max_errors is not None and error_count >= self.max_errors
+
+    def add_outcome(self, error):
+        """
+        Score an outcome of the evaluation (a limit that was hit) and record it for the report
+        @param: error: CompileTimeoutError, TestTimeoutError or TestCrashError
+        """
+        self.outcomes.append(type(error).__name__)
+        return self.scoring.outcome(error)
+
+    def for_working_dir(self, working_dir, target_dir=None):
+        """
+        Create a fresh parser for the same example that runs cargo in another crate directory
+        @param: working_dir: Crate directory, e.g. the workspace of one candidate
+        @param: target_dir: CARGO_TARGET_DIR for cargo, defaults to the target directory of the crate
+        @return: RustCompilerErrorParser
+        """
+        return RustCompilerErrorParser(
+            self.project_path, self.code, working_dir, target_dir, self.limits, self.scoring
+        )
+
+    def generate_report(self, staged=False, abort_above=None, max_errors=None):
         """
         Generate a comprehensive error report
         @param: self
-        @return: Dictionary with error statistics and unit test result
-        """
-        # if self.list_of_errors is None:
-        errors = self.parse_cargo_test_output()
-        # else:
-            # errors = self.list_of_errors
-        
-        report = {
-            'total_errors': len(errors),
-            'errors_by_type': {},
-            'total_score': 0,
-            'passed': self.passed,
-            'failed': self.failed
-        }
-        
-        for error in errors:
-            error_type = type(error).__name__
-            if error_type not in report['errors_by_type']:
-                report['errors_by_type'][error_type] = 0
-            report['errors_by_type'][error_type] += 1
-            
-            report['total_score'] += error.score
-        if not (self.passed == 0 and self.failed == 0):
-            report['total_score'] = report['failed'] / (report['failed'] + report['passed'])
-        
+        @param: staged: Run cargo check first and only run cargo test when the code compiles
+        @param: abort_above: Stop the build once the compile errors (or the tests once the failed tests) score above this
+        @param: max_errors: Stop the build after this many compile errors
+        @return: Dictionary with error statistics and unit test result, the stage that decided
+                 the score ('check' or 'test'), the run time of every stage, whether the
+                 build or the tests were aborted (the score is then a lower bound, the tests that
+                 did not finish are counted in 'unfinished' and score as passed) and the
+                 outcome of every test ('tests', 'pass_vector'). The scored diagnostics of the
+                 deciding stage ('diagnostics') and the limits that were hit ('outcomes') are kept,
+                 see ScoringModel.score_report. 'cargo_error' says why cargo failed without a
+                 compiler error, None if it did not, 'build_success' whether the last build succeeded
+                 (None if cargo never finished a build)
+        """
+        self.abort_above = abort_above
+        self.max_errors = max_errors
+        stage = 'test'
+        if staged:
+            self.parse_cargo_check_output()
+            # a failed check already decides the score, building and linking
+            # the test binary would only report the same diagnostics again
+            if self.build_success is False or self.aborted or self.cargo_error:
+                stage = 'check'
+        if stage == 'test':
+            self.parse_cargo_test_output()
+
+        # scoring the diagnostics collected while cargo ran
+        with tracer.span("parse", code=self.code):
+            report = self.scoring.score_report({
+                'passed': self.passed,
+                'failed': self.failed,
+                'unfinished': self.unfinished,
+                'stage': stage,
+                'stage_times': dict(self.stage_times),
+                'aborted': self.aborted,
+                'tests': dict(self.test_results),
+                # 1 for every passed test, in the order of the sorted test names
+                'pass_vector': pass_vector(self.test_results),
+                'diagnostics': list(self.diagnostics),
+                'outcomes': list(self.outcomes),
+                'cargo_error': self.cargo_error,
+                'build_success': self.build_success,
+            })
+
         return report
 
 # Example usage
@@ -0,0 +1,126 @@
+import os
+from error_message_parser import RustCompilerErrorParser, EvaluationLimits
+from fitness_cache import FitnessCache, toolchain_version
+from scoring import ScoringModel
+from workspace import WorkspacePool
+from tracing import tracer
+
+# part of the fitness cache key, to be raised when the reports get new fields
+REPORT_VERSION = 5
+
+
+def cacheable(report: dict) -> bool:
+    """
+    Whether a report is a result of the code alone, only those are cached: the build ran and ended
+    with diagnostics or with the tests. An aborted report depends on the threshold (its score is only
+    a lower bound), a compile timeout may just be a busy machine, and a cargo run that failed outside
+    the code (see RustCompilerErrorParser.cargo_error) says nothing about the candidate
+    """
+    if report["aborted"] or report.get("cargo_error") or report.get("build_success") is None:
+        return False
+    if "CompileTimeoutError" in report["outcomes"]:
+        return False
+    if report["build_success"]:
+        test_outcomes = {"TestTimeoutError", "TestCrashError"}
+        return bool(report["tests"]) or bool(test_outcomes.intersection(report["outcomes"]))
+    return bool(report["diagnostics"]) or "BuildError" in report["outcomes"]
+
+
+class FitnessEvaluator:
+    def __init__(
+        self,
+        project_path: str,
+        code: str,
+        max_parallel_builds: int = None,
+        workspace_root: str = None,
+        fitness_cache: FitnessCache = None,
+        staged: bool = True,
+        warm_target_dir: str = None,
+        max_errors: int = None,
+        limits: EvaluationLimits = None,
+        scoring: ScoringModel = None,
+    ):
+        """
+        Builds and tests generated code for one example crate, each candidate in its own workspace
+        @param: project_path: Path to the rust_examples directory
+        @param: code: Name of the example crate, e.g. linked_list
+        @param: max_parallel_builds: Number of candidates compiled and tested at the same time
+        @param: workspace_root: Directory the per-candidate workspaces are created in
+        @param: fitness_cache: Reports of code that was already evaluated, None disables caching
+        @param: staged: Gate cargo test behind a cargo check, see RustCompilerErrorParser.generate_report
+        @param: warm_target_dir: Shared target directory with prebuilt dependencies (see build_cache)
+        @param: max_errors: Abort a build after this many compile errors, None never aborts on the count
+        @param: limits: Timeouts and resource limits of an evaluation, EvaluationLimits() if None
+        @param: scoring: Scoring table of the diagnostics, scoring.json if None. Cached reports are
+                         scored again with it, so it is not part of the cache key
+        """
+        self.project_path = project_path
+        self.code = code
+        self.err_parser = RustCompilerErrorParser(project_path, code, limits=limits, scoring=scoring)
+        self.workspace_pool = WorkspacePool(
+            project_path, code, max_parallel_builds, workspace_root, warm_target_dir
+        )
+        self.fitness_cache = fitness_cache
+        self.staged = staged
+        self.max_errors = max_errors
+        self.cache_context = self._cache_context() if fitness_cache is not None else ()
+
+    def _cache_context(self) -> tuple:
+        # everything besides the generated code that decides the report
+        crate_path = os.path.join(self.project_path, self.code)
+        context = [f"report {REPORT_VERSION}", toolchain_version(crate_path)]
+        for name in ("Cargo.toml", "src/main.rs", f"src/test_{self.code}.rs"):
+            with open(os.path.join(crate_path, name), "r") as file:
+                context.append(file.read())
+        return tuple(context)
+
+    def evaluate(self, code_string: str, abort_above: float = None) -> dict:
+        """
+        Compile and test the code in a free workspace
+        @param: code_string: Generated content of src/<code>.rs
+        @param: abort_above: Stop the build once the score is above this, e.g. the worst fitness in the population
+        @return: Report of RustCompilerErrorParser.generate_report
+        """
+        if self.fitness_cache is not None:
+            key = self.fitness_cache.key(code_string, *self.cache_context)
+            report = self.fitness_cache.get(key)
+            if report is not None:
+                report = self.err_parser.scoring.score_report(report)
+                report['cached'] = True
+                return report
+
+        with self.workspace_pool.workspace() as workspace:
+            with tracer.span("write", code=self.code, workspace=os.path.basename(workspace.path)):
+                workspace.write_candidate(code_string)
+            # a parser per evaluation, so the errors and test counts of
+            # concurrently evaluated candidates are never mixed up
+            parser = self.err_parser.for_working_dir(workspace.path)
+            report = parser.generate_report(self.staged, abort_above, self.max_errors)
+
+        if self.fitness_cache is not None and cacheable(report):
+            self.fitness_cache.put(key, report)
+        return report
+
+    def cache_stats(self):
+        """
+        Fitness cache hits and misses since the last call, None if caching is disabled
+        """
+        if self.fitness_cache is None:
+            return None
+        return self.fitness_cache.generation_stats()
+
+    def cleanup(self) -> None:
+        self.workspace_pool.cleanup()
+
+
+class EvaluationTask:
+    def __init__(self, code: str, source_code: str, evaluator: FitnessEvaluator):
+        """
+        One example a prompt is scored on in multi-crate mode
+        @param: code: Name of the example crate
+        @param: source_code: Content of its src/<code>_src.rs, the skeleton given to the LLM
+        @param: evaluator: FitnessEvaluator of the crate
+        """
+        self.code = code
+        self.source_code = source_code
+        self.evaluator = evaluator
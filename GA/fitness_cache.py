@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import threading
+from typing import List, Tuple
+
+# multi character operators, longest first so they are matched greedily
+RUST_OPERATORS = (
+    "<<=", ">>=", "...", "..=", "::", "->", "=>", "==", "!=", "<=", ">=", "&&", "||",
+    "+=", "-=", "*=", "/=", "%=", "^=", "&=", "|=", "<<", ">>", "..",
+)
+RAW_STRING = re.compile(r'b?r(#*)"')
+IDENT_OR_NUMBER = re.compile(r"[A-Za-z0-9_]+")
+CHAR_LITERAL = re.compile(r"'(\\(x[0-9a-fA-F]{2}|u\{[0-9a-fA-F]+\}|.)|[^\\'])'")
+# seconds a write waits for another process holding the database lock
+BUSY_TIMEOUT = 60
+
+
+def token_spans(code: str) -> List[Tuple[int, int]]:
+    """
+    Positions of the tokens of Rust code, whitespace and comments (including doc comments) are skipped
+    @param: code: Rust source code
+    @return: List of (start, end) of the tokens, string and char literals are a single token
+    """
+    tokens = []
+    i = 0
+    n = len(code)
+    while i < n:
+        c = code[i]
+        if c.isspace():
+            i += 1
+        elif code.startswith("//", i):
+            end = code.find("\n", i)
+            i = n if end == -1 else end
+        elif code.startswith("/*", i):
+            # block comments nest in Rust
+            depth = 0
+            while i < n:
+                if code.startswith("/*", i):
+                    depth += 1
+                    i += 2
+                elif code.startswith("*/", i):
+                    depth -= 1
+                    i += 2
+                    if depth == 0:
+                        break
+                else:
+                    i += 1
+        elif RAW_STRING.match(code, i) and (i == 0 or not (code[i - 1].isalnum() or code[i - 1] == "_")):
+            match = RAW_STRING.match(code, i)
+            closing = '"' + match.group(1)
+            end = code.find(closing, match.end())
+            end = n if end == -1 else end + len(closing)
+            tokens.append((i, end))
+            i = end
+        elif c == '"' or code.startswith('b"', i):
+            start = i
+            i = code.index('"', i) + 1
+            while i < n and code[i] != '"':
+                i += 2 if code[i] == "\\" else 1
+            i += 1
+            tokens.append((start, i))
+        elif c == "'":
+            # either a char literal or a lifetime / label
+            match = CHAR_LITERAL.match(code, i)
+            if match:
+                tokens.append((i, match.end()))
+                i = match.end()
+            else:
+                match = IDENT_OR_NUMBER.match(code, i + 1)
+                end = match.end() if match else i + 1
+                tokens.append((i, end))
+                i = end
+        elif c.isalnum() or c == "_":
+            match = IDENT_OR_NUMBER.match(code, i)
+            tokens.append((i, match.end()))
+            i = match.end()
+        else:
+            for operator in RUST_OPERATORS:
+                if code.startswith(operator, i):
+                    tokens.append((i, i + len(operator)))
+                    i += len(operator)
+                    break
+            else:
+                tokens.append((i, i + 1))
+                i += 1
+    return tokens
+
+
+def tokenize_rust(code: str) -> List[str]:
+    """
+    Split Rust code into tokens, dropping whitespace and comments (including doc comments)
+    @param: code: Rust source code
+    @return: List of tokens, string and char literals are kept as a single token
+    """
+    return [code[start:end] for start, end in token_spans(code)]
+
+
+def normalize_rust_code(code: str) -> str:
+    """
+    Canonical form of the code, two programs that only differ in whitespace or comments normalize to the same string
+    """
+    return " ".join(tokenize_rust(code))
+
+
+_toolchain_versions = {}
+
+
+def toolchain_version(crate_path: str) -> str:
+    """
+    Verbose rustc version used in the crate directory (respects rust-toolchain files)
+    """
+    if crate_path not in _toolchain_versions:
+        try:
+            result = subprocess.run(["rustc", "-vV"], cwd=crate_path, capture_output=True, text=True)
+            _toolchain_versions[crate_path] = result.stdout.strip()
+        except OSError:
+            _toolchain_versions[crate_path] = ""
+    return _toolchain_versions[crate_path]
+
+
+class FitnessCache:
+    def __init__(self, path: str):
+        """
+        Persistent map from normalized generated code to the report of RustCompilerErrorParser.generate_report
+        @param: path: Path of the SQLite database file
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # the islands of a run share the file from separate processes: readers don't block the
+        # writer (WAL) and a writer waits for the lock instead of failing with "database is locked"
+        self._connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS reports (key TEXT PRIMARY KEY, report TEXT NOT NULL)"
+        )
+        self._connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(code_string: str, *context: str) -> str:
+        """
+        Content address of a candidate
+        @param: code_string: Generated code, normalized before hashing
+        @param: context: Everything else the result depends on, e.g. the test file and the toolchain version
+        @return: Hex digest
+        """
+        digest = hashlib.sha256(normalize_rust_code(code_string).encode())
+        for part in context:
+            digest.update(b"\0")
+            digest.update(hashlib.sha256(part.encode()).digest())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT report FROM reports WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, report: dict) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO reports (key, report) VALUES (?, ?)",
+                (key, json.dumps(report)),
+            )
+            self._connection.commit()
+
+    def reports(self):
+        """
+        Every cached (key, report), e.g. to score them again with another scoring table
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT key, report FROM reports").fetchall()
+        for key, report in rows:
+            yield key, json.loads(report)
+
+    def generation_stats(self) -> dict:
+        """
+        Hits and misses since the last call, the counters are reset afterwards
+        @return: Dictionary with hits, misses and hit_rate
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+            self.hits = 0
+            self.misses = 0
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -1,48 +1,226 @@
 from data_types import *
 from typing import List, Union, Tuple
 from llm_api import *
+import llm_api
 import random
 import numpy as np
 import json
 import re
 import argparse
-from error_message_parser import RustCompilerErrorParser
+from evaluator import FitnessEvaluator, EvaluationTask
+from error_message_parser import EvaluationLimits, pass_vector
+from fitness_cache import FitnessCache
+import build_cache
+import selection
 from compiler_error import CompilerError
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import hashlib
+import itertools
+import math
 import shutil
+from checkpoint import save_checkpoint, load_checkpoint, restore_rng_state
+from accounting import usage_ledger, phase, current_generation
+from tracing import tracer
+from prompt_index import PromptIndex
+from surrogate import SurrogateModel, spearman
+from scoring import ScoringModel
+import racing
+import repair
+import patch
+import prompt_layout
+from code_extraction import extract_code
 
 class Solution:
     def __init__(
         self,
-        rust_source_code = "",
         prompt: str = "",
         code_string: str = "",
         source_code: str = "",
         fitness: float = float("inf"),
         run_fitness: bool = False,
-        err_parser: RustCompilerErrorParser = None,
+        evaluator: FitnessEvaluator = None,
+        tasks: List[EvaluationTask] = None,
+        generation_mode: GenerationMode = GenerationMode.FULL,
     ):
         self.prompt = prompt
         self.code_string = code_string
         self.source_code = source_code
         self.fitness = fitness
-        self.err_parser = err_parser
+        self.evaluator = evaluator
         self.error_report = None
-        self.rust_source_code = rust_source_code
+        # multi-crate mode: the prompt is scored on every task, code_string and
+        # source_code then belong to the first one
+        self.tasks = tasks
+        self.task_results = {}
+        # whole files or patches against the skeleton, only for the async generation
+        self.generation_mode = generation_mode
+        # prompt of the near-duplicate the fitness was taken over from, see inherit
+        self.inherited_from = None
+        # fitness of every code sample of the prompt, fitness is then their mean
+        # with a confidence interval of +- fitness_ci (see race_population)
+        self.samples = []
+        self.fitness_ci = float("inf")
+        # fix rounds the code of the prompt went through, see repair_population
+        self.repairs = 0
         if run_fitness is True:
             self.eval_fitness()
 
+    def evaluators(self) -> List[FitnessEvaluator]:
+        if self.tasks is None:
+            return [self.evaluator]
+        return [task.evaluator for task in self.tasks]
+
     # calculate the fitness
     def eval_fitness(self) -> float:
+        if self.tasks is not None:
+            results = {}
+            for task in self.tasks:
+                code_string = extract_code(complete(self.code_prompt(task.source_code)))
+                report = None if code_string is None else task.evaluator.evaluate(code_string)
+                results[task.code] = task_result(code_string, report)
+            return self.set_task_results(results)
+
         # generate the code from llm
         self.generate_code()
+        if self.code_string is None:
+            # the LLM call failed, the solution keeps the worst fitness
+            self.fitness = float("inf")
+            return self.fitness
+
+        # write the code to a workspace of its own and run the code there,
+        # collect the errors from parser
+        error_report = self.evaluator.evaluate(self.code_string)
+        return self.set_error_report(error_report)
+
+    # same as eval_fitness, the LLM call goes through the async client and the
+    # build runs on the executor, so a whole population can be evaluated at once
+    async def eval_fitness_async(
+        self, llm_client: AsyncLLMClient, executor: ThreadPoolExecutor, abort_above: float = None
+    ) -> float:
+        if self.tasks is not None:
+            # the mean can only stay below abort_above while every task stays below len(tasks) * abort_above
+            task_abort_above = None if abort_above is None else abort_above * len(self.tasks)
+            results = await asyncio.gather(
+                *(self.eval_task_async(task, llm_client, executor, task_abort_above) for task in self.tasks)
+            )
+            return self.set_task_results(
+                {task.code: result for task, result in zip(self.tasks, results)}
+            )
+
+        await self.generate_code_async(llm_client)
+        if self.code_string is None:
+            self.fitness = float("inf")
+            return self.fitness
+
+        loop = asyncio.get_running_loop()
+        error_report = await loop.run_in_executor(
+            executor, functools.partial(self.evaluator.evaluate, self.code_string, abort_above)
+        )
+        return self.set_error_report(error_report)
+
+    async def eval_task_async(
+        self, task: EvaluationTask, llm_client: AsyncLLMClient, executor: ThreadPoolExecutor, abort_above: float = None
+    ) -> dict:
+        code_string = await self.request_code(task.source_code, llm_client)
+        if code_string is None:
+            return task_result(None, None)
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(
+            executor, functools.partial(task.evaluator.evaluate, code_string, abort_above)
+        )
+        return task_result(code_string, report)
+
+    def set_task_results(self, results: dict) -> float:
+        # per-crate breakdown is kept, fitness and error report are the aggregate
+        self.task_results = results
+        self.code_string = results[self.tasks[0].code]["code_string"]
+        self.error_report = aggregate_reports(results)
+        self.fitness = self.error_report["total_score"]
+        print("Score from err parser: ", {code: result["fitness"] for code, result in results.items()})
+        return self.fitness
+
+    def to_dict(self) -> dict:
+        # everything of the solution that is not shared with the rest of the population
+        return {
+            "prompt": self.prompt,
+            "code_string": self.code_string,
+            "code_hash": hashlib.sha256(self.code_string.encode()).hexdigest() if self.code_string else None,
+            "fitness": self.fitness,
+            "error_report": self.error_report,
+            "task_results": self.task_results,
+            "inherited_from": self.inherited_from,
+            "samples": self.samples,
+            "fitness_ci": self.fitness_ci,
+            "repairs": self.repairs,
+        }
+
+    @classmethod
+    def from_dict(
+        cls,
+        data: dict,
+        source_code: str,
+        evaluator: FitnessEvaluator,
+        tasks: List[EvaluationTask] = None,
+        generation_mode: GenerationMode = GenerationMode.FULL,
+    ) -> "Solution":
+        solution = cls(
+            prompt=data["prompt"],
+            code_string=data["code_string"],
+            source_code=source_code,
+            fitness=data["fitness"],
+            run_fitness=False,
+            evaluator=evaluator,
+            tasks=tasks,
+            generation_mode=generation_mode,
+        )
+        solution.error_report = data["error_report"]
+        solution.task_results = data.get("task_results", {})
+        solution.inherited_from = data.get("inherited_from")
+        solution.samples = data.get("samples", [])
+        solution.fitness_ci = data.get("fitness_ci", float("inf"))
+        solution.repairs = data.get("repairs", 0)
+        return solution
+
+    def inherit(self, original: "Solution") -> float:
+        # a near-duplicate prompt is not evaluated, it gets the result of the similar one
+        self.code_string = original.code_string
+        self.error_report = original.error_report
+        self.task_results = original.task_results
+        self.fitness = original.fitness
+        self.samples = list(original.samples)
+        self.fitness_ci = original.fitness_ci
+        self.repairs = original.repairs
+        self.inherited_from = original.prompt
+        return self.fitness
 
-        # write the code to the linked_list_src.rs file
-        # with open(f"../rust_examples/src/{self.rust_code}/{self.rust_code}.rs", "w") as file:
-        with open(self.rust_source_code, "w") as file:
-            file.write(self.code_string)
+    def sample_count(self) -> int:
+        # a solution evaluated once without racing has its fitness as the only sample
+        return len(self.samples) or 1
 
-        # run the code, collect the errors from parser
-        error_report = self.err_parser.generate_report()
+    def add_sample(self, sample: "Solution") -> float:
+        """
+        Add the result of another code sample of the same prompt, the fitness becomes the mean.
+        The code and report of the best sample are kept.
+        """
+        if not self.samples:
+            self.samples = [self.fitness]
+        best_sample = min(self.samples)
+        self.samples.append(sample.fitness)
+        if sample.fitness < best_sample:
+            self.code_string = sample.code_string
+            self.error_report = sample.error_report
+            self.task_results = sample.task_results
+        self.fitness, self.fitness_ci = racing.mean_confidence_interval(self.samples)
+        return self.fitness
+
+    def reset_samples(self) -> None:
+        # the fitness is the one of the current code alone again, e.g. after a repair
+        self.samples = []
+        self.fitness_ci = float("inf")
+
+    def set_error_report(self, error_report: dict) -> float:
         score = error_report["total_score"]
         self.error_report = error_report
         print("Score from err parser: ", error_report)
@@ -61,26 +239,87 @@ class Solution:
         self.fitness = score
         return self.fitness
 
+    # chat messages of the code generation request, the skeleton in the prefix every individual shares
+    def code_prompt(self, source_code: str = None) -> list:
+        if source_code is None:
+            source_code = self.source_code
+        return prompt_layout.code_messages(self.prompt, source_code)
+
     # call prompt to get code from llm
     def generate_code(self) -> str:
         print("Calling OpenAI API in Solution")
-        code_prompt = f"""
-            {self.prompt} \n
-            Code: \n
-            {self.source_code} \n
-            Provide the code only, without any explanation or additional text.
-        """
-        llm_output = call_openai_api(code_prompt)
+        llm_output = complete(self.code_prompt())
         print("OpenAI API call finished in Solution")
-        self.code_string = llm_output[7:-3]
+        self.code_string = extract_code(llm_output)
         return llm_output
 
+    async def generate_code_async(self, llm_client: AsyncLLMClient) -> str:
+        self.code_string = await self.request_code(self.source_code, llm_client)
+        return self.code_string
+
+    async def request_code(self, source_code: str, llm_client: AsyncLLMClient) -> str:
+        # in patch mode only the changed items are requested and applied to the skeleton,
+        # a reply that does not apply is followed by a request for the whole file
+        if self.generation_mode == GenerationMode.PATCH:
+            with phase("patch", current_generation.get()):
+                llm_output = await llm_client.complete(patch.patch_prompt(self.prompt, source_code))
+            try:
+                return patch.apply_patch(source_code, llm_output)
+            except patch.PatchError as e:
+                print(f"Patch not applied ({e}), generating the whole file")
+            with phase("patch fallback", current_generation.get()):
+                return await llm_client.complete_code(self.code_prompt(source_code))
+        return await llm_client.complete_code(self.code_prompt(source_code))
+
     # TODO: Implement the fitness calculation logic
     # fitness calc logic
     def calc_fitness(self, output: str, error: str) -> float:
         return float("inf")
 
 
+def task_result(code_string: str, report: dict) -> dict:
+    fitness = float("inf") if report is None else report["total_score"]
+    return {"code_string": code_string, "error_report": report, "fitness": fitness}
+
+
+# combine the reports of the tasks of a multi-crate solution, the score is the mean
+def aggregate_reports(results: dict) -> dict:
+    report = {
+        "total_errors": 0,
+        "errors_by_type": {},
+        "total_score": float(np.mean([result["fitness"] for result in results.values()])),
+        "passed": 0,
+        "failed": 0,
+        "unfinished": 0,
+        "tasks": {code: result["error_report"] for code, result in results.items()},
+    }
+    tests = {}
+    for code, result in results.items():
+        task_report = result["error_report"]
+        if task_report is None:
+            continue
+        for name, test in task_report.get("tests", {}).items():
+            tests[f"{code}/{name}"] = test
+        report["total_errors"] += task_report["total_errors"]
+        report["passed"] += task_report["passed"]
+        report["failed"] += task_report["failed"]
+        report["unfinished"] += task_report.get("unfinished", 0)
+        for error_type, count in task_report["errors_by_type"].items():
+            report["errors_by_type"][error_type] = report["errors_by_type"].get(error_type, 0) + count
+    report["tests"] = tests
+    report["pass_vector"] = pass_vector(tests)
+    return report
+
+
+# reports of the single builds behind a solution's report
+def build_reports(report: dict) -> List[dict]:
+    if report is None:
+        return []
+    if "tasks" in report:
+        return [task_report for task_report in report["tasks"].values() if task_report is not None]
+    return [report]
+
+
 def GA(
     initial_population_size: int = 50,
     mating_pool_size: int = 10,
@@ -93,127 +332,774 @@ def GA(
     generation_limit: int = 20,
     s_in_ranking_based_selection: float = 1.5,
     probability_based_sample_method_type: ProbabilityBasedSampleMethodType = ProbabilityBasedSampleMethodType.ROULETTE_WHEEL,
+    max_parallel_builds: int = None,
+    fitness_cache_path: str = None,
+    use_fitness_cache: bool = True,
+    llm_cache_path: str = None,
+    llm_cache_mode: CacheMode = CacheMode.READ_THROUGH,
+    seed: int = None,
+    llm_concurrency: int = 8,
+    requests_per_minute: int = None,
+    tokens_per_minute: int = None,
+    llm_timeout: float = 120.0,
+    stream_code: bool = True,
+    staged_evaluation: bool = True,
+    use_warm_target_dir: bool = True,
+    early_abort: bool = True,
+    max_compile_errors: int = None,
+    compile_timeout: float = 600,
+    test_timeout: float = 30,
+    test_memory_limit_mb: int = 2048,
+    checkpoint_dir: str = None,
+    prompt_log: str = None,
+    resume: str = None,
+    migration = None,
+    input_codes: List[str] = None,
+    crossover_chunk_size: int = 6,
+    max_offspring: int = None,
+    usage_report: str = None,
+    trace_path: str = None,
+    duplicate_threshold: float = 0.8,
+    duplicate_policy: DuplicatePolicy = DuplicatePolicy.INHERIT,
+    surrogate_fraction: float = None,
+    surrogate_warmup: int = 20,
+    max_samples: int = 1,
+    scoring_table: str = None,
+    max_repair_rounds: int = 0,
+    repair_candidates: int = 3,
+    generation_mode: GenerationMode = GenerationMode.FULL,
+    model: str = None,
+    max_prompt_tokens: int = None,
 ) -> Solution:
 
+    # parameters that decide the course of the run, stored in every checkpoint
+    config = {
+        "initial_population_size": initial_population_size,
+        "mating_pool_size": mating_pool_size,
+        "input_code": input_code,
+        "selection_type": selection_type,
+        "selection_type_prob_type": selection_type_prob_type,
+        "tournament_selection_size_k": tournament_selection_size_k,
+        "mutation_rate": mutation_rate,
+        "new_population_selection_type": new_population_selection_type,
+        "generation_limit": generation_limit,
+        "s_in_ranking_based_selection": s_in_ranking_based_selection,
+        "probability_based_sample_method_type": probability_based_sample_method_type,
+        "seed": seed,
+        "input_codes": input_codes,
+        "crossover_chunk_size": crossover_chunk_size,
+        "max_offspring": max_offspring,
+        "duplicate_threshold": duplicate_threshold,
+        "duplicate_policy": duplicate_policy,
+        "surrogate_fraction": surrogate_fraction,
+        "surrogate_warmup": surrogate_warmup,
+        "max_samples": max_samples,
+        "scoring_table": scoring_table,
+        "max_repair_rounds": max_repair_rounds,
+        "repair_candidates": repair_candidates,
+        "generation_mode": generation_mode,
+        "model": model,
+        "max_prompt_tokens": max_prompt_tokens,
+    }
+
+    # multi-crate mode: every prompt is scored on all of these examples
+    codes = input_codes or [input_code]
+    input_code = codes[0]
+    run_name = "+".join(codes)
+
     current_file_path = os.path.dirname(__file__)
     project_folder_path = os.path.dirname(current_file_path)
+    if checkpoint_dir is None and resume is not None:
+        # a resumed run writes its checkpoints next to the one it continues
+        checkpoint_dir = os.path.dirname(os.path.abspath(resume))
+    elif checkpoint_dir is None:
+        checkpoint_dir = os.path.join(current_file_path, "checkpoints")
+    # the best prompt of every generation is appended to this file
+    if prompt_log is None:
+        prompt_log = os.path.join(current_file_path, "prompts.txt")
 
     rust_code_folder_path = os.path.join(current_file_path, "../rust_examples")
 
-    # create instance of Rust error parser
-    err_parser = RustCompilerErrorParser(os.path.abspath(rust_code_folder_path), input_code)
-    rust_source_code = rust_code_folder_path + f"/{input_code}/src/{input_code}.rs"
-    # read from the initial prompts json file
-    initial_prompts = []
-    with open(f"{project_folder_path}/initial_prompts/init_prompts.json", "r") as file:
-        initial_prompts = json.load(file)
-        initial_prompts = initial_prompts[input_code]
-
-    source_code = ""
-    with open(f"{project_folder_path}/rust_examples/{input_code}/src/{input_code}_src.rs", "r") as file:
-        source_code = file.read()
-
-    # create initial population
-    population = []
-    for prompt in initial_prompts:
-        solution = Solution(
-            rust_source_code=rust_source_code,
-            prompt=prompt,
-            code_string="",
-            source_code=source_code,
-            fitness=float("inf"),
-            run_fitness=False,
-            err_parser=err_parser,
-        )
-        population.append(solution)
-    print("Initial Population Created")
-
-    run_api_threads(population)
-    print("Initial population Fitness Calculated")
+    # spans of the phases and of every candidate, written to trace_path at the end
+    if trace_path is not None:
+        tracer.enable()
+
+    # with a fixed seed and a replayed LLM cache the whole run is reproducible offline
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    if llm_cache_path is not None:
+        configure_response_cache(llm_cache_path, llm_cache_mode)
+    configure_model(model, max_prompt_tokens)
+
+    # every code generation of a population goes through this client
+    llm_client = AsyncLLMClient(
+        max_concurrency=llm_concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        timeout=llm_timeout,
+        stream_code=stream_code,
+    )
 
-    # derive best current solution
-    best_solution = min(population, key=eval_fitness)
-    print(f"Initial Best Solution: {best_solution.fitness}\n")
-    write_prompt_to_file(best_solution.prompt)
+    # reports of already evaluated code, shared by all runs
+    fitness_cache = None
+    if use_fitness_cache:
+        if fitness_cache_path is None:
+            fitness_cache_path = f"{project_folder_path}/.cache/fitness.sqlite"
+        fitness_cache = FitnessCache(fitness_cache_path)
+
+    # dependencies prebuilt by `python ga.py warm`, so only the generated file is compiled
+    warm_target_dir = None
+    if use_warm_target_dir:
+        warm_target_dir = build_cache.shared_target_dir(os.path.abspath(rust_code_folder_path))
+        if not build_cache.is_warm(warm_target_dir):
+            print("No warm dependency cache, run `python ga.py warm` to build the dependencies once")
+            warm_target_dir = None
+
+    # the cores are split between the examples
+    if max_parallel_builds is None and len(codes) > 1:
+        max_parallel_builds = max(1, (os.cpu_count() or 1) // len(codes))
+
+    # scores of the diagnostics, scoring.json unless another table is given
+    scoring = ScoringModel.load(scoring_table)
+
+    # create the evaluators, every candidate is built in its own copy of the crate
+    evaluators = {}
+    for code in codes:
+        evaluators[code] = FitnessEvaluator(
+            os.path.abspath(rust_code_folder_path),
+            code,
+            max_parallel_builds,
+            fitness_cache=fitness_cache,
+            staged=staged_evaluation,
+            warm_target_dir=warm_target_dir,
+            max_errors=max_compile_errors,
+            limits=EvaluationLimits(
+                compile_timeout=compile_timeout,
+                test_timeout=test_timeout,
+                memory_limit=test_memory_limit_mb * 1024 ** 2 if test_memory_limit_mb else None,
+            ),
+            scoring=scoring,
+        )
+    evaluator = evaluators[input_code]
 
-    for generation_num in range(generation_limit):
+    # read from the initial prompts json file, the prompts of all examples in multi-crate mode
+    initial_prompts = []
+    with open(f"{project_folder_path}/initial_prompts/init_prompts.json", "r") as file:
+        all_initial_prompts = json.load(file)
+        for code in codes:
+            initial_prompts += [prompt for prompt in all_initial_prompts[code] if prompt not in initial_prompts]
+
+    source_codes = {}
+    for code in codes:
+        with open(f"{project_folder_path}/rust_examples/{code}/src/{code}_src.rs", "r") as file:
+            source_codes[code] = file.read()
+    source_code = source_codes[input_code]
+
+    tasks = None
+    if len(codes) > 1:
+        tasks = [EvaluationTask(code, source_codes[code], evaluators[code]) for code in codes]
+
+    def checkpoint(generation: int) -> None:
+        path = os.path.join(checkpoint_dir, f"{run_name}_gen{generation:03}.json")
+        with tracer.span("checkpoint", generation=generation):
+            save_checkpoint(
+                path,
+                generation,
+                config,
+                [sol.to_dict() for sol in population],
+                best_solution.to_dict(),
+                None if prompt_index is None else [sol.to_dict() for sol in prompt_index.entries],
+                None if surrogate is None else surrogate.to_dict(),
+                None if llm_api.response_cache is None else llm_api.response_cache.sample_counters(),
+            )
+        print(f"Checkpoint written: {path}")
+
+    # totals of the compiler feedback repairs of the run
+    repair_stats = {"candidates": 0, "llm_calls": 0, "builds": 0, "improved": 0, "fixed": 0}
+
+    # evaluated prompts, offspring too similar to one of them are not evaluated again
+    prompt_index = None
+    duplicate_stats = {"offspring": 0, "duplicates": 0, "saved": 0}
+    if duplicate_threshold:
+        prompt_index = PromptIndex(duplicate_threshold)
+
+    # cheap model of the fitness, only the offspring it ranks best are evaluated
+    surrogate = None
+    surrogate_correlations = []
+    if surrogate_fraction is not None:
+        surrogate = SurrogateModel()
+
+    if resume is not None:
+        # continue after the last finished generation, every solution keeps its fitness
+        state = load_checkpoint(resume)
+        population = [
+            Solution.from_dict(data, source_code, evaluator, tasks, generation_mode) for data in state["population"]
+        ]
+        best_solution = Solution.from_dict(state["best_solution"], source_code, evaluator, tasks, generation_mode)
+        restore_rng_state(state["rng_state"])
+        if llm_api.response_cache is not None and state.get("llm_samples") is not None:
+            llm_api.response_cache.restore_sample_counters(state["llm_samples"])
+        start_generation = state["generation"]
+        # the index and the surrogate continue with everything they had seen, not only the population
+        # (a checkpoint of an older version has neither, both then start from the population)
+        if prompt_index is not None:
+            if state.get("prompt_index") is None:
+                index_prompts(prompt_index, population)
+            else:
+                index_prompts(
+                    prompt_index,
+                    [Solution.from_dict(data, source_code, evaluator, tasks, generation_mode)
+                     for data in state["prompt_index"]],
+                )
+        if surrogate is not None:
+            if state.get("surrogate") is None:
+                paid = [sol for sol in population if sol.inherited_from is None]
+                surrogate.update([sol.prompt for sol in paid], [sol.fitness for sol in paid])
+            else:
+                surrogate = SurrogateModel.from_dict(state["surrogate"])
+        print(f"Resumed from {resume} after generation {start_generation}")
+        print(f"Best Solution: {best_solution.fitness}\n")
+    else:
+        # create initial population
+        population = []
+        for prompt in initial_prompts:
+            solution = Solution(
+                prompt=prompt,
+                code_string="",
+                source_code=source_code,
+                fitness=float("inf"),
+                run_fitness=False,
+                evaluator=evaluator,
+                tasks=tasks,
+                generation_mode=generation_mode,
+            )
+            population.append(solution)
+        print("Initial Population Created")
+
+        with phase("generate", 0), tracer.span("evaluate", generation=0, size=len(population)):
+            evaluate_population(population, llm_client)
+            if max_samples > 1:
+                race_population(population, llm_client, max_samples)
+        if generation_mode == GenerationMode.PATCH:
+            print_patch_savings(population, 0)
+        if max_repair_rounds:
+            with phase("repair", 0), tracer.span("repair", generation=0):
+                add_repair_stats(repair_stats, repair_population(population, llm_client, max_repair_rounds, repair_candidates))
+        print("Initial population Fitness Calculated")
+        print_cache_stats(evaluators.values())
+        print_stage_summary(population)
+        usage_ledger.print_summary(0)
+
+        # derive best current solution
+        best_solution = min(population, key=eval_fitness)
+        print(f"Initial Best Solution: {format_fitness(best_solution)}\n")
+        write_prompt_to_file(best_solution.prompt, prompt_log)
+        start_generation = 0
+        if prompt_index is not None:
+            index_prompts(prompt_index, population)
+        if surrogate is not None:
+            paid = [sol for sol in population if sol.inherited_from is None]
+            surrogate.update([sol.prompt for sol in paid], [sol.fitness for sol in paid])
+        checkpoint(start_generation)
+
+    for generation_num in range(start_generation, generation_limit):
         print(f"Generation: {generation_num + 1}")
         mating_pool = []
 
         #  if tournament based selection
-        if selection_type == NextGenSelectionType.TRS:
-            mating_pool = tournament_selection(
-                population, tournament_selection_size_k, mating_pool_size
-            )
-        else:
-            # probability based selection: (RBS or FPS)
-            mating_pool = solver_probability_based(
-                population,
-                selection_type_prob_type,
-                s_in_ranking_based_selection,
-                probability_based_sample_method_type,
-                mating_pool_size,
-            )
+        with tracer.span("selection", generation=generation_num + 1):
+            if selection_type == NextGenSelectionType.TRS:
+                mating_pool = tournament_selection(
+                    population, tournament_selection_size_k, mating_pool_size
+                )
+            elif selection_type == NextGenSelectionType.LEXICASE:
+                mating_pool = lexicase_selection(population, mating_pool_size)
+            else:
+                # probability based selection: (RBS or FPS)
+                mating_pool = solver_probability_based(
+                    population,
+                    selection_type_prob_type,
+                    s_in_ranking_based_selection,
+                    probability_based_sample_method_type,
+                    mating_pool_size,
+                )
         print(f"Mating Pool Created {len(mating_pool)}")
 
         # crossover
-        new_population = crossover_and_mutation_on_population(mating_pool)
+        with phase("crossover", generation_num + 1), tracer.span("crossover", generation=generation_num + 1):
+            new_population = crossover_and_mutation_on_population(
+                mating_pool, llm_client, crossover_chunk_size, max_offspring
+            )
         print(f"Crossover Done, and length of new population {len(new_population)}")
 
-        run_api_threads(new_population)
+        duplicates = []
+        if prompt_index is not None:
+            offspring_count = len(new_population)
+            new_population, duplicates = split_duplicates(new_population, prompt_index)
+            duplicate_count = len(duplicates)
+            if duplicate_policy == DuplicatePolicy.REGENERATE:
+                # the near-duplicates are replaced by children of other pairs, twice at most
+                for _ in range(2):
+                    if not duplicates:
+                        break
+                    with phase("crossover", generation_num + 1):
+                        replacements = crossover_and_mutation_on_population(
+                            mating_pool, llm_client, crossover_chunk_size, len(duplicates)
+                        )
+                    offspring_count += len(replacements)
+                    replacements, duplicates = split_duplicates(replacements, prompt_index, new_population)
+                    duplicate_count += len(duplicates)
+                    new_population += replacements
+                duplicates = []
+            duplicate_stats["offspring"] += offspring_count
+            duplicate_stats["duplicates"] += duplicate_count
+            print(
+                f"Near-duplicates: {duplicate_count} of {offspring_count} offspring "
+                f"({duplicate_policy.value.lower()})"
+            )
+
+        predictions = None
+        if surrogate is not None and new_population:
+            with tracer.span("surrogate", generation=generation_num + 1):
+                predictions = surrogate.predict([sol.prompt for sol in new_population])
+            # until it has seen enough prompts the model only predicts, for the correlation
+            if surrogate.samples >= surrogate_warmup:
+                keep = max(1, math.ceil(len(new_population) * surrogate_fraction))
+                selected = np.sort(np.argsort(predictions, kind="stable")[:keep])
+                print(f"Surrogate: {keep} of {len(new_population)} offspring selected for evaluation")
+                dropped = np.delete(np.arange(len(new_population)), selected)
+                dropped = [new_population[i] for i in dropped]
+                new_population = [new_population[i] for i in selected]
+                predictions = predictions[selected]
+                # a near-duplicate of a dropped offspring would inherit a result that never exists
+                duplicates, orphans = rematch_duplicates(duplicates, dropped, prompt_index, new_population)
+                if orphans:
+                    print(f"Surrogate: {len(orphans)} near-duplicates of dropped offspring are evaluated")
+                    new_population += orphans
+                    predictions = np.concatenate([predictions, surrogate.predict([sol.prompt for sol in orphans])])
+
+        # offspring scoring worse than the worst current member can't be selected,
+        # their builds are stopped early
+        abort_above = worst_fitness(population) if early_abort else None
+        with phase("generate", generation_num + 1), tracer.span(
+            "evaluate", generation=generation_num + 1, size=len(new_population)
+        ):
+            evaluate_population(new_population, llm_client, abort_above)
+            if max_samples > 1:
+                race_population(new_population, llm_client, max_samples)
+        if generation_mode == GenerationMode.PATCH:
+            print_patch_savings(new_population, generation_num + 1)
+        # the fitness the prompts are credited with includes the repairs
+        if max_repair_rounds:
+            with phase("repair", generation_num + 1), tracer.span("repair", generation=generation_num + 1):
+                add_repair_stats(
+                    repair_stats, repair_population(new_population, llm_client, max_repair_rounds, repair_candidates)
+                )
+        if predictions is not None:
+            correlation = spearman(predictions, [sol.fitness for sol in new_population])
+            if correlation is not None:
+                surrogate_correlations.append(correlation)
+            surrogate.update([sol.prompt for sol in new_population], [sol.fitness for sol in new_population])
+            print(
+                f"Surrogate: Spearman correlation with the fitness "
+                f"{'-' if correlation is None else f'{correlation:.2f}'} on {len(new_population)} offspring, "
+                f"trained on {surrogate.samples} prompts"
+            )
+        if prompt_index is not None:
+            index_prompts(prompt_index, new_population)
+        for child, original in duplicates:
+            child.inherit(original)
+        new_population += [child for child, _ in duplicates]
+        if prompt_index is not None and duplicate_policy == DuplicatePolicy.INHERIT:
+            saved = len(duplicates) * len(tasks or [None])
+            duplicate_stats["saved"] += saved
+            print(
+                f"Near-duplicates: {len(duplicates)} inherited the result of an evaluated prompt, "
+                f"{saved} evaluations saved"
+            )
         print("New population Fitness Calculated")
+        print_cache_stats(evaluators.values())
+        print_stage_summary(new_population)
+        usage_ledger.print_summary(generation_num + 1)
 
         # # mutation
         # apply_mutation_to_population(new_population, mutation_rate)
         # print("Mutation Done")
 
         # selection from pools
-        population = general_selection_based_on_type(
-            population, new_population, new_population_selection_type
-        )
+        with tracer.span("replacement", generation=generation_num + 1):
+            population = general_selection_based_on_type(
+                population, new_population, new_population_selection_type
+            )
         print("Selection Done")
 
+        # island mode: exchange the best prompts with the other populations
+        if migration is not None:
+            with tracer.span("migration", generation=generation_num + 1):
+                population = migration(generation_num + 1, population)
+
         # update best solution
         best_solution = min(
             best_solution, min(population, key=eval_fitness), key=eval_fitness
         )
-        print(f"Best Solution: {best_solution.fitness}\n")
+        print(f"Best Solution: {format_fitness(best_solution)}\n")
+        checkpoint(generation_num + 1)
         if best_solution.fitness == 0:
             print("Error report of best solution", best_solution.error_report)
             break
         # print(f"Best Solution code: {best_solution.code_string}\n")
-        write_prompt_to_file(best_solution.prompt)
+        write_prompt_to_file(best_solution.prompt, prompt_log)
 
+    if prompt_index is not None:
+        print(
+            f"Near-duplicates of the run: {duplicate_stats['duplicates']} of {duplicate_stats['offspring']} offspring, "
+            f"{duplicate_stats['saved']} evaluations saved"
+        )
+    if max_repair_rounds:
+        print_repair_stats(repair_stats, "Repairs of the run")
+    if surrogate_correlations:
+        print(f"Surrogate: mean Spearman correlation {np.mean(surrogate_correlations):.2f} over {len(surrogate_correlations)} generations")
+    usage_ledger.print_summary()
+    if usage_report is not None:
+        usage_ledger.export(usage_report)
+        print(f"LLM usage written to {usage_report}")
+    if trace_path is not None:
+        tracer.write(trace_path, run_name)
+        print(f"Trace written to {trace_path}, open it in chrome://tracing or ui.perfetto.dev")
+
+    for code_evaluator in evaluators.values():
+        code_evaluator.cleanup()
+    if fitness_cache is not None:
+        fitness_cache.close()
+    if llm_cache_path is not None:
+        configure_response_cache(None)
     return best_solution
 
 
-# write/append the prompt to the prompts.txt file
-def write_prompt_to_file(prompt: str) -> None:
-    prompts_file = os.path.dirname(__file__) + "/prompts.txt"
+# write/append the prompt to the prompts file (GA/prompts.txt by default)
+def write_prompt_to_file(prompt: str, prompts_file: str) -> None:
     with open(prompts_file, "a") as file:
         file.write(prompt + "\n")
 
 
-def run_api_threads(population: List[Solution]) -> None:
-    threads = []
-    for i in range(len(population)):
-        threads.append(
-            threading.Thread(
-                target=population[i].eval_fitness,
+def print_cache_stats(evaluators) -> None:
+    # all evaluators share one cache, the first one reports for all of them
+    stats = next(iter(evaluators)).cache_stats()
+    if stats is None:
+        return
+    print(
+        f"Fitness cache: {stats['hits']} hits, {stats['misses']} misses "
+        f"(hit rate {stats['hit_rate']:.0%})"
+    )
+
+
+# how many candidates the cargo check gate decided, and the build time per stage
+def print_stage_summary(population: List[Solution]) -> None:
+    reports = [
+        report for sol in population for report in build_reports(sol.error_report)
+        if not report.get("cached")
+    ]
+    if not reports:
+        return
+    stage_totals = {}
+    for report in reports:
+        for stage, seconds in report.get("stage_times", {}).items():
+            stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+    decided_by_check = sum(1 for report in reports if report.get("stage") == "check")
+    test_times = [
+        report["stage_times"].get("build", 0.0) + report["stage_times"].get("test", 0.0)
+        for report in reports if report.get("stage") == "test"
+    ]
+    # the gated candidates would have paid roughly one more test build and run each
+    saved = decided_by_check * np.mean(test_times) if test_times else 0.0
+    times = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_totals.items())
+    print(
+        f"Build stages: {decided_by_check}/{len(reports)} decided by cargo check, "
+        f"{times}, ~{saved:.1f}s saved by the gate"
+    )
+
+
+# generate and evaluate the code of every solution concurrently, the LLM
+# calls are bounded by the client, the builds by the evaluator's workspaces
+def evaluate_population(
+    population: List[Solution], llm_client: AsyncLLMClient, abort_above: float = None
+) -> None:
+    asyncio.run(_evaluate_population(population, llm_client, abort_above))
+
+
+async def _evaluate_population(
+    population: List[Solution], llm_client: AsyncLLMClient, abort_above: float = None
+) -> None:
+    if not population:
+        return
+    build_workers = sum(evaluator.workspace_pool.size for evaluator in population[0].evaluators())
+    # named threads, their spans are drawn on the same tracks every generation
+    with ThreadPoolExecutor(max_workers=build_workers, thread_name_prefix="build") as executor:
+        results = await asyncio.gather(
+            *(sol.eval_fitness_async(llm_client, executor, abort_above) for sol in population),
+            return_exceptions=True,
+        )
+    for sol, result in zip(population, results):
+        if isinstance(result, Exception):
+            print(f"Evaluation failed: {result!r}")
+            sol.fitness = float("inf")
+
+def race_population(population: List[Solution], llm_client: AsyncLLMClient, max_samples: int) -> int:
+    """
+    Give more code samples to the prompts that are still in contention, after a first evaluation
+    with one sample each. Every round the better half of the contenders (successive halving) gets
+    one more sample, a prompt whose confidence interval lies above the one of the best prompt
+    leaves the race early.
+    @param: max_samples: Samples per prompt at most
+    @return: Number of additional samples evaluated
+    """
+    contenders = [sol for sol in population if sol.fitness != float("inf")]
+    extra = 0
+    for _ in range(max_samples - 1):
+        contenders = racing.halve(contenders, eval_fitness)
+        if not contenders:
+            break
+        best = contenders[0]
+        contenders = [
+            sol for sol in contenders
+            if sol.sample_count() < max_samples
+            and racing.still_in_race(sol.fitness, sol.fitness_ci, best.fitness, best.fitness_ci)
+        ]
+        # a single prompt left has nothing to race against
+        if len(contenders) < 2:
+            break
+        samples = [
+            Solution(
+                prompt=sol.prompt,
+                code_string="",
+                source_code=sol.source_code,
+                fitness=float("inf"),
+                run_fitness=False,
+                evaluator=sol.evaluator,
+                tasks=sol.tasks,
+                generation_mode=sol.generation_mode,
             )
+            for sol in contenders
+        ]
+        with tracer.span("racing", size=len(samples)):
+            evaluate_population(samples, llm_client)
+        for sol, sample in zip(contenders, samples):
+            sol.add_sample(sample)
+        extra += len(samples)
+    print(f"Racing: {extra} additional samples for {len(population)} prompts")
+    return extra
+
+
+def repair_population(
+    population: List[Solution], llm_client: AsyncLLMClient, max_rounds: int, candidates: int
+) -> dict:
+    """
+    Send the code of the most promising failing solutions back to the model together with the
+    diagnostics and failed tests of its evaluation, for up to max_rounds fix rounds each. A repair
+    is kept when it scores better, and the prompt is credited with the repaired fitness. In multi-crate
+    mode every task that does not pass is repaired on its own.
+    @param: max_rounds: Fix rounds per candidate at most, a candidate stops once it passes
+    @param: candidates: Number of solutions repaired, the best failing ones
+    @return: Statistics: candidates, llm_calls, builds, improved, fixed
+    """
+    chosen = sorted(
+        [sol for sol in population if sol.inherited_from is None and repair.is_repairable(sol.error_report)],
+        key=eval_fitness,
+    )[:candidates]
+    stats = {"candidates": len(chosen), "llm_calls": 0, "builds": 0, "improved": 0, "fixed": 0}
+    if chosen:
+        asyncio.run(_repair_population(chosen, llm_client, max_rounds, stats))
+    print_repair_stats(stats, "Repair")
+    return stats
+
+
+async def _repair_population(
+    population: List[Solution], llm_client: AsyncLLMClient, max_rounds: int, stats: dict
+) -> None:
+    build_workers = sum(evaluator.workspace_pool.size for evaluator in population[0].evaluators())
+    with ThreadPoolExecutor(max_workers=build_workers, thread_name_prefix="build") as executor:
+        results = await asyncio.gather(
+            *(_repair_solution(sol, llm_client, executor, max_rounds, stats) for sol in population),
+            return_exceptions=True,
         )
+    for sol, result in zip(population, results):
+        if isinstance(result, Exception):
+            print(f"Repair failed: {result!r}")
+
+
+async def _repair_solution(
+    sol: Solution, llm_client: AsyncLLMClient, executor: ThreadPoolExecutor, max_rounds: int, stats: dict
+) -> None:
+    # a repair has to beat the fitness the prompt is credited with, the mean of its samples after racing,
+    # and replaces them: the repaired code is a single result, without a confidence interval
+    fitness = sol.fitness
+    if sol.tasks is None:
+        result = await _repair_task(
+            sol, sol.source_code, sol.evaluator, dict(task_result(sol.code_string, sol.error_report), fitness=fitness),
+            llm_client, executor, max_rounds, stats,
+        )
+        if result["code_string"] != sol.code_string:
+            sol.code_string = result["code_string"]
+            sol.set_error_report(result["error_report"])
+            sol.reset_samples()
+    else:
+        results = await asyncio.gather(*(
+            _repair_task(
+                sol, task.source_code, task.evaluator, sol.task_results[task.code],
+                llm_client, executor, max_rounds, stats,
+            )
+            for task in sol.tasks
+        ))
+        repaired = {task.code: result for task, result in zip(sol.tasks, results)}
+        changed = any(result is not sol.task_results[task.code] for task, result in zip(sol.tasks, results))
+        if changed and aggregate_reports(repaired)["total_score"] < fitness:
+            sol.set_task_results(repaired)
+            sol.reset_samples()
+    if sol.fitness < fitness:
+        stats["improved"] += 1
+        if sol.fitness == 0:
+            stats["fixed"] += 1
+
+
+async def _repair_task(
+    sol: Solution, source_code: str, evaluator: FitnessEvaluator, result: dict,
+    llm_client: AsyncLLMClient, executor: ThreadPoolExecutor, max_rounds: int, stats: dict,
+) -> dict:
+    # fix rounds on the code of one task, every round starts from the best code so far
+    loop = asyncio.get_running_loop()
+    for _ in range(max_rounds):
+        if not repair.is_repairable(result["error_report"]):
+            break
+        stats["llm_calls"] += 1
+        sol.repairs += 1
+        code_string = None
+        if sol.generation_mode == GenerationMode.PATCH:
+            # the fix as a patch against the code being repaired
+            llm_output = await llm_client.complete(repair.repair_prompt(
+                sol.prompt, source_code, result["code_string"], result["error_report"], patch.PATCH_INSTRUCTIONS
+            ))
+            try:
+                code_string = patch.apply_patch(result["code_string"], llm_output)
+            except patch.PatchError as e:
+                print(f"Patch not applied ({e}), repairing the whole file")
+                stats["llm_calls"] += 1
+        if code_string is None:
+            code_string = await llm_client.complete_code(
+                repair.repair_prompt(sol.prompt, source_code, result["code_string"], result["error_report"])
+            )
+        if code_string is None:
+            break
+        # a repair scoring worse than the code it started from is not kept, its build can stop early
+        report = await loop.run_in_executor(
+            executor, functools.partial(evaluator.evaluate, code_string, result["fitness"])
+        )
+        stats["builds"] += 1
+        repaired = task_result(code_string, report)
+        if repaired["fitness"] < result["fitness"]:
+            result = repaired
+    return result
+
+
+# completion tokens and LLM latency of the patch requests of a generation, against whole files
+def print_patch_savings(population: List[Solution], generation: int) -> None:
+    patches = usage_ledger.select(generation, "patch")
+    fallbacks = usage_ledger.select(generation, "patch fallback")
+    if not patches:
+        return
+    code_strings = [
+        result["code_string"] for sol in population
+        for result in (sol.task_results.values() if sol.tasks is not None else [{"code_string": sol.code_string}])
+        if result["code_string"]
+    ]
+    result = patch.savings(patches + fallbacks, [patch.estimate_tokens(code) for code in code_strings])
+    latency = ""
+    if result["full_latency"] is not None:
+        latency = f", LLM time {result['latency']:.1f}s instead of ~{result['full_latency']:.1f}s"
+    print(
+        f"Patches: {len(patches) - len(fallbacks)} of {len(patches)} applied, {result['tokens']:.0f} completion tokens "
+        f"instead of ~{result['full_tokens']:.0f} for whole files{latency}"
+    )
+
+
+def add_repair_stats(totals: dict, stats: dict) -> None:
+    for name, value in stats.items():
+        totals[name] += value
+
+
+def print_repair_stats(stats: dict, title: str) -> None:
+    if not stats["candidates"]:
+        return
+    print(
+        f"{title}: {stats['improved']} of {stats['candidates']} candidates improved, {stats['fixed']} fixed, "
+        f"{stats['llm_calls']} LLM calls, {stats['builds']} builds"
+    )
+
+
+# add the evaluated solutions to the index of near-duplicates
+def index_prompts(prompt_index: PromptIndex, population: List[Solution]) -> None:
+    for sol in population:
+        if sol.fitness != float("inf"):
+            prompt_index.add(sol.prompt, sol)
+
+
+def split_duplicates(
+    offspring: List[Solution], prompt_index: PromptIndex, accepted: List[Solution] = ()
+) -> Tuple[List[Solution], List[Tuple[Solution, Solution]]]:
+    """
+    Separate the offspring that are near-duplicates of an evaluated prompt, of an accepted
+    offspring or of an earlier one in the list
+    @return: Offspring to evaluate, and (near-duplicate, similar solution) pairs
+    """
+    batch = prompt_index.child_index()
+    for sol in accepted:
+        batch.add(sol.prompt, sol)
+    unique, duplicates = [], []
+    for child in offspring:
+        original = prompt_index.match(child.prompt) or batch.match(child.prompt)
+        if original is None:
+            unique.append(child)
+            batch.add(child.prompt, child)
+        else:
+            duplicates.append((child, original))
+    return unique, duplicates
+
+
+def rematch_duplicates(
+    duplicates: List[Tuple[Solution, Solution]], dropped: List[Solution], prompt_index: PromptIndex,
+    evaluated: List[Solution],
+) -> Tuple[List[Tuple[Solution, Solution]], List[Solution]]:
+    """
+    Match the near-duplicates of offspring that are not evaluated again, against the evaluated
+    prompts and the offspring that are evaluated
+    @return: (near-duplicate, similar solution) pairs, and the near-duplicates without a match to evaluate
+    """
+    dropped = {id(sol) for sol in dropped}
+    orphans = [child for child, original in duplicates if id(original) in dropped]
+    if not orphans:
+        return duplicates, []
+    unique, matched = split_duplicates(orphans, prompt_index, evaluated)
+    return [pair for pair in duplicates if id(pair[1]) not in dropped] + matched, unique
+
+
+# fitness with its confidence interval when the solution has several samples
+def format_fitness(sol: Solution) -> str:
+    if sol.sample_count() < 2:
+        return str(sol.fitness)
+    return f"{sol.fitness:.3f} +- {sol.fitness_ci:.3f} ({sol.sample_count()} samples)"
 
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        thread.join()
-    return
 
 # custom fitness evaluation function
 def eval_fitness(x: Solution) -> float:
     return x.fitness
 
 
+# highest finite fitness of the population, None if no member has one
+def worst_fitness(population: List[Solution]):
+    finite = [sol.fitness for sol in population if sol.fitness != float("inf")]
+    return max(finite) if finite else None
+
+
 def solver_probability_based(
     population: List[Solution],
     type: Union[RBSType, FPSType],
@@ -243,7 +1129,7 @@ def general_selection_based_on_type(
 
     if type == SelectionType.GENERAL_REPLACEMENT:
         # replace all population with new population
-        return new_population
+        return fill_population(new_population, population)
 
     new_population.sort(key=eval_fitness, reverse=True)
     population.sort(key=eval_fitness, reverse=True)
@@ -252,11 +1138,22 @@ def general_selection_based_on_type(
     if type == SelectionType.ELITISM:
         # replace worst solutions with new population
         combined_population = population[-M_BEST:] + new_population[M_BEST:]
-        return combined_population
+        return fill_population(combined_population, population)
 
     # GRADUAL_REPLACEMENT
     combined_population = population[M_BEST:] + new_population[-M_BEST:]
-    return combined_population
+    return fill_population(combined_population, population)
+
+
+# with fewer offspring than places (surrogate screening, max_offspring, failed crossovers) the best
+# members of the old population that were not kept fill the places, so the population never shrinks
+def fill_population(combined_population: List[Solution], population: List[Solution]) -> List[Solution]:
+    missing = len(population) - len(combined_population)
+    if missing <= 0:
+        return combined_population
+    kept = set(map(id, combined_population))
+    rest = sorted((sol for sol in population if id(sol) not in kept), key=eval_fitness)
+    return combined_population + rest[:missing]
 
 
 def apply_mutation_to_population(
@@ -265,20 +1162,89 @@ def apply_mutation_to_population(
 
     # TODO: Implement the mutation logic
 
-    for sol in population:
-        original_prompt = sol.prompt
-        mutation_prompt = f"""
-            {original_prompt}
-            Mutation Rate: {mutation_rate}
-        """
-        mutated_prompt = mutate_with_openai(mutation_prompt)
-        sol.prompt = mutated_prompt
+    with phase("mutate", current_generation.get()):
+        for sol in population:
+            original_prompt = sol.prompt
+            mutation_prompt = f"""
+                {original_prompt}
+                Mutation Rate: {mutation_rate}
+            """
+            mutated_prompt = mutate_with_openai(mutation_prompt)
+            sol.prompt = mutated_prompt
 
 
 def crossover_and_mutation_on_population(
     mating_pool: List[Solution],
+    llm_client: AsyncLLMClient,
+    chunk_size: int = 6,
+    max_offspring: int = None,
+    max_retries: int = 2,
 ) -> List[Solution]:
-    
+    """
+    Cross over and mutate every pair of the mating pool, one child per pair.
+    The pairs are sent in chunks of chunk_size concurrent requests, so the latency
+    does not grow with the number of pairs, and a broken response only loses its chunk.
+    @param: mating_pool: Parents
+    @param: llm_client: Client the chunks are sent through
+    @param: chunk_size: Pairs per request
+    @param: max_offspring: Upper bound of the children, a random subset of the pairs is used above it
+    @param: max_retries: Times the pairs without a child are sent again
+    @return: Children, in the order of their pairs
+    """
+    print(f"Mating Pool: {len(mating_pool)}")
+
+    pairs = list(itertools.combinations(range(len(mating_pool)), 2))
+    if max_offspring is not None and len(pairs) > max_offspring:
+        pairs = sorted(random.sample(pairs, max_offspring))
+    print(f"Prompt pair num: {len(pairs)}")
+
+    children = asyncio.run(
+        _crossover_pairs(mating_pool, pairs, llm_client, chunk_size, max_retries)
+    )
+
+    new_population = []
+    for pair in pairs:
+        if pair not in children:
+            continue
+        new_population.append(
+            Solution(
+                prompt=children[pair],
+                code_string="",
+                source_code=mating_pool[0].source_code,
+                fitness=float("inf"),
+                run_fitness=False,
+                evaluator=mating_pool[0].evaluator,
+                tasks=mating_pool[0].tasks,
+                generation_mode=mating_pool[0].generation_mode,
+            )
+        )
+    return new_population
+
+
+async def _crossover_pairs(
+    mating_pool: List[Solution], pairs: list, llm_client: AsyncLLMClient, chunk_size: int, max_retries: int
+) -> dict:
+    children = {}
+    pending = pairs
+    for attempt in range(max_retries + 1):
+        chunks = [pending[i : i + chunk_size] for i in range(0, len(pending), chunk_size)]
+        responses = await asyncio.gather(
+            *(llm_client.call(crossover_chunk_prompt(mating_pool, chunk)) for chunk in chunks)
+        )
+        for chunk, response in zip(chunks, responses):
+            children.update(parse_crossover_response(response, chunk))
+        # only the pairs that got no child are sent again
+        pending = [pair for pair in pending if pair not in children]
+        if not pending:
+            break
+        if attempt < max_retries:
+            print(f"Crossover: {len(pending)} pairs without a child, retrying")
+    if pending:
+        print(f"Crossover: {len(pending)} pairs without a child, skipped")
+    return children
+
+
+def crossover_chunk_prompt(mating_pool: List[Solution], chunk: list) -> str:
     prompt = f"""
 Please follow the instruction step-by-step to generate a better prompt.
 
@@ -287,53 +1253,46 @@ Please follow the instruction step-by-step to generate a better prompt.
 Prompt pairs:
 
 """
-    
-    print(f"Mating Pool: {len(mating_pool)}")
-    
-    new_population = []
-    index = 1
-    for i in range(len(mating_pool) - 1):
-        for j in range(i + 1, len(mating_pool)):
-            prompt += f"""
+    for index, (i, j) in enumerate(chunk, 1):
+        prompt += f"""
 Pair {index}:
 Prompt 1:  {mating_pool[i].prompt}
 Prompt 2:  {mating_pool[j].prompt} \n
 """
-            index += 1
 
     prompt += f"""
 
-2. Mutate the prompts generated in Step 1 and generate a final prompts, each bracketed with <prompt> and </prompt>.
+2. Mutate the prompts generated in Step 1 and generate a final prompt for every pair.
 
-Return only the final outputs, no additional information or text needed.
+Return only a JSON object of the form {{"prompts": [{{"pair": 1, "prompt": "..."}}, ...]}} with one entry per pair, no additional information or text needed.
 """
-    
-    print(f"Prompt pair num: \n{index} \n\n\n")
-    
-    new_prompts = call_openai_api(prompt)
-    # parse the new prompts
-
-
-    new_prompts = parse_crossover_and_mutation_prompts(new_prompts)
-    for prompt in new_prompts:
-        new_population.append(
-            Solution(
-                prompt=prompt,
-                code_string="",
-                rust_source_code=mating_pool[0].rust_source_code, #we put it here as well. 
-                source_code=mating_pool[0].source_code,
-                fitness=float("inf"),
-                run_fitness=False,
-                err_parser=mating_pool[0].err_parser,
-            )
-        )
-
-    return new_population
-
-
-def parse_crossover_and_mutation_prompts(result: str) -> List[str]:
-    matches = re.findall(r'<prompt>(.*?)</prompt>', result)
-    return matches
+    return prompt
+
+
+def parse_crossover_response(result: str, chunk: list) -> dict:
+    """
+    Children of the pairs of one chunk, pairs without a valid entry in the response are missing
+    @return: Dictionary from pair to child prompt
+    """
+    if not result:
+        return {}
+    # the JSON object may still be wrapped in a markdown fence
+    start, end = result.find("{"), result.rfind("}")
+    try:
+        entries = json.loads(result[start : end + 1])["prompts"]
+    except (ValueError, KeyError, TypeError):
+        return {}
+    if not isinstance(entries, list):
+        return {}
+
+    children = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        index, prompt = entry.get("pair"), entry.get("prompt")
+        if isinstance(index, int) and 1 <= index <= len(chunk) and isinstance(prompt, str) and prompt.strip():
+            children[chunk[index - 1]] = prompt.strip()
+    return children
 
 
 def crossover_between_parents(
@@ -354,7 +1313,9 @@ Parent 2: {parent2.prompt}
         source_code=parent1.source_code,
         fitness=float("inf"),
         run_fitness=False,
-        err_parser=parent1.err_parser,
+        evaluator=parent1.evaluator,
+        tasks=parent1.tasks,
+        generation_mode=parent1.generation_mode,
     )
     return child
 
@@ -365,20 +1326,34 @@ def tournament_selection(
 ) -> List[Solution]:
     # tournament selection
     # select k random solutions from population
-    mating_pool = set()
-    while len(mating_pool) < mating_pool_size:
-        while True:
-            k_sample = random.sample(population, k)
-            best_one = min(k_sample, key=eval_fitness)
-            if best_one not in mating_pool:
-                mating_pool.add(best_one)
-                break
+    # (a list rather than a set keeps the order of the pool, and with it the
+    # crossover prompt, the same for the same random seed)
+    mating_pool = []
+    # the pool holds distinct solutions, at most the whole population: every tournament
+    # is among the solutions not selected yet, so it ends even when few are left
+    while len(mating_pool) < min(mating_pool_size, len(population)):
+        candidates = [sol for sol in population if sol not in mating_pool]
+        k_sample = random.sample(candidates, min(k, len(candidates)))
+        mating_pool.append(min(k_sample, key=eval_fitness))
+
+    return mating_pool
+
 
-    return list(mating_pool)
+# picks prompts that pass different tests, not only the ones with the best mean
+def lexicase_selection(population: List[Solution], mating_pool_size: int) -> List[Solution]:
+    # a solution without test results (it did not compile) passes no test
+    results = [(sol.error_report or {}).get("tests", {}) for sol in population]
+    names = sorted(set().union(*results))
+    passes = np.array(
+        [[tests.get(name, {}).get("outcome") == "ok" for name in names] for tests in results],
+        dtype=bool,
+    ).reshape(len(population), len(names))
+    indices = selection.lexicase(passes, selection.fitness_array(population), mating_pool_size)
+    return [population[i] for i in indices]
 
 
 def probability_based_selection(
-    ranked_population: List[Solution],
+    ranked_population: List[Tuple[float, Solution]],
     type: ProbabilityBasedSampleMethodType,
     mating_pool_size: int,
 ) -> List[Solution]:
@@ -387,115 +1362,181 @@ def probability_based_selection(
         return roulette_wheel_selection(ranked_population, mating_pool_size)
 
     # Stochastic Universal Sampling
-    return stochastic_universal_sampling(ranked_population)
+    return stochastic_universal_sampling(ranked_population, mating_pool_size)
 
 
+# the samplers pick distinct solutions, at most the whole population
 def roulette_wheel_selection(
     ranked_population: List[Tuple[float, Solution]], mating_pool_size: int
 ) -> List[Solution]:
-    mating_pool = set()
-    while len(mating_pool) < mating_pool_size:
-        # pick random number uniformly from 0 to 1
-        # print(mating_pool_size, len(ranked_population))
-        while True:
-            random_number = random.random()
-            index = 0
-            total_probability = ranked_population[0][0]
-            while total_probability < random_number:
-                index += 1
-                total_probability += ranked_population[index][0]
-
-            # print(total_probability)
-            # print(ranked_population )
-
-            if ranked_population[index][1] not in mating_pool:
-                mating_pool.add(ranked_population[index][1])
-                break
-
-    return list(mating_pool)
+    probabilities = np.array([probability for probability, _ in ranked_population])
+    indices = selection.roulette_wheel(probabilities, mating_pool_size)
+    return [ranked_population[i][1] for i in indices]
 
 
 def stochastic_universal_sampling(
-    ranked_population: List[Tuple[float, Solution]],
+    ranked_population: List[Tuple[float, Solution]], mating_pool_size: int
 ) -> List[Solution]:
-
-    pointer_distance = sum([sol.value() for _, sol in ranked_population]) / len(
-        ranked_population
-    )
-
-    start_point = random.uniform(0, pointer_distance)
-    pointers = [
-        start_point + i * pointer_distance for i in range(len(ranked_population) - 1)
-    ]
-
-    accum_probs = 0
-    curr_index = 0
-    mating_pool = []
-    for pointer in pointers:
-        while curr_index < len(ranked_population) - 1 and accum_probs < pointer:
-            accum_probs += ranked_population[curr_index][0]
-            curr_index += 1
-        mating_pool.append(ranked_population[curr_index][1])
-
-    return mating_pool
+    probabilities = np.array([probability for probability, _ in ranked_population])
+    indices = selection.stochastic_universal_sampling(probabilities, mating_pool_size)
+    return [ranked_population[i][1] for i in indices]
 
 
 # returns List[(probability, solution)]
 def ranking_based_selection(
-    population: List[Solution], type: RBSType, s: int = 1.5
+    population: List[Solution], type: RBSType, s: float = 1.5
 ) -> List[Tuple[float, Solution]]:
 
     # sort in ascending order of fitness
     population.sort(key=eval_fitness)
-    population_size = len(population)
+    fitness = selection.fitness_array(population)
 
     if type == RBSType.LINEAR_RANKING:
-        # calculate the rank sum
-        # TODO: implement linear ranking
-        return []
-
-    # EXPONENTIAL_RANKING
-    # TODO: implement EXPONENTIAL_RANKING ranking
-    return []
+        probabilities = selection.linear_ranking(fitness, s)
+    else:
+        # EXPONENTIAL_RANKING
+        probabilities = selection.exponential_ranking(fitness)
+    return list(zip(probabilities.tolist(), population))
 
 
 # returns List[(probability, solution)]
 def improved_fps(
     population: List[Solution], type: FPSType
 ) -> List[Tuple[float, Solution]]:
+    fitness = selection.fitness_array(population)
     if type == FPSType.WINDOWING:
-        # get b(t) for linear scaling
-        # TODO: implement windowing
-        return []
-
-    # SIGNAL_SCALING
-    # TODO: implement signal scaling, and debug
-    # find mean value of population using np
-    mean = np.mean([sol.fitness for sol in population])
-
-    # find standard deviation of population using np
-    std = np.std([sol.fitness for sol in population])
-    c = 2
-
-    # scaling using f(i) = max(f(i) - (mean - c * std), 0)
-    ranked_population = [
-        [max(sol.fitness - (mean - c * std), 0), sol] for sol in population
-    ]
-    total_fitness = sum([updated_fitness for updated_fitness, _ in ranked_population])
-    for i in range(len(ranked_population)):
-        ranked_population[i][0] /= total_fitness
-    return ranked_population
+        # the worst fitness of the population is the window
+        probabilities = selection.windowing(fitness)
+    else:
+        # SIGNAL_SCALING (sigma scaling), c = 2
+        probabilities = selection.sigma_scaling(fitness, 2)
+    return list(zip(probabilities.tolist(), population))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Genetic Algorithm with file input')
-    parser.add_argument('--file', type=str, help='Input file name', required=True)
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'warm'],
+                        help='run the GA (default), or warm: prebuild the dependencies of the examples once')
+    parser.add_argument('--file', type=str, nargs='+',
+                        help='Input file name (for warm: only these examples); several names or "all" score every prompt on all of them')
+    parser.add_argument('--builds', type=int, default=None, help='Number of candidates built in parallel (default: number of cpus)')
+    parser.add_argument('--fitness-cache', type=str, default=None, help='Path of the fitness cache (default: .cache/fitness.sqlite)')
+    parser.add_argument('--no-fitness-cache', action='store_true', help='Always compile, never reuse cached reports')
+    parser.add_argument('--llm-cache', type=str, default=None, help='Path of the LLM response cache (default: no cache)')
+    parser.add_argument('--llm-cache-mode', type=str, default=CacheMode.READ_THROUGH.value,
+                        choices=[mode.value for mode in CacheMode], help='RECORD, REPLAY (offline) or READ_THROUGH')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    parser.add_argument('--llm-concurrency', type=int, default=8, help='LLM requests in flight at the same time')
+    parser.add_argument('--rpm', type=int, default=None, help='LLM requests per minute (default: no limit)')
+    parser.add_argument('--tpm', type=int, default=None, help='LLM tokens per minute (default: no limit)')
+    parser.add_argument('--no-check-gate', action='store_true', help='Always run cargo test, without a cargo check first')
+    parser.add_argument('--no-warm-cache', action='store_true', help='Build the dependencies in every workspace')
+    parser.add_argument('--no-early-abort', action='store_true', help='Always finish the build of a candidate')
+    parser.add_argument('--no-stream', action='store_true', help='Wait for the whole LLM response instead of stopping at the end of the code block')
+    parser.add_argument('--max-compile-errors', type=int, default=None, help='Abort a build after this many compile errors')
+    parser.add_argument('--compile-timeout', type=float, default=600, help='Seconds a build of a candidate may take')
+    parser.add_argument('--test-timeout', type=float, default=30, help='Seconds the tests of a candidate may run')
+    parser.add_argument('--test-memory-limit', type=int, default=2048, help='Memory limit of the tests in MB (0: no limit)')
+    parser.add_argument('--checkpoint-dir', type=str, default=None, help='Directory of the per generation checkpoints (default: GA/checkpoints, with --resume the directory of the resumed checkpoint)')
+    parser.add_argument('--prompt-log', type=str, default=None, help='File the best prompt of every generation is appended to (default: GA/prompts.txt)')
+    parser.add_argument('--resume', type=str, default=None, help='Continue the run of this checkpoint file, with its configuration')
+    parser.add_argument('--islands', type=int, default=0, help='Evolve this many populations in parallel processes (island model)')
+    parser.add_argument('--migration-interval', type=int, default=2, help='Generations between migrations of the islands')
+    parser.add_argument('--migration-size', type=int, default=2, help='Top prompts an island sends per migration')
+    parser.add_argument('--crossover-chunk-size', type=int, default=6, help='Prompt pairs per crossover request')
+    parser.add_argument('--max-offspring', type=int, default=None, help='Children per generation at most (default: one per pair of the mating pool)')
+    parser.add_argument('--usage-report', type=str, default=None, help='Write the tokens, cost and latency of every LLM call to this .csv or .json file')
+    parser.add_argument('--trace', type=str, default=None, help='Write a Chrome/Perfetto trace of the phases and evaluations to this .json file')
+    parser.add_argument('--duplicate-threshold', type=float, default=0.8, help='Similarity from which an offspring prompt is a near-duplicate (0: off)')
+    parser.add_argument('--duplicate-policy', type=str, default=DuplicatePolicy.INHERIT.value,
+                        choices=[policy.value for policy in DuplicatePolicy], help='INHERIT the fitness or REGENERATE near-duplicates')
+    parser.add_argument('--surrogate-fraction', type=float, default=None, help='Evaluate only this fraction of the offspring, the best ranked by the surrogate model (default: all)')
+    parser.add_argument('--surrogate-warmup', type=int, default=20, help='Evaluated prompts the surrogate model needs before it screens offspring')
+    parser.add_argument('--max-samples', type=int, default=1, help='Code samples per prompt at most, given by successive halving to the prompts still in contention')
+    parser.add_argument('--scoring', type=str, default=None, help='Scoring table of the compiler diagnostics (default: scoring.json)')
+    parser.add_argument('--repair-rounds', type=int, default=0, help='Fix rounds with the compiler and test output for the best failing candidates of every generation (0: off)')
+    parser.add_argument('--repair-candidates', type=int, default=3, help='Candidates repaired per generation')
+    parser.add_argument('--generation-mode', type=str, default=GenerationMode.FULL.value,
+                        choices=[mode.value for mode in GenerationMode], help='FULL files or PATCH: only the changed items, applied to the skeleton')
+    parser.add_argument('--model', type=str, default=None, help='Model of the LLM calls (default: LLM_MODEL or gpt-4o-mini)')
+    parser.add_argument('--max-prompt-tokens', type=int, default=None, help='Prompt tokens per LLM call at most, the feedback and the prompt are cut to fit (default: no limit)')
+    parser.add_argument('--selection', type=str, default=NextGenSelectionType.TRS.value,
+                        choices=[selection_type.value for selection_type in NextGenSelectionType], help='Selection of the mating pool')
     args = parser.parse_args()
-    solution = GA(
-        generation_limit=20,
-        mating_pool_size=9,
-        input_code = args.file
+
+    if args.command == 'warm':
+        rust_examples_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../rust_examples"))
+        build_cache.warm_all(rust_examples_path, None if args.file in (None, ["all"]) else args.file)
+        raise SystemExit(0)
+    if args.resume is not None:
+        if args.islands:
+            parser.error("--resume continues a single population, it can't be combined with --islands")
+        config = load_checkpoint(args.resume)["config"]
+    elif args.file is None:
+        parser.error("--file is required to run the GA")
+    else:
+        codes = args.file
+        if codes == ["all"]:
+            rust_examples_path = os.path.join(os.path.dirname(__file__), "../rust_examples")
+            codes = sorted(
+                name for name in os.listdir(rust_examples_path)
+                if os.path.isfile(os.path.join(rust_examples_path, name, "Cargo.toml"))
+            )
+        config = dict(
+            generation_limit=20,
+            mating_pool_size=9,
+            input_code = codes[0],
+            input_codes = codes if len(codes) > 1 else None,
+            seed = args.seed,
+            selection_type = NextGenSelectionType(args.selection),
+            crossover_chunk_size = args.crossover_chunk_size,
+            max_offspring = args.max_offspring,
+            duplicate_threshold = args.duplicate_threshold,
+            duplicate_policy = DuplicatePolicy(args.duplicate_policy),
+            surrogate_fraction = args.surrogate_fraction,
+            surrogate_warmup = args.surrogate_warmup,
+            max_samples = args.max_samples,
+            scoring_table = args.scoring,
+            max_repair_rounds = args.repair_rounds,
+            repair_candidates = args.repair_candidates,
+            generation_mode = GenerationMode(args.generation_mode),
+            model = args.model,
+            max_prompt_tokens = args.max_prompt_tokens,
+        )
+    run_kwargs = dict(
+        max_parallel_builds = args.builds,
+        fitness_cache_path = args.fitness_cache,
+        use_fitness_cache = not args.no_fitness_cache,
+        llm_cache_path = args.llm_cache,
+        llm_cache_mode = CacheMode(args.llm_cache_mode),
+        llm_concurrency = args.llm_concurrency,
+        requests_per_minute = args.rpm,
+        tokens_per_minute = args.tpm,
+        stream_code = not args.no_stream,
+        staged_evaluation = not args.no_check_gate,
+        use_warm_target_dir = not args.no_warm_cache,
+        early_abort = not args.no_early_abort,
+        max_compile_errors = args.max_compile_errors,
+        compile_timeout = args.compile_timeout,
+        test_timeout = args.test_timeout,
+        test_memory_limit_mb = args.test_memory_limit,
+        checkpoint_dir = args.checkpoint_dir,
+        prompt_log = args.prompt_log,
+        resume = args.resume,
+        usage_report = args.usage_report,
+        trace_path = args.trace,
     )
+    if args.islands:
+        from island import run_islands
+        best = run_islands(
+            args.islands, args.migration_interval, args.migration_size, **config, **run_kwargs
+        )
+        print(f"Best Solution (island {best['island']}): {best['prompt']}\n")
+        print(f"Best Fitness: {best['fitness']}\n")
+        print(f"Best Code: {best['code_string']}\n")
+        raise SystemExit(0)
+
+    solution = GA(**config, **run_kwargs)
     print(f"Best Solution: {solution.prompt}\n")
     print(f"Best Fitness: {solution.fitness}\n")
     print(f"Best Code: {solution.code_string}\n")
@@ -0,0 +1,191 @@
+import multiprocessing
+import os
+import queue
+from typing import List
+from data_types import *
+from ga import GA, Solution, eval_fitness
+
+# seconds between the checks for island processes that died without a result
+RESULT_POLL_INTERVAL = 5
+
+# selection settings of the islands, island i uses ISLAND_VARIANTS[i % len(ISLAND_VARIANTS)]
+ISLAND_VARIANTS = [
+    dict(selection_type=NextGenSelectionType.TRS, tournament_selection_size_k=4,
+         new_population_selection_type=SelectionType.GRADUAL_REPLACEMENT),
+    dict(selection_type=NextGenSelectionType.RBS, selection_type_prob_type=RBSType.LINEAR_RANKING,
+         s_in_ranking_based_selection=1.5,
+         probability_based_sample_method_type=ProbabilityBasedSampleMethodType.STOCHASTIC_UNIVERSAL_SAMPLING,
+         new_population_selection_type=SelectionType.ELITISM),
+    dict(selection_type=NextGenSelectionType.TRS, tournament_selection_size_k=2,
+         new_population_selection_type=SelectionType.ELITISM),
+    dict(selection_type=NextGenSelectionType.FPS, selection_type_prob_type=FPSType.SIGNAL_SCALING,
+         probability_based_sample_method_type=ProbabilityBasedSampleMethodType.ROULETTE_WHEEL,
+         new_population_selection_type=SelectionType.GRADUAL_REPLACEMENT),
+    dict(selection_type=NextGenSelectionType.TRS, tournament_selection_size_k=6,
+         new_population_selection_type=SelectionType.ELITISM),
+    dict(selection_type=NextGenSelectionType.RBS, selection_type_prob_type=RBSType.EXPONENTIAL_RANKING,
+         probability_based_sample_method_type=ProbabilityBasedSampleMethodType.ROULETTE_WHEEL,
+         new_population_selection_type=SelectionType.GRADUAL_REPLACEMENT),
+    dict(selection_type=NextGenSelectionType.TRS, tournament_selection_size_k=3,
+         new_population_selection_type=SelectionType.GRADUAL_REPLACEMENT),
+    dict(selection_type=NextGenSelectionType.FPS, selection_type_prob_type=FPSType.WINDOWING,
+         probability_based_sample_method_type=ProbabilityBasedSampleMethodType.STOCHASTIC_UNIVERSAL_SAMPLING,
+         new_population_selection_type=SelectionType.ELITISM),
+    dict(selection_type=NextGenSelectionType.LEXICASE,
+         new_population_selection_type=SelectionType.GRADUAL_REPLACEMENT),
+]
+
+
+class Migration:
+    def __init__(self, inbox, outbox, interval: int, size: int):
+        """
+        Migration hook of one island for GA(migration=...), islands form a ring
+        @param: inbox: Queue the previous island sends its migrants to
+        @param: outbox: Queue of the next island
+        @param: interval: Migrate every interval generations
+        @param: size: Number of top prompts sent per migration
+        """
+        self.inbox = inbox
+        self.outbox = outbox
+        self.interval = interval
+        self.size = size
+        self.received = 0
+
+    def __call__(self, generation: int, population: List[Solution]) -> List[Solution]:
+        if generation % self.interval != 0 or not population:
+            return population
+
+        emigrants = sorted(population, key=eval_fitness)[: self.size]
+        self.outbox.put([sol.to_dict() for sol in emigrants])
+
+        # the islands don't wait for each other, everything that arrived so far is taken
+        immigrants = []
+        while True:
+            try:
+                immigrants.extend(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        known_prompts = {sol.prompt for sol in population}
+        immigrants = [data for data in immigrants if data["prompt"] not in known_prompts]
+        if not immigrants:
+            return population
+
+        # migrants keep their fitness, they are not evaluated again, and replace the worst members
+        source_code = population[0].source_code
+        evaluator = population[0].evaluator
+        tasks = population[0].tasks
+        generation_mode = population[0].generation_mode
+        immigrants = sorted(immigrants, key=lambda data: data["fitness"])[: len(population) // 2]
+        self.received += len(immigrants)
+        print(f"Migration: {len(immigrants)} prompts received")
+        survivors = sorted(population, key=eval_fitness)[: len(population) - len(immigrants)]
+        return survivors + [
+            Solution.from_dict(data, source_code, evaluator, tasks, generation_mode) for data in immigrants
+        ]
+
+
+def run_island(island_id: int, ga_kwargs: dict, inbox, outbox, results, interval: int, size: int) -> None:
+    # migrants for a neighbour that is gone would keep this process from exiting
+    outbox.cancel_join_thread()
+    migration = Migration(inbox, outbox, interval, size)
+    try:
+        best = GA(**ga_kwargs, migration=migration)
+        results.put((island_id, best.to_dict(), migration.received, None))
+    except Exception as e:
+        results.put((island_id, None, migration.received, repr(e)))
+
+
+def run_islands(
+    num_islands: int = 4,
+    migration_interval: int = 2,
+    migration_size: int = 2,
+    variants: List[dict] = None,
+    **ga_kwargs,
+) -> dict:
+    """
+    Evolve num_islands populations in separate processes, migrating the top prompts between them
+    @param: num_islands: Number of islands (processes)
+    @param: migration_interval: Generations between two migrations
+    @param: migration_size: Prompts each island sends per migration
+    @param: variants: GA settings per island, defaults to ISLAND_VARIANTS
+    @param: ga_kwargs: Settings of GA common to all islands
+    @return: Best solution over all islands as dictionary (see Solution.to_dict)
+    """
+    variants = variants or ISLAND_VARIANTS
+    # spawned rather than forked, the islands run their own event loops and threads
+    context = multiprocessing.get_context("spawn")
+    inboxes = [context.Queue() for _ in range(num_islands)]
+    results = context.Queue()
+
+    base_seed = ga_kwargs.pop("seed", None)
+    ga_kwargs["prompt_log"] = ga_kwargs.get("prompt_log") or os.path.join(os.path.dirname(__file__), "prompts.txt")
+    checkpoint_dir = ga_kwargs.pop("checkpoint_dir", None) or os.path.join(os.path.dirname(__file__), "checkpoints")
+    if ga_kwargs.get("max_parallel_builds") is None:
+        # the cores are shared by all islands
+        ga_kwargs["max_parallel_builds"] = max(1, (os.cpu_count() or 1) // num_islands)
+
+    processes = []
+    for island_id in range(num_islands):
+        settings = dict(ga_kwargs, **variants[island_id % len(variants)])
+        settings["seed"] = None if base_seed is None else base_seed + island_id
+        settings["checkpoint_dir"] = os.path.join(checkpoint_dir, f"island{island_id}")
+        # every island has its own ledger, tracer and prompt log
+        for name in ("usage_report", "trace_path", "prompt_log"):
+            if ga_kwargs.get(name):
+                root, extension = os.path.splitext(ga_kwargs[name])
+                settings[name] = f"{root}.island{island_id}{extension}"
+        process = context.Process(
+            target=run_island,
+            args=(
+                island_id,
+                settings,
+                inboxes[island_id],
+                inboxes[(island_id + 1) % num_islands],
+                results,
+                migration_interval,
+                migration_size,
+            ),
+        )
+        process.start()
+        processes.append(process)
+
+    island_results = {}
+    while len(island_results) < num_islands:
+        try:
+            island_id, best, received, error = results.get(timeout=RESULT_POLL_INTERVAL)
+            island_results[island_id] = (best, received, error)
+        except queue.Empty:
+            # an island killed from outside (OOM killer, signal) never sends its result, one
+            # that exited normally (code 0) has sent it and it is read in the next round
+            for island_id, process in enumerate(processes):
+                if island_id not in island_results and not process.is_alive() and process.exitcode != 0:
+                    island_results[island_id] = (None, 0, f"process died with exit code {process.exitcode}")
+
+    # migrants nobody picked up anymore, the senders can't exit before they are read
+    for inbox in inboxes:
+        while True:
+            try:
+                inbox.get_nowait()
+            except queue.Empty:
+                break
+    for process in processes:
+        process.join()
+
+    print("\nIsland summary:")
+    best_overall = None
+    for island_id in range(num_islands):
+        best, received, error = island_results[island_id]
+        variant = variants[island_id % len(variants)]
+        description = ", ".join(
+            f"{name}={value.value if isinstance(value, Enum) else value}" for name, value in variant.items()
+        )
+        if error is not None:
+            print(f"Island {island_id} ({description}): failed with {error}")
+            continue
+        print(
+            f"Island {island_id} ({description}): best fitness {best['fitness']}, "
+            f"{received} migrants received, best prompt: {best['prompt']!r}"
+        )
+        if best_overall is None or best["fitness"] < best_overall["fitness"]:
+            best_overall = dict(best, island=island_id)
+    return best_overall
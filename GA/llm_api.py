@@ -1,57 +1,229 @@
 import os
 import openai
 from dotenv import load_dotenv, dotenv_values
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import random
 import time
 import threading
+from data_types import CacheMode
+from llm_cache import LLMResponseCache
+from accounting import usage_ledger, current_phase
+from tracing import tracer
+from code_extraction import CodeExtractor, extract_code
+
+try:
+    # exact token counts, optional
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
 load_dotenv(env_path)
 
-# Get the API key from the .env file
-api_key = dotenv_values(env_path)["LLM_API_KEY"]
+# Get the API key from the .env file, it is not needed when replaying from the response cache
+api_key = dotenv_values(env_path).get("LLM_API_KEY")
 # Set the API key
 openai.api_key = api_key
+# OpenAI compatible endpoint, e.g. a local server (see benchmark.py), None for the OpenAI API
+base_url = dotenv_values(env_path).get("LLM_BASE_URL") or os.environ.get("LLM_BASE_URL")
 
-print("OpenAI API Key: ", api_key)
-client = OpenAI(
-    api_key=api_key,
-)
+# model of every call that does not name one, LLM_MODEL in .env or the environment overrides it
+default_model = dotenv_values(env_path).get("LLM_MODEL") or os.environ.get("LLM_MODEL") or "gpt-4o-mini"
+# prompt tokens a single call may send at most, None for no limit (see prompt_layout.assemble)
+max_prompt_tokens = None
 
+client = None
+response_cache = None
 
-def call_openai_api(prompt, model="gpt-4o-mini"):
-    # TODO: append the return structure of the response to prompt
-    prompt += f"\n"
 
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant for writing code.",
-                },
-                {"role": "user", "content": prompt},
-            ],
+def get_client():
+    # created on first use, so that replaying from the cache works without a key
+    global client
+    if client is None:
+        client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+        )
+    return client
+
+
+def configure_endpoint(url, key=None):
+    """
+    Send every request to another OpenAI compatible endpoint, clients created before are dropped
+    """
+    global base_url, api_key, client
+    base_url = url
+    if key is not None:
+        api_key = key
+    client = None
+
+
+def configure_model(model=None, prompt_budget=None):
+    """
+    Model of the calls that don't name one (None keeps the current one) and the prompt token budget per call
+    """
+    global default_model, max_prompt_tokens
+    if model is not None:
+        default_model = model
+    max_prompt_tokens = prompt_budget
+
+
+def configure_response_cache(path, mode=CacheMode.READ_THROUGH):
+    """
+    Route every chat completion through a LLMResponseCache, None turns the cache off
+    """
+    global response_cache
+    if response_cache is not None:
+        response_cache.close()
+    response_cache = LLMResponseCache(path, mode) if path else None
+    return response_cache
+
+
+_encodings = {}
+
+
+def _encoding(model):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # models tiktoken does not know, e.g. behind a compatible endpoint
+            _encodings[model] = tiktoken.get_encoding("o200k_base")
+    return _encodings[model]
+
+
+def encode(text, model=None):
+    """
+    Tokens of text under the tokenizer of model, None if tiktoken is not installed
+    """
+    if tiktoken is None:
+        return None
+    return _encoding(model or default_model).encode(text, disallowed_special=())
+
+
+def count_tokens(text, model=None):
+    # with tiktoken the exact count, otherwise about 4 characters per token
+    tokens = encode(text, model)
+    return len(text) // 4 + 1 if tokens is None else len(tokens)
+
+
+def truncate_tokens(text, tokens, model=None):
+    """
+    The head of text that fits into the given number of tokens
+    """
+    encoded = encode(text, model)
+    if encoded is None:
+        return text[: tokens * 4]
+    return _encoding(model or default_model).decode(encoded[:tokens])
+
+
+def message_tokens(messages, model=None):
+    # every message is framed by a few tokens (role, separators), the reply is primed with 3 more
+    return sum(count_tokens(message["content"], model) + 4 for message in messages) + 3
+
+
+class PromptBudgetError(Exception):
+    pass
+
+
+def check_budget(messages, model):
+    # a call over the budget is not sent, it fails like any other call
+    if max_prompt_tokens is None:
+        return
+    tokens = message_tokens(messages, model)
+    if tokens > max_prompt_tokens:
+        error = PromptBudgetError(f"{tokens} prompt tokens, the budget is {max_prompt_tokens}")
+        usage_ledger.record(model, error=repr(error))
+        raise error
+
+
+def record_usage(model, usage, latency, messages=None, content=None):
+    if usage is None and messages is not None:
+        # a stream cancelled before its end carries no usage, the tokens are counted here,
+        # its cost and prefix cache share are unknown
+        return usage_ledger.record(
+            model, message_tokens(messages, model), count_tokens(content, model), latency, estimated=True
         )
-        # TODO: parse the only code section from the response
+    details = getattr(usage, "prompt_tokens_details", None)
+    return usage_ledger.record(
+        model,
+        usage.prompt_tokens if usage is not None else 0,
+        usage.completion_tokens if usage is not None else 0,
+        latency,
+        # prompt tokens the provider served from its prefix cache
+        cached_prompt_tokens=getattr(details, "cached_tokens", None) or 0,
+    )
+
+
+def chat_completion(messages, model=None, sample_index=None):
+    model = model or default_model
+    check_budget(messages, model)
+    called = False
+
+    def create():
+        nonlocal called
+        called = True
+        start = time.perf_counter()
+        try:
+            response = get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+            )
+        except Exception as e:
+            usage_ledger.record(model, latency=time.perf_counter() - start, error=repr(e))
+            raise
+        record_usage(model, response.usage, time.perf_counter() - start)
         return response.choices[0].message.content.strip()
+
+    if response_cache is None:
+        return create()
+    content = response_cache.complete(model, messages, create, sample_index)
+    if not called:
+        usage_ledger.record(model, cached=True)
+    return content
+
+
+def complete(messages, model=None, sample_index=None):
+    """
+    Chat completion of messages (e.g. of prompt_layout.assemble), None if the call failed
+    """
+    try:
+        return chat_completion(messages, model, sample_index)
     except Exception as e:
         print("Error on openai.ChatCompletion.create: ", e)
 
 
+def call_openai_api(prompt, model=None, sample_index=None):
+    # TODO: append the return structure of the response to prompt
+    prompt += f"\n"
+
+    # TODO: parse the only code section from the response
+    return complete(
+        [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant for writing code.",
+            },
+            {"role": "user", "content": prompt},
+        ],
+        model,
+        sample_index,
+    )
+
+
 def mutate_with_openai(
     prompt,
     mutation_instructions=(
         "Make small, random changes to the text such as replacing words with synonyms, "
         "adding minor typographical errors, or rephrasing parts of the text while preserving its meaning."
     ),
-    model="gpt-4o-mini",
+    model=None,
+    sample_index=None,
 ):
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
+        return chat_completion(
+            [
                 {
                     "role": "system",
                     "content": "You are a helpful assistant for mutating text.",
@@ -61,12 +233,232 @@ def mutate_with_openai(
                     "content": f"Mutate the following text according to the instructions and the mutation rate in the text:\n\nText: {prompt}\nInstructions: {mutation_instructions}",
                 },
             ],
+            model,
+            sample_index,
         )
-        return response.choices[0].message.content.strip()
     except Exception as e:
         print("Error while calling OpenAI API:", e)
         return None
 
+class LLMCallError(Exception):
+    pass
+
+
+# errors worth another attempt, everything else (bad request, auth, ...) fails right away
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+def estimate_tokens(messages):
+    # rough count (4 characters per token), only used for rate limiting
+    return sum(len(message["content"]) for message in messages) // 4 + 1
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        """
+        Token bucket refilled continuously at per_minute / 60 per second, holding at most per_minute
+        @param: per_minute: Rate limit, None for no limit
+        """
+        self.per_minute = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        if self.per_minute is None:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # a request larger than the whole bucket would wait forever
+        amount = min(amount, self.per_minute)
+        # the lock keeps the waiters in order, so big requests are not starved
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) * 60 / self.per_minute)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount):
+        # correct an estimate once the real usage is known (negative: give tokens back), the bucket
+        # may go into debt and never holds more than per_minute
+        if self.per_minute is None:
+            return
+        self._refill()
+        self.tokens = min(self.per_minute, self.tokens - amount)
+
+
+class AsyncLLMClient:
+    def __init__(
+        self,
+        max_concurrency=8,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=60.0,
+        timeout=120.0,
+        expected_completion_tokens=1024,
+        stream_code=True,
+    ):
+        """
+        Chat completions on AsyncOpenAI with bounded concurrency, rate limits and retries
+        @param: max_concurrency: Requests in flight at the same time
+        @param: requests_per_minute: Request rate limit, None for no limit
+        @param: tokens_per_minute: Token rate limit (prompt + completion), None for no limit
+        @param: max_retries: Attempts after the first one for rate limits, timeouts and server errors
+        @param: base_delay: Backoff before the first retry in seconds, doubled for every further retry
+        @param: max_delay: Upper bound of the backoff in seconds
+        @param: timeout: Deadline of a single attempt in seconds
+        @param: expected_completion_tokens: Completion tokens reserved in the token bucket before a call
+        @param: stream_code: Stream the code requests (complete_code) and cancel them at the end of the code
+        """
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.expected_completion_tokens = expected_completion_tokens
+        self.stream_code = stream_code
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self._loop = None
+
+    def _bind_to_running_loop(self):
+        # the client and the semaphore belong to one event loop, GA starts a
+        # new loop for every population
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.request_bucket._lock = None
+            self.token_bucket._lock = None
+            # retries are done here, with jitter and rate limiting
+            self._client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+    async def _request(self, messages, model, stream):
+        # one attempt, returns the response text and its usage (None if the stream was cancelled)
+        if not stream:
+            response = await self._client.chat.completions.create(model=model, messages=messages)
+            return response.choices[0].message.content.strip(), response.usage
+        extractor = CodeExtractor()
+        usage = None
+        response = await self._client.chat.completions.create(
+            model=model, messages=messages, stream=True, stream_options={"include_usage": True}
+        )
+        try:
+            async for chunk in response:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content and extractor.feed(chunk.choices[0].delta.content):
+                    # the code block is closed, the explanation the model may add after it is not waited for
+                    break
+        finally:
+            await response.close()
+        return extractor.text.strip(), usage
+
+    async def _create(self, messages, model, stream=False):
+        estimated = estimate_tokens(messages) + self.expected_completion_tokens
+        # the latency of a call includes the retries and the waits for the rate limits
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire()
+            await self.token_bucket.acquire(estimated)
+            try:
+                async with self._semaphore:
+                    with tracer.span(f"llm {current_phase.get() or 'call'}", lane="llm", model=model, attempt=attempt):
+                        content, usage = await asyncio.wait_for(
+                            self._request(messages, model, stream),
+                            self.timeout,
+                        )
+                record = record_usage(model, usage, time.perf_counter() - start, messages, content)
+                self.token_bucket.adjust(record["prompt_tokens"] + record["completion_tokens"] - estimated)
+                return content
+            except RETRYABLE_ERRORS as e:
+                # the server reported no usage for a failed attempt, only the successful one is charged
+                self.token_bucket.adjust(-estimated)
+                if attempt == self.max_retries:
+                    usage_ledger.record(model, latency=time.perf_counter() - start, error=repr(e))
+                    raise LLMCallError(f"giving up after {attempt + 1} attempts: {e!r}") from e
+                # full jitter exponential backoff
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                print(f"LLM call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            except openai.OpenAIError as e:
+                self.token_bucket.adjust(-estimated)
+                usage_ledger.record(model, latency=time.perf_counter() - start, error=repr(e))
+                raise LLMCallError(repr(e)) from e
+
+    async def chat(self, messages, model=None, sample_index=None, stream=False):
+        """
+        @param: messages: Chat messages sent to the model
+        @param: model: Model name, None for llm_api.default_model
+        @param: sample_index: Sample of the request in the response cache
+        @param: stream: Stream the response and stop it after the first fenced Rust block
+        @return: Response text
+        """
+        model = model or default_model
+        check_budget(messages, model)
+        self._bind_to_running_loop()
+        if response_cache is None:
+            return await self._create(messages, model, stream)
+        called = False
+
+        def create():
+            nonlocal called
+            called = True
+            return self._create(messages, model, stream)
+
+        content = await response_cache.complete_async(model, messages, create, sample_index)
+        if not called:
+            usage_ledger.record(model, cached=True)
+        return content
+
+    async def complete(self, messages, model=None, sample_index=None, stream=False):
+        """
+        Async counterpart of complete, returns None if the call failed
+        """
+        try:
+            return await self.chat(messages, model, sample_index, stream)
+        except Exception as e:
+            print("Error on async chat completion: ", e)
+            return None
+
+    async def complete_code(self, messages, model=None, sample_index=None):
+        """
+        Code of the first fenced Rust block of the response (see code_extraction), None if the call failed.
+        Streamed requests end as soon as the block is closed, the code goes to the evaluation right away
+        """
+        return extract_code(await self.complete(messages, model, sample_index, self.stream_code))
+
+    async def call(self, prompt, model=None, sample_index=None):
+        """
+        Async counterpart of call_openai_api, returns None if the call failed
+        """
+        return await self.complete(
+            [
+                {
+                    "role": "system",
+                    "content": "You are a helpful assistant for writing code.",
+                },
+                {"role": "user", "content": prompt + "\n"},
+            ],
+            model,
+            sample_index,
+        )
+
+
 def run_thread(prompt, results, index):
     results[index] = call_openai_api(prompt)
 
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from data_types import CacheMode
+
+# seconds a write waits for another process holding the database lock
+BUSY_TIMEOUT = 60
+
+
+class LLMCacheMiss(Exception):
+    pass
+
+
+class LLMResponseCache:
+    def __init__(self, path: str, mode: CacheMode = CacheMode.READ_THROUGH):
+        """
+        SQLite store of chat completions, keyed on (model, messages) and the sample index
+        @param: path: Path of the SQLite database file
+        @param: mode: RECORD, REPLAY or READ_THROUGH, see CacheMode
+        """
+        self.path = path
+        self.mode = mode
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # written by every island process of a run, as the fitness cache
+        self._connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT NOT NULL,
+                sample_index INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (key, sample_index)
+            )"""
+        )
+        self._connection.commit()
+        # how many samples of every key were handed out in this run, the n-th
+        # identical request of a run gets sample n, so a replay sees the
+        # responses in the same order they were recorded in
+        self._next_sample = defaultdict(int)
+
+    @staticmethod
+    def key(model: str, messages: list) -> str:
+        payload = json.dumps({"model": model, "messages": messages}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _claim_sample_index(self, key: str, sample_index) -> int:
+        with self._lock:
+            if sample_index is None:
+                sample_index = self._next_sample[key]
+            self._next_sample[key] = max(self._next_sample[key], sample_index + 1)
+        return sample_index
+
+    def sample_counters(self) -> dict:
+        # the next sample index of every key, stored in the checkpoints of a run
+        with self._lock:
+            return dict(self._next_sample)
+
+    def restore_sample_counters(self, counters: dict) -> None:
+        # a resumed run continues with the samples after the ones its first part used
+        with self._lock:
+            self._next_sample = defaultdict(int, counters)
+
+    def get(self, key: str, sample_index: int):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response FROM responses WHERE key = ? AND sample_index = ?",
+                (key, sample_index),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key: str, sample_index: int, model: str, messages: list, response: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, sample_index, model, json.dumps(messages), response, time.time()),
+            )
+            self._connection.commit()
+
+    def lookup(self, model: str, messages: list, sample_index: int = None):
+        """
+        Find the stored response of a request according to the cache mode
+        @param: model: Model name
+        @param: messages: Chat messages sent to the model
+        @param: sample_index: Which sample of this request, by default the next one not used in this run
+        @return: (key, sample_index, response), response is None when the API has to be called
+        """
+        key = self.key(model, messages)
+        sample_index = self._claim_sample_index(key, sample_index)
+
+        if self.mode == CacheMode.RECORD:
+            return key, sample_index, None
+        response = self.get(key, sample_index)
+        if response is None and self.mode == CacheMode.REPLAY:
+            raise LLMCacheMiss(f"no recorded response for sample {sample_index} of {key}")
+        return key, sample_index, response
+
+    def complete(self, model: str, messages: list, create, sample_index: int = None) -> str:
+        """
+        Answer a chat completion request from the cache or by calling create()
+        @param: create: Function without arguments that calls the API and returns the response text
+        @return: Response text
+        """
+        key, sample_index, response = self.lookup(model, messages, sample_index)
+        if response is not None:
+            return response
+        response = create()
+        if response is not None:
+            self.put(key, sample_index, model, messages, response)
+        return response
+
+    async def complete_async(self, model: str, messages: list, create, sample_index: int = None) -> str:
+        """
+        Same as complete, create is a coroutine function
+        """
+        key, sample_index, response = self.lookup(model, messages, sample_index)
+        if response is not None:
+            return response
+        response = await create()
+        if response is not None:
+            self.put(key, sample_index, model, messages, response)
+        return response
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,417 @@
+import re
+import numpy as np
+from fitness_cache import token_spans
+from prompt_layout import code_messages
+
+# Edits of the model against a base file (the *_src.rs skeleton, or the code being repaired):
+# the reply holds only the items that change, complete with their signatures, e.g. the
+# functions whose body is todo!(). Every item replaces the item of the base with the same
+# name (and signature), items the base does not have are added.
+
+PATCH_INSTRUCTIONS = (
+    "Reply with only the items you implement or change, complete with their signatures: every function "
+    "whose body is todo!(), structs that need other fields, new helper functions. Keep methods inside "
+    "their impl block header as in the code. Leave out everything that stays as it is. Provide the "
+    "code only, in one ```rust block, without any explanation or additional text."
+)
+
+# tokens that may come before the keyword of an item
+QUALIFIERS = {"pub", "const", "async", "unsafe", "extern", "default"}
+# items whose {} block ends them, the others end at ;
+BLOCK_ITEMS = {"fn", "impl", "trait", "mod", "struct", "enum", "union", "macro_rules"}
+# items with other items in their block
+CONTAINERS = {"impl", "trait", "mod"}
+NAMED_ITEMS = {"fn", "trait", "mod", "struct", "enum", "union", "const", "static", "type", "macro_rules"}
+CLOSING = {"(": ")", "[": "]", "{": "}"}
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+FENCED_BLOCK = re.compile(r"```[\w+-]*[^\n]*\n(.*?)```", re.DOTALL)
+
+
+class PatchError(Exception):
+    pass
+
+
+class Item:
+    def __init__(self, kind, name, header, start, end, body=None, children=()):
+        """
+        An item of a Rust file (function, impl block, struct, use declaration, ...)
+        @param: kind: Keyword of the item, e.g. fn or impl
+        @param: name: Name of named items (fn, struct, trait, ...), otherwise None
+        @param: header: Tokens from the keyword up to the block or the ;, e.g. the signature of a function
+        @param: start: Position of the first character, attributes included
+        @param: end: Position after the last character
+        @param: body: Position of the closing brace of a container
+        @param: children: Items in the block of a container (impl, trait, mod)
+        """
+        self.kind = kind
+        self.name = name
+        self.header = header
+        self.start = start
+        self.end = end
+        self.body = body
+        self.children = list(children)
+
+
+def code_blocks(response: str) -> str:
+    # the fenced blocks of the reply, the whole reply if there is none
+    blocks = FENCED_BLOCK.findall(response)
+    return "\n\n".join(blocks) if blocks else response
+
+
+class _Parser:
+    def __init__(self, code: str):
+        self.code = code
+        self.spans = token_spans(code)
+        self.texts = [code[start:end] for start, end in self.spans]
+        # index of the closing bracket of every opening one
+        self.closing = {}
+        stack = []
+        for index, text in enumerate(self.texts):
+            if text in CLOSING:
+                stack.append(index)
+            elif text in (")", "]", "}"):
+                if not stack or CLOSING[self.texts[stack[-1]]] != text:
+                    raise PatchError(f"unbalanced {text!r}")
+                self.closing[stack.pop()] = index
+        if stack:
+            raise PatchError(f"unclosed {self.texts[stack[-1]]!r}")
+
+    def items(self, first: int, last: int) -> list:
+        items = []
+        i = first
+        while i < last:
+            start = i
+            # attributes, #[...] and #![...]
+            while i < last and self.texts[i] == "#":
+                i += 1
+                if i < last and self.texts[i] == "!":
+                    i += 1
+                if i < last and self.texts[i] == "[":
+                    i = self.closing[i] + 1
+            while i < last and (self.texts[i] in QUALIFIERS or self.texts[i].startswith('"')):
+                # const and static items, not const fn
+                if self.texts[i] in ("const", "static") and i + 1 < last and self.texts[i + 1] not in QUALIFIERS | {"fn"}:
+                    break
+                i += 1
+                if i < last and self.texts[i] == "(" and self.texts[i - 1] == "pub":
+                    i = self.closing[i] + 1
+            if i >= last:
+                break
+            keyword = self.texts[i]
+            name = self.texts[i + 1] if keyword in NAMED_ITEMS and i + 1 < last else None
+            if keyword == "macro_rules":
+                name = self.texts[i + 2] if i + 2 < last else None
+            end = i
+            body = None
+            while end < last:
+                text = self.texts[end]
+                if text == ";":
+                    break
+                if text == "{":
+                    close = self.closing[end]
+                    if keyword in BLOCK_ITEMS or self.texts[end - 1] == "!":
+                        body = (end, close)
+                        end = close
+                        break
+                    end = close + 1
+                elif text in ("(", "["):
+                    end = self.closing[end] + 1
+                else:
+                    end += 1
+            end = min(end, last - 1)
+            header_end = body[0] if body is not None else end
+            children = ()
+            if keyword in CONTAINERS and body is not None:
+                children = self.items(body[0] + 1, body[1])
+            items.append(Item(
+                keyword,
+                name,
+                " ".join(self.texts[i:header_end]),
+                self.spans[start][0],
+                self.spans[end][1],
+                self.spans[body[1]][0] if body is not None and keyword in CONTAINERS else None,
+                children,
+            ))
+            i = end + 1
+        return items
+
+
+def parse_items(code: str) -> list:
+    """
+    Top level items of Rust code, with the items of impl, trait and mod blocks as children
+    @raise PatchError: The brackets of the code are not balanced
+    """
+    parser = _Parser(code)
+    return parser.items(0, len(parser.texts))
+
+
+def indentation(code: str, position: int) -> str:
+    line_start = code.rfind("\n", 0, position) + 1
+    prefix = code[line_start:position]
+    return prefix if prefix.isspace() else ""
+
+
+def reindent(text: str, old: str, new: str) -> str:
+    # lines after the first one move from the old to the new indentation, the first one is placed by the caller
+    lines = text.split("\n")
+    moved = [lines[0]]
+    for line in lines[1:]:
+        if line.startswith(old):
+            line = line[len(old):]
+        moved.append(new + line if line else line)
+    return "\n".join(moved)
+
+
+def _path_name(tokens: list):
+    # last identifier of a path before its generic arguments, std :: fmt :: Display < T > -> Display
+    name = None
+    for token in tokens:
+        if token == "<":
+            break
+        if IDENTIFIER.fullmatch(token) and token not in ("dyn", "mut", "for"):
+            name = token
+    return name
+
+
+def container_key(header: str):
+    """
+    What a container is about, the same for headers that only differ in generics and paths:
+    (trait, type) for impl blocks, e.g. (Display, SinglyLinkedList), the header for the others
+    """
+    tokens = header.split(" ")
+    if tokens[0] != "impl":
+        return header
+    i = 1
+    if i < len(tokens) and tokens[i] == "<":
+        depth = 0
+        while i < len(tokens):
+            depth += {"<": 1, ">": -1, ">>": -2}.get(tokens[i], 0)
+            i += 1
+            if depth <= 0:
+                break
+    rest = tokens[i:]
+    if "for" in rest:
+        split = rest.index("for")
+        return _path_name(rest[:split]), _path_name(rest[split + 1:])
+    return None, _path_name(rest)
+
+
+def use_names(header: str):
+    """
+    Module path and imported names of a use declaration, None for forms that are not
+    use a :: b :: C, use a :: b :: C as D or use a :: b :: { C , D }
+    @return: (module path, [(path, name it is imported as)])
+    """
+    tokens = header.split(" ")[1:]
+    if "{" in tokens:
+        brace = tokens.index("{")
+        if tokens[-1] != "}" or tokens.count("{") != 1 or brace < 2 or tokens[brace - 1] != "::":
+            return None
+        module = tokens[: brace - 1]
+        group = " ".join(tokens[brace + 1 : -1]).split(",")
+    else:
+        if "::" not in tokens:
+            return None
+        split = len(tokens) - 1 - tokens[::-1].index("::")
+        module = tokens[:split]
+        group = [" ".join(tokens[split + 1 :])]
+    names = []
+    for entry in group:
+        parts = entry.split()
+        if not parts:
+            continue
+        if len(parts) == 3 and parts[1] == "as":
+            names.append((parts[0], parts[2]))
+        elif len(parts) == 1:
+            names.append((parts[0], parts[0]))
+        else:
+            return None
+    return " ".join(module), names
+
+
+def imported_names(items: list) -> set:
+    # names the use declarations bring into scope, globs as module ::*
+    names = set()
+    for item in items:
+        if item.kind != "use":
+            continue
+        parsed = use_names(item.header)
+        if parsed is None:
+            names.add(item.header)
+            continue
+        module, entries = parsed
+        for path, name in entries:
+            names.add(f"{module} :: *" if path == "*" else name)
+    return names
+
+
+def merge_use(header: str, imported: set):
+    """
+    The part of a use declaration of the reply that the base does not import yet, None if it imports all of it
+    (a second import of the same name does not compile)
+    """
+    parsed = use_names(header)
+    if parsed is None:
+        return None if header in imported else header.replace(" :: ", "::") + ";"
+    module, entries = parsed
+    missing = [
+        (path, name) for path, name in entries
+        if (f"{module} :: *" if path == "*" else name) not in imported
+    ]
+    if not missing:
+        return None
+    module = module.replace(" ", "")
+    names = [path if path == name else f"{path} as {name}" for path, name in missing]
+    if len(names) == 1:
+        return f"use {module}::{names[0]};"
+    return f"use {module}::{{{', '.join(names)}}};"
+
+
+def find_function(item: Item, candidates: list):
+    """
+    The function of the base the function item replaces: the one with the same name,
+    if there are several the one with the same signature
+    @return: Item or None if the base has no function of that name
+    @raise PatchError: Several functions of the base could be meant
+    """
+    named = [candidate for candidate in candidates if candidate.kind == "fn" and candidate.name == item.name]
+    if len(named) > 1:
+        named = [candidate for candidate in named if candidate.header == item.header]
+        if len(named) != 1:
+            raise PatchError(f"fn {item.name} is ambiguous, it is defined more than once")
+    return named[0] if named else None
+
+
+def apply_patch(base: str, response: str) -> str:
+    """
+    Apply the items of a patch reply to the base code
+    @param: base: Code the reply was asked against, e.g. the skeleton
+    @param: response: Reply of the model, the fenced blocks are taken if there are any
+    @return: The patched code
+    @raise PatchError: The reply has no items, its brackets are not balanced, or an item has no place in the base
+    """
+    if not response:
+        raise PatchError("empty reply")
+    patch_code = code_blocks(response)
+    base_items = parse_items(base)
+    patch_items = parse_items(patch_code)
+    if not patch_items:
+        raise PatchError("no items in the reply")
+    functions = [item for item in base_items if item.kind == "fn"]
+    for container in base_items:
+        functions += [child for child in container.children if child.kind == "fn"]
+
+    # (start, end, text) of the base, an insertion has start == end
+    edits = []
+
+    def replace(target: Item, item: Item) -> None:
+        text = patch_code[item.start:item.end]
+        edits.append((target.start, target.end, reindent(
+            text, indentation(patch_code, item.start), indentation(base, target.start)
+        )))
+
+    def insert(container: Item, item: Item) -> None:
+        text = patch_code[item.start:item.end]
+        inner = indentation(base, container.start) + "    "
+        edits.append((container.body, container.body, inner + reindent(
+            text, indentation(patch_code, item.start), inner
+        ) + "\n" + indentation(base, container.start)))
+
+    def append(item: Item) -> None:
+        text = patch_code[item.start:item.end]
+        edits.append((len(base), len(base), "\n\n" + reindent(text, indentation(patch_code, item.start), "")))
+
+    for item in patch_items:
+        if item.kind == "fn":
+            target = find_function(item, functions)
+            if target is not None:
+                replace(target, item)
+            else:
+                append(item)
+        elif item.kind in CONTAINERS:
+            # the blocks of the base about the same type and trait (an impl may be split into several),
+            # new items go to the one with the same header if there is one
+            containers = [
+                base_item for base_item in base_items
+                if base_item.kind == item.kind and container_key(base_item.header) == container_key(item.header)
+            ]
+            if not containers:
+                append(item)
+                continue
+            containers.sort(key=lambda container: container.header != item.header)
+            members = [child for container in containers for child in container.children]
+            for child in item.children:
+                if child.kind == "fn":
+                    target = find_function(child, members)
+                else:
+                    target = next(
+                        (member for member in members
+                         if member.kind == child.kind and child.name is not None and member.name == child.name),
+                        None,
+                    )
+                if target is not None:
+                    replace(target, child)
+                else:
+                    insert(containers[0], child)
+        elif item.kind == "use":
+            text = merge_use(item.header, imported_names(base_items))
+            if text is not None:
+                # after the use declarations of the base, inner doc comments and attributes stay first
+                uses = [base_item for base_item in base_items if base_item.kind == "use"]
+                if uses:
+                    edits.append((uses[-1].end, uses[-1].end, "\n" + text))
+                else:
+                    edits.append((base_items[0].start, base_items[0].start, text + "\n\n"))
+        else:
+            target = next(
+                (base_item for base_item in base_items
+                 if base_item.kind == item.kind and item.name is not None and base_item.name == item.name),
+                None,
+            )
+            if target is not None:
+                replace(target, item)
+            elif not any(base_item.kind == item.kind and base_item.header == item.header for base_item in base_items):
+                append(item)
+
+    # applied back to front, so the positions of the earlier edits stay valid
+    edits.sort(key=lambda edit: (edit[0], edit[1]))
+    for (start, end, _), (next_start, _, _) in zip(edits, edits[1:]):
+        if next_start < end or (start == next_start and start != end):
+            raise PatchError("the reply changes the same item twice")
+    patched = base
+    for start, end, text in reversed(edits):
+        patched = patched[:start] + text + patched[end:]
+    return patched
+
+
+def patch_prompt(prompt: str, source_code: str) -> list:
+    return code_messages(prompt, source_code, PATCH_INSTRUCTIONS)
+
+
+def estimate_tokens(text: str) -> float:
+    # about 4 characters per token for code and English
+    return len(text) / 4
+
+
+def savings(records: list, full_tokens: list) -> dict:
+    """
+    Completion tokens and latency of the patch calls of a generation against the estimate for full code
+    @param: records: Usage records of the patch calls and of their full generation fallbacks
+    @param: full_tokens: Estimated completion tokens had every candidate been generated in full
+    @return: tokens, full_tokens, latency, full_latency (None if it can't be estimated)
+    """
+    records = [record for record in records if not record["cached"] and record["error"] is None]
+    tokens = np.array([record["completion_tokens"] for record in records], dtype=float)
+    latencies = np.array([record["latency"] for record in records], dtype=float)
+    full_latency = None
+    if len(np.unique(tokens)) >= 2:
+        # latency = overhead + tokens / throughput, fitted on the calls of the generation
+        slope, intercept = np.polyfit(tokens, latencies, 1)
+        if slope > 0:
+            full_latency = float(np.sum(intercept + slope * np.array(full_tokens)))
+    return {
+        "tokens": float(tokens.sum()),
+        "full_tokens": float(np.sum(full_tokens)),
+        "latency": float(latencies.sum()),
+        "full_latency": full_latency,
+    }
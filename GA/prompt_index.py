@@ -0,0 +1,92 @@
+import hashlib
+import re
+import numpy as np
+
+# Mersenne prime 2^31 - 1, hash values are reduced below it so a * x + b fits in int64
+PRIME = (1 << 31) - 1
+
+
+def normalize_prompt(prompt: str) -> str:
+    # case, punctuation and spacing don't make a prompt different
+    return " ".join(re.findall(r"\w+", prompt.lower()))
+
+
+def shingles(prompt: str, size: int = 5) -> set:
+    """
+    Character n-grams of the normalized prompt, a prompt shorter than size characters is a single shingle.
+    Characters rather than words, so a synonym in a short prompt only changes a few of them.
+    """
+    text = normalize_prompt(prompt)
+    if len(text) <= size:
+        return {text}
+    return {text[i : i + size] for i in range(len(text) - size + 1)}
+
+
+def shingle_hashes(prompt: str, size: int = 5) -> np.ndarray:
+    # stable across processes, unlike hash()
+    return np.array(
+        [
+            int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little") % PRIME
+            for shingle in shingles(prompt, size)
+        ],
+        dtype=np.int64,
+    )
+
+
+class PromptIndex:
+    def __init__(self, threshold: float = 0.8, num_hashes: int = 128, shingle_size: int = 5, seed: int = 0):
+        """
+        MinHash signatures of evaluated prompts, to find the near-duplicates of new ones
+        @param: threshold: Estimated Jaccard similarity of the shingles from which a prompt is a near-duplicate
+        @param: num_hashes: Length of the signatures, the estimate has a standard error of about 1 / sqrt(num_hashes)
+        @param: shingle_size: Characters per shingle
+        @param: seed: Seed of the hash functions, indexes with the same seed are comparable
+        """
+        self.threshold = threshold
+        self.num_hashes = num_hashes
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        # h_i(x) = (a_i x + b_i) mod PRIME
+        self._a = rng.randint(1, PRIME, size=num_hashes, dtype=np.int64)
+        self._b = rng.randint(0, PRIME, size=num_hashes, dtype=np.int64)
+        self._signatures = np.empty((0, num_hashes), dtype=np.int64)
+        self.entries = []
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def signature(self, prompt: str) -> np.ndarray:
+        hashes = shingle_hashes(prompt, self.shingle_size)
+        return ((np.outer(hashes, self._a) + self._b) % PRIME).min(axis=0)
+
+    def add(self, prompt: str, entry) -> None:
+        """
+        @param: entry: Returned by match for near-duplicates of prompt, e.g. the evaluated Solution
+        """
+        self._signatures = np.vstack([self._signatures, self.signature(prompt)])
+        self.entries.append(entry)
+
+    def similarities(self, prompt: str) -> np.ndarray:
+        # fraction of equal minimum hashes, an estimate of the Jaccard similarity
+        if not self.entries:
+            return np.empty(0)
+        return (self._signatures == self.signature(prompt)).mean(axis=1)
+
+    def match(self, prompt: str):
+        """
+        The entry of the most similar indexed prompt if it is a near-duplicate, otherwise None
+        """
+        similarities = self.similarities(prompt)
+        if similarities.size == 0:
+            return None
+        best = int(similarities.argmax())
+        if similarities[best] < self.threshold:
+            return None
+        return self.entries[best]
+
+    def child_index(self) -> "PromptIndex":
+        """
+        Empty index with the same hash functions, e.g. for the offspring of one generation
+        """
+        return PromptIndex(self.threshold, self.num_hashes, self.shingle_size, self.seed)
@@ -0,0 +1,47 @@
+from typing import List
+import llm_api
+
+SYSTEM_PROMPT = "You are a helpful assistant for writing code."
+CODE_INSTRUCTIONS = "Provide the code only, without any explanation or additional text."
+TRUNCATED = "\n[... truncated]"
+
+
+def layout(static: List[str], variable: List[str]) -> list:
+    # the system message holds what every individual shares, the user message what it doesn't
+    return [
+        {"role": "system", "content": "\n\n".join([SYSTEM_PROMPT, *static])},
+        {"role": "user", "content": "\n\n".join(part for part in variable if part) + "\n"},
+    ]
+
+
+def assemble(static: List[str], variable: List[str], trimmable: List[int] = (), model: str = None) -> list:
+    """
+    Chat messages laid out for the provider's prompt prefix cache: the static parts (skeleton, reply
+    instructions), the same for the whole population, form the prefix and the evolving prompt comes last
+    @param: static: Parts of the system message, in order
+    @param: variable: Parts of the user message, in order, the evolving prompt last
+    @param: trimmable: Parts that may be cut to fit llm_api.max_prompt_tokens, as indices into
+                       static + variable, the first one is cut first. The evolving prompt is never cut,
+                       it is what the GA scores: a call that still does not fit fails in
+                       llm_api.check_budget and the candidate gets no code (fitness inf)
+    @param: model: Model whose tokenizer counts the tokens, None for llm_api.default_model
+    """
+    parts = list(static) + list(variable)
+    budget = llm_api.max_prompt_tokens
+    if budget is not None:
+        for index in trimmable:
+            excess = llm_api.message_tokens(layout(parts[: len(static)], parts[len(static):]), model) - budget
+            if excess <= 0:
+                break
+            keep = llm_api.count_tokens(parts[index], model) - excess - llm_api.count_tokens(TRUNCATED, model)
+            parts[index] = llm_api.truncate_tokens(parts[index], max(keep, 0), model) + TRUNCATED
+    return layout(parts[: len(static)], parts[len(static):])
+
+
+def code_messages(prompt: str, source_code: str, instructions: str = CODE_INSTRUCTIONS) -> list:
+    """
+    Request for the implementation of a skeleton, the skeleton is cut when the request is over the token budget
+    @param: prompt: The evolving prompt
+    @param: instructions: What the reply should look like, e.g. patch.PATCH_INSTRUCTIONS
+    """
+    return assemble([f"Code:\n{source_code}", instructions], [prompt], trimmable=[0])
@@ -0,0 +1,43 @@
+import math
+import numpy as np
+
+# two-sided 95% quantiles of Student's t distribution by degrees of freedom
+T_QUANTILES_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262,
+    10: 2.228, 12: 2.179, 15: 2.131, 20: 2.086, 30: 2.042, 60: 2.000,
+}
+
+
+def t_quantile(degrees_of_freedom: int) -> float:
+    # the table entry at or below the degrees of freedom, a little conservative in between
+    if degrees_of_freedom > 60:
+        return 1.960
+    return T_QUANTILES_95[max(df for df in T_QUANTILES_95 if df <= degrees_of_freedom)]
+
+
+def mean_confidence_interval(samples: list):
+    """
+    Mean of the finite samples and the half width of its 95% confidence interval
+    @param: samples: Fitness of every code sample of a prompt, inf for samples that could not be generated
+    @return: (mean, half width), the half width is inf for fewer than two samples, the mean inf without any
+    """
+    values = np.array([sample for sample in samples if math.isfinite(sample)], dtype=float)
+    if values.size == 0:
+        return float("inf"), float("inf")
+    mean = float(values.mean())
+    if values.size < 2:
+        return mean, float("inf")
+    half_width = t_quantile(values.size - 1) * float(values.std(ddof=1)) / math.sqrt(values.size)
+    return mean, half_width
+
+
+def still_in_race(mean: float, half_width: float, best_mean: float, best_half_width: float) -> bool:
+    """
+    A prompt leaves the race once its interval lies entirely above the one of the best prompt
+    """
+    return mean - half_width <= best_mean + best_half_width
+
+
+def halve(contenders: list, key) -> list:
+    # successive halving: the better half (rounded up) goes to the next round
+    return sorted(contenders, key=key)[: math.ceil(len(contenders) / 2)]
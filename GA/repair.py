@@ -0,0 +1,74 @@
+import math
+from prompt_layout import assemble
+
+# diagnostics and failing tests shown to the model per repair request at most
+MAX_DIAGNOSTICS = 20
+MAX_FAILED_TESTS = 10
+
+FULL_INSTRUCTIONS = "Fix the implementation. Provide the complete code only, without any explanation or additional text."
+
+
+def is_repairable(report: dict) -> bool:
+    # evaluated code that does not pass yet, a failed LLM call has no code to repair
+    return report is not None and 0 < report["total_score"] < math.inf
+
+
+def format_diagnostic(diagnostic: dict) -> str:
+    # like rustc's short message format: error[E0308]: src/linked_list.rs:12:5: mismatched types (label)
+    code = f"[{diagnostic['code']}]" if diagnostic.get("code") else ""
+    location = f"{diagnostic.get('file')}:{diagnostic.get('line')}:{diagnostic.get('column')}"
+    label = f" ({diagnostic['label']})" if diagnostic.get("label") else ""
+    return f"{diagnostic.get('level')}{code}: {location}: {diagnostic.get('message')}{label}"
+
+
+def report_feedback(report: dict) -> str:
+    """
+    The diagnostics, the limits that were hit and the failed tests of a report as text for the model,
+    the errors before the warnings
+    """
+    lines = []
+    diagnostics = sorted(report.get("diagnostics", []), key=lambda diagnostic: diagnostic.get("level") != "error")
+    for diagnostic in diagnostics[:MAX_DIAGNOSTICS]:
+        lines.append(format_diagnostic(diagnostic))
+    if len(diagnostics) > MAX_DIAGNOSTICS:
+        lines.append(f"... and {len(diagnostics) - MAX_DIAGNOSTICS} more")
+    for outcome in report.get("outcomes", []):
+        if outcome == "CompileTimeoutError":
+            lines.append("The build did not finish in time.")
+        elif outcome == "BuildError":
+            lines.append("The build failed (syntax error or another error without an error code).")
+        elif outcome == "TestTimeoutError":
+            lines.append("The tests did not finish in time (infinite loop or far too slow).")
+        elif outcome == "TestCrashError":
+            lines.append("The test binary crashed (stack overflow, out of memory or abort).")
+    failed = [
+        (name, test) for name, test in sorted(report.get("tests", {}).items())
+        if test["outcome"] not in ("ok", "ignored")
+    ]
+    for name, test in failed[:MAX_FAILED_TESTS]:
+        message = test.get("message", "").strip()
+        lines.append(f"test {name}: {test['outcome']}" + (f"\n{message}" if message else ""))
+    if len(failed) > MAX_FAILED_TESTS:
+        lines.append(f"... and {len(failed) - MAX_FAILED_TESTS} more failed tests")
+    return "\n".join(lines)
+
+
+def repair_prompt(prompt: str, source_code: str, code_string: str, report: dict, instructions: str = FULL_INSTRUCTIONS) -> list:
+    """
+    Request to fix generated code with the feedback of its evaluation, the feedback is cut first,
+    then the skeleton and then the code being repaired when the request is over the token budget
+    @param: prompt: The prompt the code was generated with
+    @param: source_code: Skeleton the code implements
+    @param: code_string: Generated code
+    @param: report: Report of the evaluation of code_string
+    @param: instructions: What the reply should look like, e.g. patch.PATCH_INSTRUCTIONS
+    """
+    return assemble(
+        [f"Code:\n{source_code}", instructions],
+        [
+            f"This implementation does not pass yet:\n{code_string}",
+            f"Compiler and test output:\n{report_feedback(report)}",
+            prompt,
+        ],
+        trimmable=[3, 0, 2],
+    )
@@ -0,0 +1,277 @@
+import argparse
+import json
+import math
+import os
+import re
+import numpy as np
+from compiler_error import error_classes
+from surrogate import spearman
+
+SCORING_TABLE = os.path.join(os.path.dirname(__file__), "scoring.json")
+
+
+def diagnostic_record(details: dict) -> dict:
+    """
+    The fields of a rustc diagnostic the score depends on, kept in the report so it can be scored again
+    @param: details: 'message' object of a compiler-message in cargo's JSON output
+    """
+    spans = details.get('spans') or []
+    primary = next((span for span in spans if span.get('is_primary')), spans[0] if spans else {})
+    code = details.get('code') or {}
+    return {
+        'code': code.get('code'),
+        'level': details.get('level'),
+        'message': details.get('message') or '',
+        'label': primary.get('label'),
+        'file': primary.get('file_name'),
+        'line': primary.get('line_start', 0),
+        'column': primary.get('column_start', 0),
+        'spans': len(spans),
+    }
+
+
+class ScoringModel:
+    def __init__(self, table: dict, path: str = None):
+        """
+        Scores of the diagnostics and outcomes of an evaluation, from a scoring table (see scoring.json):
+        codes: entry ({"type", "score"}) by rustc error code, looked up in a dict
+        default: entry of codes that are not in the table (lints of warnings included), none: not scored
+        messages: entries with a regex "pattern" for diagnostics without a code, the first match wins
+        outcomes: score and stage ('build' or 'test') of the evaluations that hit a limit
+        severity: weight by level ('error', 'warning'), 1 for levels not listed
+        span_weight: every span of a diagnostic after the first adds this fraction of its score
+        duplicates: weight of a diagnostic repeated at the same span ('same_span'), and of one with the
+                    type, message and label of an earlier one ('cascade', e.g. every use of a missing
+                    import), 1 (no collapse) when not listed. An entry with "cascade": "type" cascades
+                    from any earlier one of its type, at its own "cascade_weight" if it has one
+                    (the default table counts the delimiter errors of a file once)
+        @param: path: File the table was read from, for messages
+        """
+        self.table = table
+        self.path = path
+        self.codes = table.get('codes', {})
+        self.default = table.get('default')
+        self.messages = [dict(rule, regex=re.compile(rule['pattern'])) for rule in table.get('messages', [])]
+        self.outcomes = table.get('outcomes', {})
+        self.severity = table.get('severity', {})
+        self.span_weight = table.get('span_weight', 0.0)
+        duplicates = table.get('duplicates', {})
+        self.same_span_weight = duplicates.get('same_span', 1.0)
+        self.cascade_weight = duplicates.get('cascade', 1.0)
+        self._classes = error_classes()
+
+    @classmethod
+    def load(cls, path: str = None) -> "ScoringModel":
+        path = path or SCORING_TABLE
+        with open(path, "r") as file:
+            return cls(json.load(file), path)
+
+    def entry(self, diagnostic: dict):
+        """
+        Table entry of a diagnostic record (see diagnostic_record)
+        @return: Dictionary with type and score, None for diagnostics that are not scored
+        """
+        if diagnostic['code']:
+            return self.codes.get(diagnostic['code'], self.default)
+        for rule in self.messages:
+            if rule['regex'].match(diagnostic['message']):
+                return rule
+        return None
+
+    def weight(self, diagnostic: dict) -> float:
+        spans = max(diagnostic.get('spans', 1) - 1, 0)
+        return self.severity.get(diagnostic['level'], 1.0) * (1 + self.span_weight * spans)
+
+    def error(self, diagnostic: dict, error_type: str, score: float):
+        # the CompilerError of a scored diagnostic, types unknown to compiler_error.py are general errors
+        cls = self._classes.get(error_type, self._classes['GeneralError'])
+        return cls(diagnostic['line'], diagnostic['column'], diagnostic['message'], score)
+
+    def outcome(self, error):
+        """
+        Set the score of an outcome (CompileTimeoutError, BuildError, TestTimeoutError, TestCrashError) from the table
+        """
+        error.score = self.outcomes.get(type(error).__name__, {}).get('score', 0)
+        return error
+
+    def scorer(self) -> "DiagnosticScorer":
+        return DiagnosticScorer(self)
+
+    def total_score(self, diagnostics_score: float, passed: int, failed: int, outcomes: list, unfinished: int = 0) -> float:
+        if passed or failed:
+            return failed / (failed + passed + unfinished)
+        test_outcomes = [outcome for outcome in outcomes if self.outcomes.get(outcome, {}).get('stage') == 'test']
+        if test_outcomes:
+            # the code compiled, warnings of the build don't count
+            return self.outcomes[test_outcomes[-1]]['score']
+        return diagnostics_score
+
+    def score_report(self, report: dict) -> dict:
+        """
+        Score a report of RustCompilerErrorParser.generate_report from its diagnostics and outcomes
+        @return: New report with errors_by_type, total_errors, duplicate_diagnostics and total_score
+                 of this model, reports without diagnostics (older report versions) unchanged.
+                 A report whose cargo run failed for reasons outside the code ('cargo_error') scores inf
+        """
+        if report is None:
+            return None
+        if 'tasks' in report:
+            return self._score_aggregate(report)
+        if 'diagnostics' not in report:
+            return report
+        scorer = self.scorer()
+        for diagnostic in report['diagnostics']:
+            scorer.add(diagnostic)
+        for outcome in report.get('outcomes', []):
+            scorer.add_outcome(outcome)
+        total_score = self.total_score(
+            scorer.score, report['passed'], report['failed'], report.get('outcomes', []), report.get('unfinished', 0)
+        )
+        return dict(
+            report,
+            total_errors=scorer.total_errors,
+            errors_by_type=scorer.errors_by_type,
+            duplicate_diagnostics=scorer.duplicates,
+            total_score=math.inf if report.get('cargo_error') else total_score,
+        )
+
+    def _score_aggregate(self, report: dict) -> dict:
+        # multi-crate report (see ga.aggregate_reports): the score is the mean over the tasks
+        tasks = {code: self.score_report(task_report) for code, task_report in report['tasks'].items()}
+        errors_by_type = {}
+        for task_report in tasks.values():
+            for error_type, count in (task_report or {}).get('errors_by_type', {}).items():
+                errors_by_type[error_type] = errors_by_type.get(error_type, 0) + count
+        scores = [float("inf") if task_report is None else task_report['total_score'] for task_report in tasks.values()]
+        return dict(
+            report,
+            tasks=tasks,
+            total_errors=sum(task_report['total_errors'] for task_report in tasks.values() if task_report is not None),
+            errors_by_type=errors_by_type,
+            total_score=float(np.mean(scores)),
+        )
+
+    def rescore(self, reports: list) -> list:
+        """
+        Score many reports again, e.g. the cached reports of past runs under a new table, nothing is compiled
+        """
+        return [self.score_report(report) for report in reports]
+
+
+class DiagnosticScorer:
+    def __init__(self, model: ScoringModel):
+        """
+        Running score of the diagnostics of one cargo run, in the order they are emitted, so a
+        repeated diagnostic or one that cascades from an earlier one is recognized as such
+        """
+        self.model = model
+        self.score = 0.0
+        self.total_errors = 0
+        self.errors_by_type = {}
+        self.duplicates = 0
+        self._spans = set()
+        self._causes = set()
+
+    def _count(self, error_type: str, score: float) -> None:
+        self.total_errors += 1
+        self.errors_by_type[error_type] = self.errors_by_type.get(error_type, 0) + 1
+        self.score += score
+
+    def add(self, diagnostic: dict):
+        """
+        @param: diagnostic: Record of diagnostic_record
+        @return: CompilerError with its weighted score, None for diagnostics that are not scored
+        """
+        entry = self.model.entry(diagnostic)
+        if entry is None:
+            return None
+        error_type = entry['type']
+        score = entry['score'] * self.model.weight(diagnostic)
+        span = (error_type, diagnostic['message'], diagnostic['file'], diagnostic['line'], diagnostic['column'])
+        if entry.get('cascade') == 'type':
+            cause = error_type
+        else:
+            cause = (error_type, diagnostic['message'], diagnostic['label'])
+        if entry.get('cascade') == 'type' and cause in self._causes:
+            score *= entry.get('cascade_weight', self.model.cascade_weight)
+            self.duplicates += 1
+        elif span in self._spans:
+            score *= self.model.same_span_weight
+            self.duplicates += 1
+        elif cause in self._causes:
+            score *= self.model.cascade_weight
+            self.duplicates += 1
+        self._spans.add(span)
+        self._causes.add(cause)
+        self._count(error_type, score)
+        return self.model.error(diagnostic, error_type, score)
+
+    def add_outcome(self, error_type: str) -> None:
+        self._count(error_type, self.model.outcomes.get(error_type, {}).get('score', 0))
+
+
+_default_model = None
+
+
+def default_model() -> ScoringModel:
+    # scoring.json, read once
+    global _default_model
+    if _default_model is None:
+        _default_model = ScoringModel.load()
+    return _default_model
+
+
+def compare(old_reports: list, new_reports: list) -> dict:
+    """
+    How a new scoring model changes the scores of the same reports
+    @return: Number of reports, changed scores, mean scores (finite ones) and the Spearman rank correlation
+    """
+    old = np.array([report['total_score'] for report in old_reports], dtype=float)
+    new = np.array([report['total_score'] for report in new_reports], dtype=float)
+    finite = np.isfinite(old) & np.isfinite(new)
+    return {
+        "reports": len(old),
+        "changed": int((old != new).sum()),
+        "old_mean": float(old[finite].mean()) if finite.any() else None,
+        "new_mean": float(new[finite].mean()) if finite.any() else None,
+        "rank_correlation": spearman(old[finite], new[finite]),
+    }
+
+
+def print_comparison(name: str, comparison: dict) -> None:
+    def fmt(value):
+        return "-" if value is None else f"{value:.3f}"
+
+    print(
+        f"{name}: {comparison['reports']} reports, {comparison['changed']} scores changed, "
+        f"mean {fmt(comparison['old_mean'])} -> {fmt(comparison['new_mean'])}, "
+        f"rank correlation {fmt(comparison['rank_correlation'])}"
+    )
+
+
+if __name__ == "__main__":
+    from checkpoint import load_checkpoint
+    from fitness_cache import FitnessCache
+
+    parser = argparse.ArgumentParser(description="Score the reports of past runs again under a scoring table, without compiling")
+    parser.add_argument("--table", type=str, default=SCORING_TABLE, help="Scoring table (default: scoring.json)")
+    parser.add_argument("--fitness-cache", type=str, default=None, help="Fitness cache whose reports are scored")
+    parser.add_argument("--checkpoint", type=str, nargs="*", default=[], help="Checkpoints whose populations are scored")
+    parser.add_argument("--top", type=int, default=5, help="Best prompts of a checkpoint to show under the new table")
+    args = parser.parse_args()
+
+    model = ScoringModel.load(args.table)
+    if args.fitness_cache is not None:
+        cache = FitnessCache(args.fitness_cache)
+        reports = [report for _, report in cache.reports()]
+        cache.close()
+        print_comparison(args.fitness_cache, compare(reports, model.rescore(reports)))
+    for path in args.checkpoint:
+        population = load_checkpoint(path)["population"]
+        solutions = [data for data in population if data["error_report"] is not None]
+        reports = [data["error_report"] for data in solutions]
+        rescored = model.rescore(reports)
+        print_comparison(path, compare(reports, rescored))
+        ranked = sorted(zip(rescored, reports, solutions), key=lambda item: item[0]["total_score"])
+        for new, old, data in ranked[: args.top]:
+            print(f"  {old['total_score']:.3f} -> {new['total_score']:.3f}  {data['prompt'][:80]}")
@@ -0,0 +1,149 @@
+import numpy as np
+
+# Selection probabilities and samplers over a NumPy array of fitness values.
+# Fitness is minimized (0 is a perfect solution), inf marks a solution that
+# could not be evaluated, it only gets picked when nothing else is left.
+
+
+def fitness_array(population) -> np.ndarray:
+    return np.array([sol.fitness for sol in population], dtype=float)
+
+
+def _normalize(weights: np.ndarray, finite: np.ndarray) -> np.ndarray:
+    weights = np.where(finite, np.maximum(weights, 0.0), 0.0)
+    total = weights.sum()
+    if total > 0:
+        return weights / total
+    # no solution stands out: uniform over the evaluated ones (or over all of them)
+    candidates = finite if finite.any() else np.ones_like(finite)
+    return candidates / candidates.sum()
+
+
+def _ranks(fitness: np.ndarray) -> np.ndarray:
+    # worst solution rank 0, best rank n - 1, ties keep their order
+    order = np.argsort(-fitness, kind="stable")
+    ranks = np.empty(len(fitness), dtype=float)
+    ranks[order] = np.arange(len(fitness))
+    return ranks
+
+
+def linear_ranking(fitness: np.ndarray, s: float = 1.5) -> np.ndarray:
+    """
+    P(i) = (2 - s) / n + 2 i (s - 1) / (n (n - 1)) for the solution of rank i (worst 0)
+    @param: s: Selection pressure, 1 < s <= 2
+    """
+    n = len(fitness)
+    if n == 1:
+        return np.ones(1)
+    probabilities = (2 - s) / n + 2 * _ranks(fitness) * (s - 1) / (n * (n - 1))
+    return _normalize(probabilities, np.isfinite(fitness))
+
+
+def exponential_ranking(fitness: np.ndarray) -> np.ndarray:
+    """
+    P(i) proportional to 1 - e^(-i) for the solution of rank i (worst 0)
+    """
+    return _normalize(1 - np.exp(-_ranks(fitness)), np.isfinite(fitness))
+
+
+def windowing(fitness: np.ndarray) -> np.ndarray:
+    """
+    Fitness proportionate with the worst evaluated fitness of the population as the window,
+    f'(i) = worst - f(i)
+    """
+    finite = np.isfinite(fitness)
+    if not finite.any():
+        return _normalize(np.zeros(len(fitness)), finite)
+    worst = fitness[finite].max()
+    return _normalize(worst - np.where(finite, fitness, worst), finite)
+
+
+def sigma_scaling(fitness: np.ndarray, c: float = 2.0) -> np.ndarray:
+    """
+    Fitness proportionate after sigma scaling, for minimization f'(i) = max((mean + c std) - f(i), 0)
+    """
+    finite = np.isfinite(fitness)
+    if not finite.any():
+        return _normalize(np.zeros(len(fitness)), finite)
+    values = fitness[finite]
+    bound = values.mean() + c * values.std()
+    return _normalize(bound - np.where(finite, fitness, bound), finite)
+
+
+def _sample_without_replacement(probabilities: np.ndarray, count: int, draw) -> np.ndarray:
+    # draw(weights, remaining) returns indices picked from the cumulative weights;
+    # every round picks at least one new index, so there are at most count rounds
+    n = len(probabilities)
+    count = min(count, n)
+    weights = probabilities.astype(float).copy()
+    chosen = []
+    while len(chosen) < count:
+        remaining = count - len(chosen)
+        if weights.sum() <= 0:
+            # only solutions without probability left, they fill the rest uniformly
+            rest = np.flatnonzero(~np.isin(np.arange(n), chosen))
+            chosen.extend(np.random.permutation(rest)[:remaining].tolist())
+            break
+        picked = draw(weights, remaining)
+        # first occurrence of every index, in the order they were drawn
+        _, first = np.unique(picked, return_index=True)
+        new = picked[np.sort(first)]
+        new = new[weights[new] > 0][:remaining]
+        chosen.extend(new.tolist())
+        weights[new] = 0.0
+    return np.array(chosen, dtype=int)
+
+
+def _searchsorted(weights: np.ndarray, points: np.ndarray) -> np.ndarray:
+    cumulative = np.cumsum(weights)
+    indices = np.searchsorted(cumulative, points * cumulative[-1], side="right")
+    return np.minimum(indices, len(weights) - 1)
+
+
+def roulette_wheel(probabilities: np.ndarray, count: int) -> np.ndarray:
+    """
+    Indices of count distinct solutions, drawn with independent spins of the wheel
+    """
+    return _sample_without_replacement(
+        probabilities, count, lambda weights, remaining: _searchsorted(weights, np.random.random(remaining))
+    )
+
+
+def stochastic_universal_sampling(probabilities: np.ndarray, count: int) -> np.ndarray:
+    """
+    Indices of count distinct solutions, drawn with count equally spaced pointers and a single spin.
+    A solution with a probability above 1 / count is hit by several pointers, the missing
+    solutions are then drawn by another spin over the ones not chosen yet.
+    """
+    def draw(weights, remaining):
+        pointers = np.random.uniform(0, 1 / remaining) + np.arange(remaining) / remaining
+        return _searchsorted(weights, pointers)
+
+    return _sample_without_replacement(probabilities, count, draw)
+
+
+def lexicase(passes: np.ndarray, fitness: np.ndarray, count: int) -> np.ndarray:
+    """
+    Indices of count distinct solutions picked by lexicase selection: for every pick the test
+    cases are taken in random order, and each one keeps the candidates that pass it (unless
+    none does). The candidates left in the end are decided by fitness, then at random.
+    @param: passes: Boolean matrix, solutions x test cases
+    @param: fitness: Fitness of the solutions, the tie-breaker
+    """
+    n = len(fitness)
+    count = min(count, n)
+    available = np.ones(n, dtype=bool)
+    chosen = []
+    for _ in range(count):
+        candidates = np.flatnonzero(available)
+        for case in np.random.permutation(passes.shape[1]):
+            passing = candidates[passes[candidates, case]]
+            if passing.size:
+                candidates = passing
+            if candidates.size == 1:
+                break
+        best = candidates[fitness[candidates] == fitness[candidates].min()]
+        pick = int(np.random.choice(best))
+        chosen.append(pick)
+        available[pick] = False
+    return np.array(chosen, dtype=int)
@@ -0,0 +1,129 @@
+import hashlib
+import numpy as np
+from prompt_index import normalize_prompt
+
+
+def ngrams(prompt: str) -> list:
+    # word unigrams and bigrams of the normalized prompt
+    words = normalize_prompt(prompt).split()
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+def prompt_features(prompt: str, dim: int = 1024) -> np.ndarray:
+    """
+    Hashed n-gram counts of a prompt, L2 normalized. The sign of every n-gram comes from its
+    hash too, so collisions cancel out on average instead of adding up.
+    """
+    features = np.zeros(dim)
+    for gram in ngrams(prompt):
+        value = int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=8).digest(), "little")
+        features[value % dim] += 1.0 if (value >> 63) & 1 else -1.0
+    norm = np.linalg.norm(features)
+    return features / norm if norm > 0 else features
+
+
+def rank(values: np.ndarray) -> np.ndarray:
+    # ranks starting at 0, tied values get the mean of their ranks
+    order = np.argsort(values, kind="stable")
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(len(values))
+    _, inverse = np.unique(values, return_inverse=True)
+    sums = np.bincount(inverse, weights=ranks)
+    counts = np.bincount(inverse)
+    return (sums / counts)[inverse]
+
+
+def spearman(predicted, actual):
+    """
+    Spearman rank correlation, None when it is not defined (fewer than 3 values or all equal)
+    """
+    predicted, actual = np.asarray(predicted, dtype=float), np.asarray(actual, dtype=float)
+    if len(predicted) < 3:
+        return None
+    ranks_predicted, ranks_actual = rank(predicted), rank(actual)
+    if ranks_predicted.std() == 0 or ranks_actual.std() == 0:
+        return None
+    return float(np.corrcoef(ranks_predicted, ranks_actual)[0, 1])
+
+
+class SurrogateModel:
+    def __init__(self, dim: int = 1024, alpha: float = 1.0):
+        """
+        Ridge regression from hashed prompt n-grams to log(1 + fitness), trained online on every
+        evaluated prompt. The fit uses only the sufficient statistics X^T X and X^T y, so an update
+        costs O(dim^2); the prompts themselves are kept only for the checkpoint.
+        @param: dim: Number of hashed features
+        @param: alpha: L2 regularization
+        """
+        self.dim = dim
+        self.alpha = alpha
+        self.samples = 0
+        self._xtx = np.zeros((dim, dim))
+        self._xty = np.zeros(dim)
+        self._y_sum = 0.0
+        self._feature_sum = np.zeros(dim)
+        self._weights = None
+        # the updates as they were made, to rebuild the model from a checkpoint (see to_dict)
+        self.batches = []
+
+    @staticmethod
+    def target(fitness: float) -> float:
+        # compile error scores reach the hundreds, the test failure ratios are in [0, 1]
+        return float(np.log1p(fitness))
+
+    def update(self, prompts: list, fitness_values: list) -> int:
+        """
+        Add evaluated prompts, the ones without a finite fitness are skipped
+        @return: Number of prompts added
+        """
+        rows, targets, batch = [], [], []
+        for prompt, fitness in zip(prompts, fitness_values):
+            if fitness is None or not np.isfinite(fitness):
+                continue
+            rows.append(prompt_features(prompt, self.dim))
+            targets.append(self.target(fitness))
+            batch.append([prompt, float(fitness)])
+        if not rows:
+            return 0
+        self.batches.append(batch)
+        features, targets = np.array(rows), np.array(targets)
+        self._xtx += features.T @ features
+        self._xty += features.T @ targets
+        self._y_sum += targets.sum()
+        self._feature_sum += features.sum(axis=0)
+        self.samples += len(rows)
+        self._weights = None
+        return len(rows)
+
+    def to_dict(self) -> dict:
+        # the training set rather than X^T X (dim^2 floats), replayed batch by batch it gives the same model
+        return {"dim": self.dim, "alpha": self.alpha, "batches": self.batches}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SurrogateModel":
+        model = cls(data["dim"], data["alpha"])
+        for batch in data["batches"]:
+            model.update([prompt for prompt, _ in batch], [fitness for _, fitness in batch])
+        return model
+
+    def _fit(self) -> None:
+        # centered ridge regression, the intercept is not regularized
+        n = self.samples
+        mean_x = self._feature_sum / n
+        mean_y = self._y_sum / n
+        xtx = self._xtx - n * np.outer(mean_x, mean_x)
+        xty = self._xty - n * mean_x * mean_y
+        weights = np.linalg.solve(xtx + self.alpha * np.eye(self.dim), xty)
+        self._weights = (weights, mean_y - mean_x @ weights)
+
+    def predict(self, prompts: list) -> np.ndarray:
+        """
+        Predicted log(1 + fitness) of the prompts, lower is better, zeros before the first update
+        """
+        if self.samples == 0:
+            return np.zeros(len(prompts))
+        if self._weights is None:
+            self._fit()
+        weights, intercept = self._weights
+        features = np.array([prompt_features(prompt, self.dim) for prompt in prompts])
+        return features @ weights + intercept
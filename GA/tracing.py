@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    def __init__(self):
+        """
+        Collects spans of a run and writes them in the Chrome trace event format, which
+        chrome://tracing and ui.perfetto.dev open. Every thread (or lane) is a track of its own.
+        Disabled until enable() is called, the spans then cost nothing.
+        """
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._tracks = {}
+        self._busy_lanes = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+        self._origin = time.perf_counter()
+
+    def _track_id(self, track: str) -> int:
+        # called with the lock held
+        if track not in self._tracks:
+            self._tracks[track] = len(self._tracks) + 1
+        return self._tracks[track]
+
+    def _claim_lane(self, lane: str) -> str:
+        # coroutines share a thread, so concurrent ones get the lowest free lane
+        # instead, spans of one track must not overlap
+        with self._lock:
+            busy = self._busy_lanes.setdefault(lane, set())
+            index = 0
+            while index in busy:
+                index += 1
+            busy.add(index)
+        return f"{lane} {index}"
+
+    def _release_lane(self, lane: str, track: str) -> None:
+        with self._lock:
+            self._busy_lanes[lane].discard(int(track.rsplit(" ", 1)[1]))
+
+    @contextmanager
+    def span(self, name: str, track: str = None, lane: str = None, **args):
+        """
+        Time the block as one span
+        @param: name: Name of the span, e.g. the GA phase or the step of a candidate
+        @param: track: Track the span is drawn on, by default the current thread
+        @param: lane: For coroutines: the span goes on the first free track named '<lane> <n>'
+        @param: args: Shown with the span, e.g. the size of the population
+        """
+        if not self.enabled:
+            yield
+            return
+        if lane is not None:
+            track = self._claim_lane(lane)
+        elif track is None:
+            track = threading.current_thread().name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if lane is not None:
+                self._release_lane(lane, track)
+            with self._lock:
+                self.events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self._origin) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": self._track_id(track),
+                        "args": args,
+                    }
+                )
+
+    def write(self, path: str, process_name: str = "GA") -> None:
+        """
+        Write the collected spans as a Chrome trace JSON file
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+            tracks = dict(self._tracks)
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": process_name}}]
+        # main thread (the GA phases) first, then the lanes and workers by name
+        order = sorted(tracks, key=lambda track: (track != "MainThread", track))
+        for index, track in enumerate(order):
+            tid = tracks[track]
+            metadata.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": track}})
+            metadata.append({"name": "thread_sort_index", "ph": "M", "pid": pid, "tid": tid, "args": {"sort_index": index}})
+        with open(path, "w") as file:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, file)
+
+
+# tracer of this process, enabled by GA(trace_path=...)
+tracer = Tracer()
@@ -0,0 +1,143 @@
+import os
+import queue
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+# build profile the evaluations use (cargo test / cargo check without --release)
+PROFILE = "debug"
+# files of deps/ that are shared with the warm target directory by hard links, see seed_target_dir
+LINKED_ARTIFACTS = (".rlib", ".rmeta", ".so", ".dylib", ".dll")
+
+
+def package_name(crate_path: str) -> str:
+    """
+    Name of the package in the Cargo.toml of the crate, as it appears in artifact file names
+    """
+    with open(os.path.join(crate_path, "Cargo.toml"), "r") as file:
+        match = re.search(r'^name\s*=\s*"([^"]+)"', file.read(), re.MULTILINE)
+    return match.group(1).replace("-", "_")
+
+
+def seed_target_dir(warm_target_dir: str, target_dir: str, package: str) -> None:
+    """
+    Take over the dependency artifacts of a warm target directory into an empty one, so cargo only
+    compiles the package itself. Only the compiled libraries in deps/ are hard linked: rustc replaces
+    them (written to a temporary file, then renamed) and never writes into them, so a rebuild of the
+    warm directory or of a workspace can't change the file the other one sees. Fingerprints, dep-info
+    and build script outputs are rewritten in place by cargo, they are copied. Hard links fall back
+    to copies when they are not possible.
+    @param: warm_target_dir: Target directory the dependencies were built in (see build_cache.warm)
+    @param: target_dir: Target directory of a workspace
+    @param: package: Package name, its own artifacts are not taken over
+    """
+    own_prefixes = (f"{package}-", f"lib{package}-")
+    source_profile = os.path.join(warm_target_dir, PROFILE)
+    if not os.path.isdir(source_profile):
+        return
+    # incremental/ only holds state of the package itself
+    for sub in ("deps", ".fingerprint", "build"):
+        for root, dirs, files in os.walk(os.path.join(source_profile, sub)):
+            relative = os.path.relpath(root, source_profile)
+            dirs[:] = [d for d in dirs if not d.startswith(own_prefixes)]
+            os.makedirs(os.path.join(target_dir, PROFILE, relative), exist_ok=True)
+            for name in files:
+                if name.startswith(own_prefixes):
+                    continue
+                source = os.path.join(root, name)
+                destination = os.path.join(target_dir, PROFILE, relative, name)
+                if os.path.exists(destination):
+                    continue
+                if sub != "deps" or not name.endswith(LINKED_ARTIFACTS):
+                    shutil.copy2(source, destination)
+                    continue
+                try:
+                    os.link(source, destination)
+                except OSError:
+                    shutil.copy2(source, destination)
+
+
+class CandidateWorkspace:
+    def __init__(self, crate_path: str, code: str, path: str, warm_target_dir: str = None):
+        """
+        A private copy of one example crate that a single candidate is built and tested in.
+        @param: crate_path: Path to the original example crate (e.g. rust_examples/linked_list)
+        @param: code: Name of the example, the candidate is written to src/<code>.rs
+        @param: path: Directory the copy lives in
+        @param: warm_target_dir: Shared target directory with prebuilt dependencies, None builds them here
+        """
+        self.crate_path = crate_path
+        self.code = code
+        self.path = path
+        self.target_dir = os.path.join(path, "target")
+        self._populate()
+        if warm_target_dir is not None:
+            seed_target_dir(warm_target_dir, self.target_dir, package_name(crate_path))
+
+    def _populate(self) -> None:
+        # only the manifest and the small source files are copied, the
+        # target directory stays inside the workspace so it is kept warm
+        # between the candidates that reuse this workspace
+        os.makedirs(os.path.join(self.path, "src"), exist_ok=True)
+        for name in ("Cargo.toml", "Cargo.lock"):
+            original = os.path.join(self.crate_path, name)
+            if os.path.exists(original):
+                shutil.copy2(original, os.path.join(self.path, name))
+
+        src_path = os.path.join(self.crate_path, "src")
+        for name in os.listdir(src_path):
+            if name == f"{self.code}.rs":
+                continue
+            shutil.copy2(os.path.join(src_path, name), os.path.join(self.path, "src", name))
+
+    @property
+    def candidate_path(self) -> str:
+        return os.path.join(self.path, "src", f"{self.code}.rs")
+
+    def write_candidate(self, code_string: str) -> None:
+        with open(self.candidate_path, "w") as file:
+            file.write(code_string)
+
+
+class WorkspacePool:
+    def __init__(
+        self, project_path: str, code: str, size: int = None, root: str = None, warm_target_dir: str = None
+    ):
+        """
+        Fixed set of workspaces handed out to concurrently evaluated candidates.
+        @param: project_path: Path to the rust_examples directory
+        @param: code: Name of the example crate
+        @param: size: Number of workspaces, i.e. how many candidates can be built at the same time
+        @param: root: Directory the workspaces are created in, defaults to rust_examples/.workspaces
+        @param: warm_target_dir: Shared target directory every workspace takes its dependencies from
+        """
+        self.project_path = project_path
+        self.code = code
+        self.size = size or os.cpu_count() or 1
+        if root is None:
+            root = os.path.join(project_path, ".workspaces")
+        os.makedirs(root, exist_ok=True)
+        self.root = tempfile.mkdtemp(prefix=f"{code}_", dir=root)
+
+        crate_path = os.path.join(project_path, code)
+        self._available = queue.Queue()
+        self.workspaces = []
+        for i in range(self.size):
+            workspace = CandidateWorkspace(
+                crate_path, code, os.path.join(self.root, str(i)), warm_target_dir
+            )
+            self.workspaces.append(workspace)
+            self._available.put(workspace)
+
+    @contextmanager
+    def workspace(self):
+        # blocks until one of the workspaces is free
+        workspace = self._available.get()
+        try:
+            yield workspace
+        finally:
+            self._available.put(workspace)
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)